@@ -1,9 +1,13 @@
 import streamlit as st
 import os
+import uuid
 from datetime import datetime
-from chatbot import ChatBot
+from modules.core.shared import get_shared_chatbot, start_shared_chatbot, is_shared_chatbot_ready
 import config
 
+# 登録先の選択肢で新しいコレクションを作る項目
+NEW_COLLECTION_OPTION = "＋ 新しいコレクション"
+
 # ページ設定
 st.set_page_config(
     page_title=config.APP_TITLE,
@@ -49,8 +53,9 @@ st.markdown("""
 
 def initialize_session_state():
     """セッション状態を初期化"""
-    if 'chatbot' not in st.session_state:
-        st.session_state.chatbot = ChatBot()
+    # ベクトルストアやLLMクライアントはプロセス内で共有し、会話履歴だけをセッションごとに持つ
+    # 読み込みはバックグラウンドで行い、終わるのを待たずに画面を表示する
+    start_shared_chatbot()
 
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
@@ -58,6 +63,9 @@ def initialize_session_state():
     if 'uploaded_files_status' not in st.session_state:
         st.session_state.uploaded_files_status = ""
 
+    if 'search_collections' not in st.session_state:
+        st.session_state.search_collections = [config.DEFAULT_COLLECTION]
+
 def display_chat_message(message, role, mode=None, sources=None, tools_used=None):
     """チャットメッセージを表示"""
     if role == "user":
@@ -76,6 +84,9 @@ def display_chat_message(message, role, mode=None, sources=None, tools_used=None
         elif mode == "agents":
             mode_class = "agent-mode"
             mode_text = "🔧 Agentsモード"
+        elif mode == "smalltalk":
+            mode_class = "bot-message"
+            mode_text = "💬 会話"
         else:
             mode_class = "bot-message"
             mode_text = "🤖 チャットボット"
@@ -91,7 +102,8 @@ def display_chat_message(message, role, mode=None, sources=None, tools_used=None
         if sources and len(sources) > 0:
             source_text = "**📄 参考文書:**\n"
             for i, source in enumerate(sources, 1):
-                source_text += f"{i}. {source['source']} - ページ{source['page']}\n"
+                collection = f"[{source['collection']}] " if source.get('collection') else ""
+                source_text += f"{i}. {collection}{source['source']} - ページ{source['page']}\n"
 
             st.markdown(f"""
             <div class="source-info">
@@ -108,6 +120,78 @@ def display_chat_message(message, role, mode=None, sources=None, tools_used=None
             </div>
             """, unsafe_allow_html=True)
 
+def is_chatbot_ready():
+    """チャットボットの読み込みが終わっているか（待たずに確認する）"""
+    return is_shared_chatbot_ready() and get_shared_chatbot().is_ready()
+
+def get_chatbot():
+    """共有するチャットボットを取得し、このセッションの会話履歴を用意（読み込み中なら完了を待つ）"""
+    if 'chatbot' not in st.session_state:
+        st.session_state.chatbot = get_shared_chatbot()
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if 'memory' not in st.session_state:
+        # セッションIDを渡し、会話履歴の保存・要約・上限の管理を ConversationStore に任せる
+        st.session_state.memory = st.session_state.chatbot.create_memory(st.session_state.session_id)
+    return st.session_state.chatbot
+
+def display_latency_panel(latency):
+    """直近の問い合わせの処理段階ごとの時間と、段階別のレイテンシ集計を表示"""
+    import pandas as pd
+    from modules.core.tracing import tracer, INPUT_TOKENS, OUTPUT_TOKENS
+
+    with st.expander("⏱️ 処理時間の内訳"):
+        if not latency:
+            st.caption("まだ計測された処理はありません")
+            return
+
+        traces = [spans for spans in tracer.get_recent_traces(limit=20)
+                  if spans[-1]["name"].startswith("chatbot.")]
+        if traces:
+            spans = traces[0]
+            depths = {}
+            rows = []
+            # 子spanは親より先に終わるため、開始時刻順に並べ直して階層をインデントで表す
+            for span in sorted(spans, key=lambda span: span["start_time_ns"]):
+                depth = depths.get(span["parent_id"], -1) + 1
+                depths[span["span_id"]] = depth
+                tokens = span["attributes"].get(INPUT_TOKENS, 0) + span["attributes"].get(OUTPUT_TOKENS, 0)
+                rows.append({"段階": "\u3000" * depth + span["name"], "ms": span["duration_ms"], "トークン": tokens or ""})
+            st.markdown("**直近の問い合わせ**")
+            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+        st.markdown("**段階別（直近の集計）**")
+        summary = pd.DataFrame([
+            {"段階": name, "回数": stats["count"], "p50 ms": stats["p50_ms"], "p95 ms": stats["p95_ms"],
+             "トークン": stats["input_tokens"] + stats["output_tokens"]}
+            for name, stats in latency.items()
+        ])
+        st.dataframe(summary, hide_index=True, use_container_width=True)
+
+def display_smalltalk_panel(smalltalk):
+    """検索やエージェントを使わずに答えた挨拶・雑談の割合と短縮時間を表示"""
+    with st.expander("💬 雑談の直接応答"):
+        col1, col2 = st.columns(2)
+        col1.metric("全体に占める割合", f"{smalltalk['share']:.1%}")
+        col2.metric("定型文 / LLM", f"{smalltalk['template_answers']} / {smalltalk['llm_answers']}")
+        if smalltalk["saved_seconds"] is not None:
+            st.caption(f"検索・エージェントを省いて約{smalltalk['saved_seconds']:.1f}秒短縮"
+                       f"（1件あたり約{smalltalk['saved_ms_per_query']:.0f}ms）")
+        else:
+            st.caption("比較できるRAG・エージェントの処理時間がまだありません")
+
+def display_startup_panel(startup):
+    """起動時の重いimportとサブシステムの初期化にかかった時間を表示"""
+    import pandas as pd
+
+    with st.expander("🚀 起動時間の内訳"):
+        st.caption(f"全サブシステムの準備完了まで {startup['ready_seconds']:.2f}秒（プロセス起動時から）")
+        rows = [{"種類": record["kind"], "対象": record["name"], "開始 s": record["start_seconds"],
+                 "秒": record["seconds"], "スレッド": record["thread"]}
+                for record in startup["init"] + startup["import"]]
+        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+
 def main():
     """メイン関数"""
     initialize_session_state()
@@ -125,9 +209,27 @@ def main():
             st.error("⚠️ OpenAI APIキーが設定されていません。.envファイルにOPENAI_API_KEYを設定してください。")
             st.stop()
 
+        # コレクションの選択（読み込み中は既定のコレクションだけを表示する）
+        ready = is_chatbot_ready()
+        collections = get_chatbot().list_collections() if ready else [config.DEFAULT_COLLECTION]
+        st.session_state.search_collections = [name for name in st.session_state.search_collections
+                                               if name in collections]
+        st.multiselect("🔎 検索するコレクション", collections, key="search_collections",
+                       help="複数選択すると横断して検索します（未選択の場合は既定のコレクション）")
+        target = st.selectbox("📂 登録先のコレクション", collections + [NEW_COLLECTION_OPTION])
+        if target == NEW_COLLECTION_OPTION:
+            target = st.text_input("新しいコレクション名", placeholder="例: hr-policies",
+                                   help="英数字・アンダースコア・ハイフン（64文字まで）").strip()
+
         # システム状態表示
-        status = st.session_state.chatbot.get_system_status()
-        st.metric("📄 登録文書数", status["document_count"])
+        status = None
+        if ready:
+            status = get_chatbot().get_system_status()
+            st.metric("📄 登録文書数（検索対象）",
+                      get_chatbot().get_document_count(st.session_state.search_collections or None))
+        else:
+            st.metric("📄 登録文書数（検索対象）", "-")
+            st.caption("⏳ 文書とモデルを読み込み中です（質問はこのまま送信でき、準備ができ次第回答します）")
 
         # ファイルアップロード
         uploaded_files = st.file_uploader(
@@ -137,12 +239,22 @@ def main():
             help="複数のファイルを同時にアップロードできます"
         )
 
-        if uploaded_files:
+        if uploaded_files and target:
             if st.button("📤 文書を登録"):
-                with st.spinner("文書を処理中..."):
-                    result = st.session_state.chatbot.add_documents(uploaded_files)
-                    st.session_state.uploaded_files_status = result
-                    st.rerun()
+                progress_bar = st.progress(0.0, text="文書を処理中...")
+
+                def on_progress(stage, done, total):
+                    label = "文書を解析中" if stage == "parse" else "埋め込みを作成中"
+                    progress_bar.progress(min(done / total, 1.0) if total else 0.0,
+                                          text=f"{label}... ({done}/{total})")
+
+                try:
+                    result = get_chatbot().add_documents(uploaded_files, progress_callback=on_progress,
+                                                         collection=target)
+                except ValueError as e:
+                    result = str(e)
+                st.session_state.uploaded_files_status = result
+                st.rerun()
 
         # アップロード結果表示
         if st.session_state.uploaded_files_status:
@@ -156,20 +268,27 @@ def main():
         # 文書管理ボタン
         col1, col2 = st.columns(2)
         with col1:
-            if st.button("🗑️ 文書クリア"):
-                result = st.session_state.chatbot.clear_documents()
-                st.success(result)
+            if st.button("🗑️ 文書クリア", disabled=not target, help="登録先のコレクションの文書を全て削除します"):
+                try:
+                    st.success(get_chatbot().clear_documents(target))
+                except ValueError as e:
+                    st.error(str(e))
                 st.rerun()
 
         with col2:
             if st.button("💭 履歴クリア"):
                 st.session_state.chat_history = []
-                st.session_state.chatbot.clear_conversation_history()
+                get_chatbot().clear_conversation_history(st.session_state.memory)
                 st.success("チャット履歴をクリアしました")
                 st.rerun()
 
         st.divider()
 
+        if status is not None:
+            display_latency_panel(status["latency"])
+            display_smalltalk_panel(status["smalltalk"])
+            display_startup_panel(status["startup"])
+
         # 使用方法
         with st.expander("💡 使用方法"):
             st.markdown("""
@@ -226,21 +345,33 @@ def main():
         # ユーザーメッセージを履歴に追加
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        with st.spinner("回答を生成中..."):
-            # チャットボットの応答を取得
-            response = st.session_state.chatbot.process_query(user_input)
-
-            # チャット履歴に追加
-            chat_entry = {
-                "timestamp": timestamp,
-                "user_message": user_input,
-                "bot_response": response["answer"],
-                "mode": response["mode"],
-                "sources": response.get("sources", []),
-                "tools_used": response.get("tools_used", [])
-            }
-
-            st.session_state.chat_history.append(chat_entry)
+        # 送信したメッセージを表示し、回答は生成されたトークンから順に描画する
+        with chat_container:
+            display_chat_message(user_input, "user")
+            answer_placeholder = st.empty()
+
+        answer = ""
+        response = None
+        for event in get_chatbot().stream_query(user_input, st.session_state.memory,
+                                                st.session_state.search_collections or None):
+            if event["type"] == "token":
+                answer += event["content"]
+                with answer_placeholder.container():
+                    display_chat_message(answer + "▌", "bot")
+            else:
+                response = event
+
+        # チャット履歴に追加
+        chat_entry = {
+            "timestamp": timestamp,
+            "user_message": user_input,
+            "bot_response": response["answer"],
+            "mode": response["mode"],
+            "sources": response.get("sources", []),
+            "tools_used": response.get("tools_used", [])
+        }
+
+        st.session_state.chat_history.append(chat_entry)
 
         # ページを再読み込みして新しいメッセージを表示
         st.rerun()
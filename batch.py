@@ -0,0 +1,50 @@
+import sys
+import json
+import time
+import argparse
+from typing import List
+from chatbot import ChatBot
+import config
+
+def read_queries(path: str) -> List[str]:
+    """質問を読み込み（.jsonl は1行1件の {"query": ...}、それ以外は1行1問のテキスト）"""
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            queries.append(json.loads(line)["query"] if path.endswith(".jsonl") else line)
+    return queries
+
+def main():
+    """質問ファイルを一括処理し、結果をJSONLで出力"""
+    parser = argparse.ArgumentParser(description="質問を一括で処理し、結果をJSONLで出力します")
+    parser.add_argument("input", help="質問ファイル（1行1問のテキスト、または {\"query\": ...} のJSONL）")
+    parser.add_argument("-o", "--output", help="出力先のJSONLファイル（省略時は標準出力）")
+    parser.add_argument("-w", "--workers", type=int, default=config.BATCH_MAX_CONCURRENCY,
+                        help="回答生成の最大並行数")
+    parser.add_argument("-c", "--collection", action="append", dest="collections",
+                        help="検索するコレクション（複数指定すると横断して検索。省略時は既定のコレクション）")
+    args = parser.parse_args()
+
+    queries = read_queries(args.input)
+    chatbot = ChatBot()
+
+    started = time.perf_counter()
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        # 完了した順に1行ずつ書き出す（入力順は index で分かる）
+        for done, result in enumerate(chatbot.process_batch(queries, max_workers=args.workers,
+                                                                     collections=args.collections), 1):
+            output.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+            output.flush()
+            print(f"{done}/{len(queries)} 件完了", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"{len(queries)}件の質問を {time.perf_counter() - started:.1f}秒で処理しました", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
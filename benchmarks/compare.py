@@ -0,0 +1,51 @@
+import json
+import argparse
+from typing import Dict, Any
+
+# 比較する指標（値が小さいほど良いもの以外は名前で判別する）
+_HIGHER_IS_BETTER = ("per_second",)
+_SKIPPED = ("count", "chunks", "files", "bytes", "chunk_count", "target_chunks", "queries", "k", "dimension")
+
+
+def flatten(value: Any, prefix: str = "") -> Dict[str, float]:
+    """入れ子の計測結果を "search.k=5.p99_ms" のようなキーの数値に平らにする"""
+    items = {}
+    if isinstance(value, dict):
+        for key, child in value.items():
+            items.update(flatten(child, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        if prefix.split(".")[-1] not in _SKIPPED:
+            items[prefix] = float(value)
+    return items
+
+def load(path: str) -> Dict[int, Dict[str, float]]:
+    with open(path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    return {result["target_chunks"]: flatten(result) for result in report["results"]}
+
+def main():
+    """2つの計測結果（benchmarks.run の出力）を比較して表示"""
+    parser = argparse.ArgumentParser(description="2つのベンチマーク結果を比較します")
+    parser.add_argument("before", help="基準の結果JSON")
+    parser.add_argument("after", help="比較する結果JSON")
+    parser.add_argument("--threshold", type=float, default=0.0, help="この割合（例: 0.05）以上変化した指標だけ表示")
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+    for chunk_count in sorted(set(before) & set(after)):
+        print(f"## {chunk_count} チャンク")
+        print(f"{'指標':<60} {'before':>12} {'after':>12} {'変化':>9}")
+        for name in sorted(set(before[chunk_count]) & set(after[chunk_count])):
+            old, new = before[chunk_count][name], after[chunk_count][name]
+            if not old:
+                continue
+            change = (new - old) / old
+            if abs(change) < args.threshold:
+                continue
+            better = change > 0 if any(word in name for word in _HIGHER_IS_BETTER) else change < 0
+            mark = "" if change == 0 else ("改善" if better else "悪化")
+            print(f"{name:<60} {old:>12.4g} {new:>12.4g} {change:>+8.1%} {mark}")
+        print()
+
+if __name__ == "__main__":
+    main()
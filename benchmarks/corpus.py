@@ -0,0 +1,117 @@
+import os
+import csv
+import random
+from typing import List, Dict, Any
+import config
+
+# 合成文書に使う語彙（RAGの検索クエリもここから作る）
+_TOPICS = [
+    "働き方改革", "労働時間", "テレワーク", "人事評価", "育児休業", "健康経営", "研修制度", "福利厚生",
+    "情報セキュリティ", "個人情報", "経費精算", "出張規程", "安全衛生", "品質管理", "顧客対応", "在庫管理",
+]
+_PHRASES = [
+    "の基本方針を定める", "について定期的に見直す", "の運用状況を報告する", "に関する手続きを簡素化する",
+    "の対象者を拡大する", "の実施手順を明確にする", "に必要な予算を確保する", "の効果を測定する",
+]
+_ROMAN_TOPICS = [
+    "work style reform", "working hours", "remote work", "performance review", "parental leave",
+    "health management", "training program", "employee benefits", "information security", "expense report",
+]
+_ROMAN_PHRASES = [
+    "defines the basic policy", "is reviewed every quarter", "is reported to the board",
+    "simplifies the procedure", "expands the eligible staff", "clarifies the steps",
+]
+
+# 生成する形式ごとのチャンク数の割合
+FILE_TYPE_RATIOS = {"txt": 0.5, "csv": 0.3, "pdf": 0.2}
+# 1ファイルあたりのおおよそのチャンク数（大きなコーパスは複数ファイルに分ける）
+CHUNKS_PER_FILE = {"txt": 2000, "csv": 5000, "pdf": 200}
+
+
+def japanese_sentence(rng: random.Random) -> str:
+    return f"{rng.choice(_TOPICS)}{rng.choice(_PHRASES)}。"
+
+def roman_sentence(rng: random.Random) -> str:
+    return f"The {rng.choice(_ROMAN_TOPICS)} {rng.choice(_ROMAN_PHRASES)}."
+
+def sample_queries(count: int, seed: int = 0) -> List[str]:
+    """コーパスの語彙から検索クエリを作成（計算と判定される記号は含めない）"""
+    rng = random.Random(seed)
+    return [f"{rng.choice(_TOPICS)}{rng.choice(_PHRASES)}のは誰ですか" for _ in range(count)]
+
+def _text(rng: random.Random, length: int, sentence=japanese_sentence) -> str:
+    parts = []
+    size = 0
+    while size < length:
+        parts.append(sentence(rng))
+        size += len(parts[-1])
+    return "".join(parts)
+
+
+def write_txt(path: str, chunk_count: int, rng: random.Random) -> None:
+    # 分割はオーバーラップ分だけ前に戻るため、1チャンクあたりの新しい文字数は CHUNK_SIZE - CHUNK_OVERLAP
+    stride = config.CHUNK_SIZE - config.CHUNK_OVERLAP
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(chunk_count):
+            f.write(_text(rng, stride) + "\n")
+
+def write_csv(path: str, chunk_count: int, rng: random.Random) -> None:
+    # 1行をおよそ100文字にし、CHUNK_SIZE までまとめられる行数を1チャンクとみなす
+    rows_per_chunk = max(1, config.CHUNK_SIZE // 100) if not config.CSV_ONE_CHUNK_PER_ROW else 1
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "部署", "項目", "内容"])
+        for row in range(chunk_count * rows_per_chunk):
+            writer.writerow([row, rng.choice(_TOPICS), rng.choice(_TOPICS), _text(rng, 60)])
+
+def write_pdf(path: str, page_count: int, rng: random.Random) -> None:
+    """テキストを抽出できる最小限のPDFを書き出す（標準フォントのため本文は英語）"""
+    line_length = 90
+    lines_per_page = max(1, (config.CHUNK_SIZE - config.CHUNK_OVERLAP) // line_length)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for _ in range(page_count):
+        lines = []
+        for _ in range(lines_per_page):
+            line = _text(rng, line_length, roman_sentence)
+            lines.append("(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") Tj T*")
+        stream = ("BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(lines) + " ET").encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("latin-1")
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+_WRITERS = {"txt": write_txt, "csv": write_csv, "pdf": write_pdf}
+
+def generate_corpus(directory: str, chunk_count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """おおよそ chunk_count 個のチャンクになるTXT・CSV・PDFを生成し、ファイルの一覧を返す"""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    files = []
+    for file_type, ratio in FILE_TYPE_RATIOS.items():
+        remaining = max(1, int(chunk_count * ratio))
+        index = 0
+        while remaining > 0:
+            count = min(remaining, CHUNKS_PER_FILE[file_type])
+            path = os.path.join(directory, f"synthetic_{index:05d}.{file_type}")
+            _WRITERS[file_type](path, count, rng)
+            files.append({"path": path, "file_type": file_type, "bytes": os.path.getsize(path)})
+            remaining -= count
+            index += 1
+    return files
@@ -0,0 +1,113 @@
+import re
+import json
+import time
+import argparse
+from typing import List, Tuple
+from modules.agents.tools import LocalCalculator
+from modules.agents.router import QueryRouter, normalize_query, ROUTE_MATH, ROUTE_RAG, ROUTE_SMALLTALK
+from .run import latency_stats
+
+# ラベル付きの質問（日付・URL・型番・電話番号など、演算記号に見える文字を含む文書の質問を多めに入れる）
+LABELED_QUERIES: List[Tuple[str, str]] = [
+    ("2+3は？", ROUTE_MATH),
+    ("１２×３４は？", ROUTE_MATH),
+    ("100の15%は？", ROUTE_MATH),
+    ("320の15パーセントはいくら？", ROUTE_MATH),
+    ("√25", ROUTE_MATH),
+    ("2の10乗を計算して", ROUTE_MATH),
+    ("2の3乗", ROUTE_MATH),
+    ("5の-2乗は？", ROUTE_MATH),
+    ("10-3は？", ROUTE_MATH),
+    ("1000/8はいくつ？", ROUTE_MATH),
+    ("(3+4)*5", ROUTE_MATH),
+    ("3足す5は？", ROUTE_MATH),
+    ("sin(30°)を計算して", ROUTE_MATH),
+    ("売上1200万円の8%はいくら？", ROUTE_MATH),
+    ("2024-01-05の会議の議事録を教えて", ROUTE_RAG),
+    ("2024/4/1から施行される規程は？", ROUTE_RAG),
+    ("4/1の入社式の持ち物は？", ROUTE_RAG),
+    ("2023年度の研修制度について", ROUTE_RAG),
+    ("https://example.com/a-b に書かれている内容は？", ROUTE_RAG),
+    ("ABC-1234の仕様を教えて", ROUTE_RAG),
+    ("型番XR-200/Bの保証期間は？", ROUTE_RAG),
+    ("問い合わせ先は03-1234-5678ですか？", ROUTE_RAG),
+    ("育児休業の手続きは？", ROUTE_RAG),
+    ("経費精算の方法を教えてください", ROUTE_RAG),
+    ("テレワークの申請期限はいつですか", ROUTE_RAG),
+    ("就業規則第12条の内容", ROUTE_RAG),
+    ("情報セキュリティの基本方針とは", ROUTE_RAG),
+    ("remote work policy", ROUTE_RAG),
+    ("this hidden clause", ROUTE_RAG),
+    ("有給休暇は年に何日取れますか", ROUTE_RAG),
+    ("こんにちは", ROUTE_SMALLTALK),
+    ("おはようございます！", ROUTE_SMALLTALK),
+    ("ありがとう", ROUTE_SMALLTALK),
+    ("Hello", ROUTE_SMALLTALK),
+    ("thanks!", ROUTE_SMALLTALK),
+    ("よろしくお願いします", ROUTE_SMALLTALK),
+    ("こんにちは、出張規程について教えて", ROUTE_RAG),
+    ("こんにちは、有給は何日？", ROUTE_RAG),
+    ("お疲れ様です。交通費の上限は？", ROUTE_RAG),
+    ("Hi, what is the refund policy?", ROUTE_RAG),
+    ("元気な職場づくりの取り組みは？", ROUTE_RAG),
+    ("お疲れ様です！", ROUTE_SMALLTALK),
+]
+
+# 以前の is_math_query の判定（比較用）
+_LEGACY_PATTERNS = [
+    r'\d+\s*[+\-*/]\s*\d+',
+    r'\d+\s*の\s*\d+%',
+    r'\d+%',
+    r'計算|足し算|引き算|掛け算|割り算|％|パーセント|平方根|累乗|√',
+    r'[+\-*/=]',
+]
+
+
+def legacy_route(query: str) -> str:
+    return ROUTE_MATH if any(re.search(pattern, query) for pattern in _LEGACY_PATTERNS) else ROUTE_RAG
+
+def bench_latency(router: QueryRouter, queries: List[str], repeat: int):
+    """キャッシュなし（判定のみ）とキャッシュありの1件あたりのレイテンシ"""
+    uncached = []
+    for _ in range(repeat):
+        for query in queries:
+            started = time.perf_counter()
+            router.classify(normalize_query(query))
+            uncached.append(time.perf_counter() - started)
+    cached = []
+    for _ in range(repeat):
+        for query in queries:
+            started = time.perf_counter()
+            router.route(query)
+            cached.append(time.perf_counter() - started)
+    return {"classify": latency_stats(uncached), "route_cached": latency_stats(cached)}
+
+def main():
+    """ラベル付きの質問でルーティングの正解率とレイテンシを計測"""
+    parser = argparse.ArgumentParser(description="質問のルーティングの正解率とレイテンシを計測します")
+    parser.add_argument("--repeat", type=int, default=200, help="レイテンシの計測で全質問を繰り返す回数")
+    parser.add_argument("-o", "--output", help="結果のJSONファイル（省略時は標準出力）")
+    args = parser.parse_args()
+
+    router = QueryRouter(LocalCalculator())
+    # 以前の判定には雑談の経路がないため、計算かそれ以外かだけを比べる
+    legacy_errors = [{"query": query, "expected": expected, "actual": legacy_route(query)}
+                     for query, expected in LABELED_QUERIES
+                     if (legacy_route(query) == ROUTE_MATH) != (expected == ROUTE_MATH)]
+    report = {
+        "router": router.evaluate(LABELED_QUERIES),
+        "legacy": {
+            "accuracy": round(1 - len(legacy_errors) / len(LABELED_QUERIES), 4),
+            "errors": legacy_errors
+        },
+        "latency": bench_latency(router, [query for query, _ in LABELED_QUERIES], args.repeat)
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+if __name__ == "__main__":
+    main()
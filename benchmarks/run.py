@@ -0,0 +1,376 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+import numpy as np
+import config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 既定ではAPIを使わないプロバイダーで計測し、結果を実行ごとに比較できるようにする
+DEFAULT_OVERRIDES = {
+    "LLM_PROVIDER": "fake",
+    "EMBEDDING_PROVIDER": "hashing",
+    "FAKE_LLM_LATENCY_SECONDS": 0.0,
+    "FAKE_LLM_TOKENS_PER_SECOND": 0,
+}
+# 計測結果に記録する設定
+RECORDED_SETTINGS = [
+    "LLM_PROVIDER", "EMBEDDING_PROVIDER", "MODEL_NAME", "EMBEDDING_MODEL", "HASHING_EMBEDDING_DIMENSION",
+    "FAKE_LLM_LATENCY_SECONDS", "FAKE_LLM_TOKENS_PER_SECOND", "CHUNK_SIZE", "CHUNK_OVERLAP",
+    "INDEX_TYPE", "VECTOR_QUANTIZATION", "IVF_NPROBE", "HNSW_EF_SEARCH", "VECTOR_STORE_LOAD_MODE",
+    "EMBEDDING_BATCH_SIZE", "TOP_K_DOCUMENTS", "HYBRID_SEARCH_ENABLED", "LEXICAL_NGRAM_SIZE",
+    "CONTEXT_CANDIDATE_K", "CONTEXT_RERANKER", "MEMORY_MAX_TOKENS", "STARTUP_BACKGROUND_WARMUP",
+]
+
+
+def apply_overrides(overrides: Dict[str, Any]) -> None:
+    """設定を上書き（既定値はimport時に引数へ束縛されるため、modules をimportする前に呼ぶ）"""
+    for name, value in overrides.items():
+        setattr(config, name, value)
+
+def rss_bytes() -> Dict[str, Optional[int]]:
+    """現在と最大の常駐メモリ（取得できない環境ではNone）"""
+    current = None
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = None
+    if resource is not None:
+        # Linuxはキロバイト、macOSはバイト単位
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    return {"rss_bytes": current, "peak_rss_bytes": peak}
+
+def latency_stats(samples: List[float]) -> Dict[str, float]:
+    """レイテンシ（秒）の一覧からミリ秒単位の統計を計算"""
+    values = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p90_ms": round(float(np.percentile(values, 90)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def log(message: str) -> None:
+    print(message, file=sys.stderr, flush=True)
+
+
+def bench_parse(files: List[Dict[str, Any]]):
+    """DocumentProcessor による解析・分割のスループット"""
+    from modules.rag.document_processor import DocumentProcessor
+    processor = DocumentProcessor()
+    documents = []
+    by_type = {}
+    for file in files:
+        started = time.perf_counter()
+        chunks = processor.process_file(file["path"], file["file_type"])
+        elapsed = time.perf_counter() - started
+        stats = by_type.setdefault(file["file_type"], {"files": 0, "bytes": 0, "chunks": 0, "seconds": 0.0})
+        stats["files"] += 1
+        stats["bytes"] += file["bytes"]
+        stats["chunks"] += len(chunks)
+        stats["seconds"] += elapsed
+        documents.extend(chunks)
+
+    for stats in by_type.values():
+        stats["mb_per_second"] = round(stats["bytes"] / 2 ** 20 / stats["seconds"], 3) if stats["seconds"] else None
+        stats["chunks_per_second"] = round(stats["chunks"] / stats["seconds"], 1) if stats["seconds"] else None
+    seconds = sum(stats["seconds"] for stats in by_type.values())
+    result = {
+        "seconds": round(seconds, 3),
+        "chunks": len(documents),
+        "chunks_per_second": round(len(documents) / seconds, 1) if seconds else None,
+        "by_file_type": by_type,
+    }
+    return result, documents
+
+def bench_embed_and_build(vector_store, documents) -> Dict[str, Any]:
+    """埋め込み（キャッシュなし）とインデックス構築の時間"""
+    vector_store.clear_vector_store()
+    vector_store.embedding_cache.clear()
+    batch_size = config.EMBEDDING_BATCH_SIZE
+
+    embed_seconds = 0.0
+    build_seconds = 0.0
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        started = time.perf_counter()
+        ids, vectors = vector_store.embed_documents(batch)
+        embedded = time.perf_counter()
+        vector_store.add_embedded_documents(ids, vectors, batch)
+        embed_seconds += embedded - started
+        build_seconds += time.perf_counter() - embedded
+
+    # バックグラウンドのコンパクションも構築時間に含める
+    started = time.perf_counter()
+    vector_store.segment_store.wait_for_compaction()
+    compaction_seconds = time.perf_counter() - started
+
+    return {
+        "embed": {
+            "seconds": round(embed_seconds, 3),
+            "chunks_per_second": round(len(documents) / embed_seconds, 1) if embed_seconds else None,
+        },
+        "index_build": {
+            "seconds": round(build_seconds + compaction_seconds, 3),
+            "compaction_wait_seconds": round(compaction_seconds, 3),
+            "index_type": vector_store.get_index_type(),
+            "chunk_count": vector_store.get_document_count(),
+            "memory": vector_store.get_memory_report(),
+        },
+    }
+
+def bench_search(vector_store, queries: List[str], k_values: List[int]) -> Dict[str, Any]:
+    """埋め込み済みのクエリでの検索レイテンシ（k ごと）"""
+    vectors = vector_store.embed_queries(queries)
+    results = {}
+    for k in k_values:
+        # 最初の1回はキャッシュやページの読み込みを含むため計測しない
+        vector_store.similarity_search_by_vector_with_score(vectors[0], k=k)
+        samples = []
+        for vector in vectors:
+            started = time.perf_counter()
+            vector_store.similarity_search_by_vector_with_score(vector, k=k)
+            samples.append(time.perf_counter() - started)
+        results[f"k={k}"] = latency_stats(samples)
+
+    # 語彙検索（埋め込みなし）とハイブリッド検索（埋め込み済みのベクトルを使用）
+    if vector_store.lexical_index is not None:
+        for name, search in (("lexical", lambda query, vector, k: vector_store.lexical_search_with_score(query, k)),
+                             ("hybrid", vector_store.hybrid_search_with_score)):
+            k = config.TOP_K_DOCUMENTS
+            samples = []
+            for query, vector in zip(queries, vectors):
+                started = time.perf_counter()
+                search(query, vector, k)
+                samples.append(time.perf_counter() - started)
+            results[f"{name}_k={k}"] = latency_stats(samples)
+
+    started = time.perf_counter()
+    vector_store.similarity_search_by_vectors_with_score(vectors, k=max(k_values))
+    elapsed = time.perf_counter() - started
+    results["batch"] = {"queries": len(vectors), "k": max(k_values), "seconds": round(elapsed, 4),
+                        "queries_per_second": round(len(vectors) / elapsed, 1) if elapsed else None}
+    return results
+
+def bench_cold_start(mode: str, overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """別プロセスで起動し、import とベクトルストア読み込みの時間・メモリを計測"""
+    command = [sys.executable, "-m", "benchmarks.run", "--probe-load", mode,
+               "--overrides", json.dumps(overrides)]
+    completed = subprocess.run(command, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1:] or ["unknown"]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def probe_load(mode: str) -> Dict[str, Any]:
+    """--probe-load で起動された子プロセス側の計測"""
+    started = time.perf_counter()
+    from modules.rag.vector_store import VectorStore
+    imported = time.perf_counter()
+    vector_store = VectorStore()
+    vector_store.load_vector_store(mode=mode)
+    loaded = time.perf_counter()
+    return {
+        "mode": mode,
+        "import_seconds": round(imported - started, 3),
+        "load_seconds": round(loaded - imported, 3),
+        "chunk_count": vector_store.get_document_count(),
+        **rss_bytes(),
+    }
+
+def bench_startup(overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """別プロセスで起動し、画面を表示できるまでと全サブシステムの準備が終わるまでの時間を計測"""
+    command = [sys.executable, "-m", "benchmarks.run", "--probe-startup", "--overrides", json.dumps(overrides)]
+    completed = subprocess.run(command, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1:] or ["unknown"]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def probe_startup() -> Dict[str, Any]:
+    """--probe-startup で起動された子プロセス側の計測（app.py と同じ手順で共有のChatBotを読み込む）"""
+    started = time.perf_counter()
+    from modules.core.shared import get_shared_chatbot, start_shared_chatbot
+    from modules.core.startup import startup_profile
+    start_shared_chatbot()
+    # app.py はここで画面を表示し、読み込みの完了は待たない
+    rendered = time.perf_counter()
+    chatbot = get_shared_chatbot()
+    created = time.perf_counter()
+    chatbot.rag_retriever
+    chatbot.agent_manager.agent
+    ready = time.perf_counter()
+    return {
+        "first_render_seconds": round(rendered - started, 3),
+        "chatbot_seconds": round(created - started, 3),
+        "ready_seconds": round(ready - started, 3),
+        "profile": startup_profile.get_report(),
+        **rss_bytes(),
+    }
+
+def bench_end_to_end(queries: List[str], query_count: int) -> Dict[str, Any]:
+    """ChatBot.process_query のモード別のレイテンシ"""
+    from chatbot import ChatBot
+    started = time.perf_counter()
+    chatbot = ChatBot()
+    # サブシステムはバックグラウンドで読み込まれるため、計測前に準備が終わるのを待つ
+    chatbot.rag_retriever
+    chatbot.agent_manager.agent
+    startup_seconds = time.perf_counter() - started
+
+    cases = {
+        "rag": queries[:query_count],
+        "calculator": [f"{i + 2}の{(i % 9) + 1}0%は？" for i in range(query_count)],
+        # ローカルでは計算できず、エージェントに任される質問
+        "agent": [f"売上が{i + 100}万円のときの前年比を計算して説明して" for i in range(query_count)],
+        # 定型文で答える挨拶と、チャットモデルを1回だけ呼ぶ雑談
+        "smalltalk": [("こんにちは", "おはようございます！", "今日も元気ですか")[i % 3] for i in range(query_count)],
+    }
+    results = {"startup_seconds": round(startup_seconds, 3)}
+    for mode, mode_queries in cases.items():
+        samples = []
+        observed_modes = {}
+        for query in mode_queries:
+            memory = chatbot.create_memory()
+            started = time.perf_counter()
+            response = chatbot.process_query(query, memory)
+            samples.append(time.perf_counter() - started)
+            observed_modes[response.get("mode")] = observed_modes.get(response.get("mode"), 0) + 1
+        results[mode] = {**latency_stats(samples), "observed_modes": observed_modes}
+    return results
+
+
+def run_size(chunk_count: int, work_dir: str, args, overrides: Dict[str, Any]) -> Dict[str, Any]:
+    from benchmarks.corpus import generate_corpus, sample_queries
+    from modules.rag.vector_store import VectorStore
+
+    log(f"[{chunk_count}] コーパスを生成中...")
+    corpus_dir = os.path.join(work_dir, "corpus")
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    started = time.perf_counter()
+    files = generate_corpus(corpus_dir, chunk_count, seed=args.seed)
+    result = {
+        "target_chunks": chunk_count,
+        "corpus": {"files": len(files), "bytes": sum(f["bytes"] for f in files),
+                   "generate_seconds": round(time.perf_counter() - started, 3)},
+    }
+
+    log(f"[{chunk_count}] 解析中...")
+    result["parse"], documents = bench_parse(files)
+
+    log(f"[{chunk_count}] 埋め込み・インデックス構築中...")
+    vector_store = VectorStore()
+    result.update(bench_embed_and_build(vector_store, documents))
+    del documents
+
+    log(f"[{chunk_count}] 検索中...")
+    queries = sample_queries(args.queries, seed=args.seed)
+    result["search"] = bench_search(vector_store, queries, args.k)
+    result["memory_after_build"] = rss_bytes()
+    del vector_store
+
+    log(f"[{chunk_count}] 起動時間を計測中...")
+    result["cold_start"] = {mode: bench_cold_start(mode, overrides) for mode in args.load_modes}
+    result["startup"] = bench_startup(overrides)
+
+    if not args.skip_end_to_end:
+        log(f"[{chunk_count}] エンドツーエンドを計測中...")
+        result["end_to_end"] = bench_end_to_end(queries, args.end_to_end_queries)
+
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    return result
+
+
+def main():
+    """合成コーパスで取り込み・検索・問い合わせを計測し、結果をJSONで出力"""
+    parser = argparse.ArgumentParser(description="合成コーパスで性能を計測し、結果をJSONで出力します")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000],
+                        help="コーパスのチャンク数（複数指定で順に計測）")
+    parser.add_argument("-k", "--k", type=int, nargs="+", default=[1, 5, 20], help="検索で取得する件数")
+    parser.add_argument("--queries", type=int, default=200, help="検索の計測に使うクエリ数")
+    parser.add_argument("--end-to-end-queries", type=int, default=20, help="モードごとの問い合わせ数")
+    parser.add_argument("--skip-end-to-end", action="store_true", help="問い合わせの計測を省略")
+    parser.add_argument("--load-modes", nargs="+", default=["memory", "mmap"], help="起動時間を計測する読み込みモード")
+    parser.add_argument("--use-configured-providers", action="store_true",
+                        help="ダミーではなく config.py のプロバイダー（OpenAIなど）で計測")
+    parser.add_argument("--set", nargs="*", default=[], metavar="NAME=VALUE",
+                        help="config の値を上書き（値はJSONとして解釈、例: INDEX_TYPE='\"hnsw\"'）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default="./data/benchmark", help="コーパスとベクトルストアの作業ディレクトリ")
+    parser.add_argument("-o", "--output", help="結果のJSONファイル（省略時は作業ディレクトリに自動命名）")
+    parser.add_argument("--probe-startup", action="store_true",
+                        help="現在の設定で起動し、importと初期化の時間の内訳をJSONで表示")
+    parser.add_argument("--probe-load", help=argparse.SUPPRESS)
+    parser.add_argument("--overrides", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe_startup:
+        apply_overrides(json.loads(args.overrides) if args.overrides else {})
+        print(json.dumps(probe_startup(), ensure_ascii=False))
+        return
+
+    if args.probe_load:
+        apply_overrides(json.loads(args.overrides))
+        print(json.dumps(probe_load(args.probe_load)))
+        return
+
+    work_dir = os.path.abspath(args.work_dir)
+    overrides = {} if args.use_configured_providers else dict(DEFAULT_OVERRIDES)
+    for item in args.set:
+        name, value = item.split("=", 1)
+        overrides[name] = json.loads(value)
+    # 作業用のベクトルストアと埋め込みキャッシュを使い、本番のデータには触れない
+    overrides["VECTOR_STORE_PATH"] = os.path.join(work_dir, "vector_store")
+    overrides["COLLECTIONS_DIR"] = os.path.join(work_dir, "collections")
+    overrides["EMBEDDING_CACHE_PATH"] = os.path.join(work_dir, "embedding_cache.sqlite3")
+    overrides["MEMORY_STORE_PATH"] = os.path.join(work_dir, "conversations.sqlite3")
+    apply_overrides(overrides)
+    shutil.rmtree(overrides["VECTOR_STORE_PATH"], ignore_errors=True)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {name: getattr(config, name, None) for name in RECORDED_SETTINGS},
+        "results": [],
+    }
+    output = args.output or os.path.join(
+        work_dir, f"benchmark_{report['git_commit'] or 'unknown'}_{datetime.now():%Y%m%d_%H%M%S}.json")
+
+    for chunk_count in args.chunks:
+        report["results"].append(run_size(chunk_count, work_dir, args, overrides))
+        # 途中で中断しても計測済みのサイズは残るよう、サイズごとに書き出す
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+    log(f"計測結果を {output} に保存しました")
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,368 @@
-from typing import Dict, Any
-from modules.rag.retriever import RAGRetriever
-from modules.agents.agent import AgentManager
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, Iterator, Optional, List
+from modules.agents.memory import ConversationMemory
+from modules.agents.router import ROUTE_MATH, ROUTE_RAG, ROUTE_SMALLTALK
+from modules.providers.registry import create_chat_model
+from modules.core.tracing import tracer
+from modules.core.startup import LazySubsystem, timed_import, startup_profile
 import config
 
 class ChatBot:
-    def __init__(self):
-        self.rag_retriever = RAGRetriever()
-        self.agent_manager = AgentManager()
+    """RAGとエージェントを束ねる（スレッドセーフで、modules.core.shared から全セッションで共有される）
 
+    会話履歴はセッションごとに create_memory(session_id) で取得し、各メソッドの memory に渡す。
+    省略した場合はエージェントの既定の会話履歴を使う。
+    LLMクライアント・RAG・エージェントは最初に使うときに作成する。warmup がTrueの場合は
+    作成時にバックグラウンドのスレッドで読み込みを始め、使う時点で終わっていなければ完了を待つ。
+    """
+
+    def __init__(self, warmup: bool = config.STARTUP_BACKGROUND_WARMUP):
+        self.warmup = warmup
+        # RAGとエージェントは同じ設定のLLMクライアントを共有する（プロバイダーは config.LLM_PROVIDER）
+        self._llm = LazySubsystem("llm", create_chat_model)
+        self._rag_retriever = LazySubsystem("rag_retriever", self._create_rag_retriever)
+        self._agent_manager = LazySubsystem("agent_manager", self._create_agent_manager)
+        if warmup:
+            for subsystem in (self._llm, self._rag_retriever, self._agent_manager):
+                subsystem.start_warmup()
+
+    def _create_rag_retriever(self):
+        rag_retriever = timed_import("modules.rag.retriever").RAGRetriever(self._llm.get())
         # 既存の文書を読み込み
-        self.rag_retriever.load_existing_documents()
+        with startup_profile.measure("init", "load_existing_documents"):
+            rag_retriever.load_existing_documents()
+        return rag_retriever
+
+    def _create_agent_manager(self):
+        agent_manager = timed_import("modules.agents.agent").AgentManager(self._llm.get())
+        if self.warmup:
+            agent_manager.warm_up()
+        return agent_manager
+
+    @property
+    def rag_retriever(self):
+        return self._rag_retriever.get()
+
+    @property
+    def agent_manager(self):
+        return self._agent_manager.get()
+
+    def is_ready(self) -> bool:
+        """RAGとエージェントの準備が終わっているか（終わっていなければ問い合わせは完了を待つ）"""
+        return self._rag_retriever.is_ready() and self._agent_manager.is_ready()
+
+    def create_memory(self, session_id: Optional[str] = None) -> ConversationMemory:
+        """セッションの会話履歴を取得（session_id がなければ保存しない一時的な会話履歴を作成）"""
+        return self.agent_manager.create_memory(session_id)
 
-    def process_query(self, query: str) -> Dict[str, Any]:
+    def process_query(self, query: str, memory: Optional[ConversationMemory] = None,
+                      route: Optional[str] = None, collections: Optional[List[str]] = None) -> Dict[str, Any]:
         """
-        クエリを処理し、適切なモード（RAGまたはAgents）を自動選択
+        クエリを処理し、適切なモード（RAG・Agents・雑談）を自動選択（route を渡すと判定を省略）
+
+        collections で検索するコレクションを指定できる（省略時は既定のコレクション、複数なら横断して検索）。
         """
+        with tracer.span("chatbot.process_query", query_length=len(query)) as span:
+            response = self._process_query(query, memory, route, collections)
+            span.set_attribute("mode", response["mode"])
+            return response
+
+    def _process_query(self, query: str, memory: Optional[ConversationMemory],
+                       route: Optional[str] = None, collections: Optional[List[str]] = None) -> Dict[str, Any]:
         # 空のクエリチェック
         if not query.strip():
-            return {
-                "answer": "質問を入力してください。",
-                "mode": "none",
-                "sources": [],
-                "tools_used": []
-            }
+            return self._empty_query_response()
+
+        route = route or self._route(query)
+        # 挨拶・雑談は検索もエージェントも使わずに答える
+        if route == ROUTE_SMALLTALK:
+            return self._smalltalk_response(self.agent_manager.answer_smalltalk(query, memory))
 
         # エージェント処理が必要かチェック（計算など）
-        if self.agent_manager.is_agent_query(query):
-            result = self.agent_manager.process_query(query)
-            return {
-                "answer": result["answer"],
-                "mode": "agents",
-                "sources": [],
-                "tools_used": result.get("tools_used", [])
-            }
+        if route == ROUTE_MATH:
+            # 単純な計算式はローカルで計算し、解釈できない場合だけエージェントに任せる
+            result = (self.agent_manager.calculate_locally(query, memory)
+                      or self.agent_manager.process_query(query, memory))
+            return self._agent_response(result)
 
         # RAG処理を試行
-        rag_result = self.rag_retriever.retrieve_and_generate(query)
+        rag_result = self.rag_retriever.retrieve_and_generate(query, collections)
 
         # RAGで回答が見つからない場合は、一般的な対話として処理
-        if not rag_result.get("is_rag_response") or "資料に該当箇所が見当たりません" in rag_result["answer"]:
-            # 文書がない場合は、エージェントで一般的な質問として処理
-            if self.rag_retriever.get_document_count() == 0:
-                general_result = self.agent_manager.process_query(query)
-                return {
-                    "answer": general_result["answer"],
-                    "mode": "agents",
+        if self._needs_agent_fallback(rag_result, collections):
+            return self._agent_response(self.agent_manager.process_query(query, memory))
+
+        return self._rag_response(rag_result)
+
+    async def aprocess_query(self, query: str, memory: Optional[ConversationMemory] = None,
+                             collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        """process_query の非同期版
+
+        エージェントへのフォールバックがあり得る場合、RAGが SPECULATIVE_AGENT_DELAY_SECONDS 秒以内に
+        終わらなければエージェントを並行して投機的に開始し、使わなかった方はキャンセルする。
+        フォールバック時の待ち時間は両者の合計ではなく、遅い方の処理時間に近くなる。
+        """
+        with tracer.span("chatbot.aprocess_query", query_length=len(query)) as span:
+            response = await self._aprocess_query(query, memory, collections)
+            span.set_attribute("mode", response["mode"])
+            return response
+
+    async def _aprocess_query(self, query: str, memory: Optional[ConversationMemory],
+                              collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        if not query.strip():
+            return self._empty_query_response()
+
+        # 読み込み中のサブシステムの完了待ちでイベントループを止めないよう、スレッドで取得する
+        agent_manager = await self._agent_manager.aget()
+        route = self._route(query)
+        if route == ROUTE_SMALLTALK:
+            return self._smalltalk_response(await agent_manager.aanswer_smalltalk(query, memory))
+
+        if route == ROUTE_MATH:
+            # ローカルの計算もCPU処理のため、他の問い合わせを待たせないようスレッドで行う
+            result = (await asyncio.to_thread(agent_manager.calculate_locally, query, memory)
+                      or await agent_manager.aprocess_query(query, memory=memory))
+            return self._agent_response(result)
+
+        rag_retriever = await self._rag_retriever.aget()
+        rag_task = asyncio.ensure_future(rag_retriever.aretrieve_and_generate(query, collections))
+        agent_task = None
+        try:
+            delay = config.SPECULATIVE_AGENT_DELAY_SECONDS
+            if delay is not None and await asyncio.to_thread(self._may_fall_back_to_agent, collections):
+                done, _ = await asyncio.wait({rag_task}, timeout=delay)
+                if not done:
+                    agent_task = asyncio.ensure_future(agent_manager.aprocess_query(query, remember=False, memory=memory))
+
+            rag_result = await rag_task
+            if not await asyncio.to_thread(self._needs_agent_fallback, rag_result, collections):
+                return self._rag_response(rag_result)
+
+            if agent_task is None:
+                agent_task = asyncio.ensure_future(agent_manager.aprocess_query(query, remember=False, memory=memory))
+            result = await agent_task
+            # 会話履歴の保存はSQLiteへの書き込みを伴うため、スレッドで行う
+            await asyncio.to_thread(agent_manager.remember, query, result["answer"], memory)
+            return self._agent_response(result)
+        finally:
+            for task in (rag_task, agent_task):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def process_batch(self, queries: List[str], max_workers: int = config.BATCH_MAX_CONCURRENCY,
+                      collections: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """複数の質問をまとめて処理し、完了した順に結果を返す
+
+        RAGに回す質問の埋め込みと検索は1回ずつまとめて行い、回答生成だけを
+        最大 max_workers 件並行して実行する。各結果には入力順の index と処理時間（秒）を含む。
+        会話履歴は質問ごとに独立させ、既定の会話履歴には残さない。
+        """
+        batch_start = time.perf_counter()
+        routes = {index: self._route(query) for index, query in enumerate(queries) if query.strip()}
+        rag_indices = [index for index, route in routes.items() if route == ROUTE_RAG]
+        prepared = {}
+        if rag_indices:
+            batch = self.rag_retriever.prepare_batch([queries[index] for index in rag_indices], collections)
+            prepared = dict(zip(rag_indices, batch))
+        retrieval_seconds = time.perf_counter() - batch_start
+
+        def run(index: int):
+            started = time.perf_counter()
+            query = queries[index]
+            try:
+                if index in prepared:
+                    rag_result = self.rag_retriever.generate_from_prepared(query, prepared[index])
+                    if self._needs_agent_fallback(rag_result, collections):
+                        response = self._agent_response(self.agent_manager.process_query(query, self.create_memory()))
+                    else:
+                        response = self._rag_response(rag_result)
+                else:
+                    response = self.process_query(query, self.create_memory(), routes.get(index), collections)
+            except Exception as e:
+                response = {
+                    "answer": f"処理中にエラーが発生しました: {str(e)}",
+                    "mode": "none",
                     "sources": [],
-                    "tools_used": general_result.get("tools_used", [])
-                }
-            else:
-                return {
-                    "answer": rag_result["answer"],
-                    "mode": "rag",
-                    "sources": rag_result.get("sources", []),
                     "tools_used": []
                 }
+            return response, time.perf_counter() - started
 
-        # RAGで適切な回答が見つかった場合
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run, index): index for index in range(len(queries))}
+            for future in as_completed(futures):
+                index = futures[future]
+                response, generation_seconds = future.result()
+                yield {
+                    "index": index,
+                    "query": queries[index],
+                    **response,
+                    "timing": {
+                        # 埋め込みと検索はバッチ全体で1回のため、RAGに回した全ての質問で同じ値になる
+                        "retrieval_seconds": round(retrieval_seconds, 4) if index in prepared else 0.0,
+                        "generation_seconds": round(generation_seconds, 4),
+                        "elapsed_seconds": round(time.perf_counter() - batch_start, 4)
+                    }
+                }
+
+    def _route(self, query: str) -> str:
+        """クエリの処理経路を判定（判定時間をspanとして記録）"""
+        with tracer.span("route.classify") as span:
+            route = self.agent_manager.route(query)
+            span.set_attribute("route", route)
+            return route
+
+    def _may_fall_back_to_agent(self, collections: Optional[List[str]] = None) -> bool:
+        """RAGの結果によってはエージェントに処理を回す可能性があるか"""
+        return config.AGENT_FALLBACK_WHEN_NOT_FOUND or self.get_document_count(collections) == 0
+
+    def _needs_agent_fallback(self, rag_result: Dict[str, Any], collections: Optional[List[str]] = None) -> bool:
+        """RAGで回答が見つからず、エージェントで一般的な質問として処理すべきか"""
+        if rag_result.get("is_rag_response") and "資料に該当箇所が見当たりません" not in rag_result["answer"]:
+            return False
+        # 文書がない場合（または設定で許可された場合）だけエージェントに回す
+        if not self._may_fall_back_to_agent(collections):
+            return False
+        self.agent_manager.router.record_fallback()
+        return True
+
+    @staticmethod
+    def _empty_query_response() -> Dict[str, Any]:
+        return {
+            "answer": "質問を入力してください。",
+            "mode": "none",
+            "sources": [],
+            "tools_used": []
+        }
+
+    @staticmethod
+    def _agent_response(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "answer": result["answer"],
+            "mode": "agents",
+            "sources": [],
+            "tools_used": result.get("tools_used", [])
+        }
+
+    @staticmethod
+    def _smalltalk_response(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "answer": result["answer"],
+            "mode": "smalltalk",
+            "sources": [],
+            "tools_used": []
+        }
+
+    @staticmethod
+    def _rag_response(rag_result: Dict[str, Any]) -> Dict[str, Any]:
         return {
             "answer": rag_result["answer"],
             "mode": "rag",
             "sources": rag_result.get("sources", []),
-            "tools_used": []
+            "tools_used": [],
+            "cached": rag_result.get("cached", False)
         }
 
-    def add_documents(self, uploaded_files) -> str:
-        """文書をRAGシステムに追加"""
-        return self.rag_retriever.add_documents(uploaded_files)
+    def stream_query(self, query: str, memory: Optional[ConversationMemory] = None,
+                     collections: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """process_query のストリーミング版
+
+        RAGの回答は生成されたトークンを {"type": "token", "content": ...} として順次返し、
+        最後に process_query と同じ内容の {"type": "end", ...} を返す。
+        エージェントの回答はストリーミングできないため、完成後に1つのトークンとして返す。
+        """
+        # yield の間は呼び出し元のコンテキストに戻るため、spanは親を明示して開始・終了する
+        span = tracer.start_span("chatbot.stream_query", query_length=len(query))
+        try:
+            with tracer.activate(span):
+                result = None
+                route = self._route(query) if query.strip() else None
+                if route != ROUTE_RAG or self.get_document_count(collections) == 0:
+                    result = self._process_query(query, memory, route, collections)
+            if result is not None:
+                span.set_attribute("mode", result["mode"])
+                yield {"type": "token", "content": result["answer"]}
+                yield {"type": "end", **result}
+                return
+
+            for event in self.rag_retriever.stream_retrieve_and_generate(query, span, collections):
+                if event["type"] == "token":
+                    yield event
+                    continue
+                if self._needs_agent_fallback(event, collections):
+                    with tracer.activate(span):
+                        response = self._agent_response(self.agent_manager.process_query(query, memory))
+                else:
+                    response = self._rag_response(event)
+                span.set_attribute("mode", response["mode"])
+                yield {"type": "end", **response}
+        finally:
+            span.end()
+
+    def add_documents(self, uploaded_files, progress_callback=None, collection: Optional[str] = None) -> str:
+        """文書をRAGシステムのコレクション（省略時は既定のコレクション）に追加"""
+        return self.rag_retriever.add_documents(uploaded_files, progress_callback, collection)
 
-    def clear_documents(self) -> str:
-        """全ての文書をクリア"""
-        return self.rag_retriever.clear_documents()
+    def clear_documents(self, collection: Optional[str] = None) -> str:
+        """コレクション（省略時は既定のコレクション）の全ての文書をクリア"""
+        return self.rag_retriever.clear_documents(collection)
 
-    def get_document_count(self) -> int:
-        """保存されている文書数を取得"""
-        return self.rag_retriever.get_document_count()
+    def list_collections(self) -> List[str]:
+        """既存のコレクション名の一覧（既定のコレクションが先頭）"""
+        return self.rag_retriever.collections.names()
 
-    def clear_conversation_history(self):
+    def delete_collection(self, collection: str) -> str:
+        """コレクションを削除"""
+        return self.rag_retriever.delete_collection(collection)
+
+    def refresh_documents(self) -> bool:
+        """他のプロセスが追加・削除した文書を反映（変更がなければ何もしない）"""
+        return self.rag_retriever.collections.refresh_loaded()
+
+    def get_document_count(self, collections: Optional[List[str]] = None) -> int:
+        """保存されている文書数を取得（collections を省略すると既定のコレクション）"""
+        return self.rag_retriever.get_document_count(collections)
+
+    def clear_conversation_history(self, memory: Optional[ConversationMemory] = None):
         """会話履歴をクリア"""
-        self.agent_manager.clear_memory()
+        self.agent_manager.clear_memory(memory)
 
     def get_system_status(self) -> Dict[str, Any]:
         """システムの状態を取得"""
+        latency = tracer.get_stage_summary()
         return {
             "document_count": self.get_document_count(),
             "rag_available": self.rag_retriever.vector_store.vector_store is not None,
-            "agents_available": len(self.agent_manager.tools) > 0
-        }
\ No newline at end of file
+            "collections": self.rag_retriever.collections.get_stats(),
+            "agents_available": len(self.agent_manager.tool_manager.get_tools()) > 0,
+            "index_type": self.rag_retriever.vector_store.get_index_type(),
+            "memory_report": self.rag_retriever.vector_store.get_memory_report(),
+            "embedding_cache": self.rag_retriever.vector_store.get_embedding_cache_stats(),
+            "answer_cache": self.rag_retriever.answer_cache.get_stats(),
+            "lexical_index": (self.rag_retriever.vector_store.lexical_index.get_stats()
+                              if self.rag_retriever.vector_store.lexical_index is not None else None),
+            "conversations": self.agent_manager.memory_store.get_stats(),
+            "router": self.agent_manager.router.get_stats(),
+            "smalltalk": self._get_smalltalk_stats(latency),
+            "latency": latency,
+            "startup": startup_profile.get_report()
+        }
+
+    def _get_smalltalk_stats(self, latency: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """雑談として直接答えた質問の割合と、検索（文書がなければエージェントも）を省いたことで短縮した時間の概算"""
+        stats = self.agent_manager.smalltalk.get_stats()
+        routes = self.agent_manager.router.get_stats()["routes"]
+        total = sum(routes.values())
+        count = stats["template_answers"] + stats["llm_answers"]
+        stats["share"] = round(routes.get(ROUTE_SMALLTALK, 0) / total, 4) if total else 0.0
+
+        # 以前の経路の平均時間は、同じ期間に計測したRAG・エージェントの処理時間で見積もる
+        stages = ["rag.retrieve_and_generate"] + (["agent.process_query"] if self.get_document_count() == 0 else [])
+        if count and stats["mean_ms"] is not None and all(stage in latency for stage in stages):
+            baseline_ms = sum(latency[stage]["mean_ms"] for stage in stages)
+            stats["saved_ms_per_query"] = round(max(baseline_ms - stats["mean_ms"], 0.0), 3)
+            stats["saved_seconds"] = round(stats["saved_ms_per_query"] * count / 1000, 3)
+        else:
+            stats["saved_ms_per_query"] = stats["saved_seconds"] = None
+        return stats
\ No newline at end of file
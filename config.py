@@ -7,14 +7,153 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL_NAME = "gpt-3.5-turbo"
 TEMPERATURE = 0.7
+EMBEDDING_MODEL = "text-embedding-ada-002"
 
 # RAG設定
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 TOP_K_DOCUMENTS = 3
+CSV_ONE_CHUNK_PER_ROW = False  # Trueで1行1チャンク。Falseでは複数行をCHUNK_SIZEまでまとめる
+CSV_READ_CHUNK_ROWS = 50000    # CSVを分割して読み込む行数
 
 # ベクトルDB設定
 VECTOR_STORE_PATH = "./data/vector_store"
+SEGMENT_COMPACTION_THRESHOLD = 8  # セグメント数がこの値以上になるとバックグラウンドで統合
+VECTOR_STORE_LOAD_MODE = "memory"  # "memory": 全体をRAMに読み込む / "mmap": メモリマップで読み込む
+MMAP_SEARCH_BLOCK_ROWS = 65536     # mmapモードの検索で一度に走査する行数
+
+# コレクション設定（テナント・部署ごとに分けたベクトルインデックス）
+DEFAULT_COLLECTION = "default"         # コレクションを指定しない場合に使う（保存先は VECTOR_STORE_PATH）
+COLLECTIONS_DIR = "./data/collections"  # その他のコレクションの保存先（COLLECTIONS_DIR/<名前>）
+COLLECTION_MAX_LOADED = 8              # メモリに読み込んでおくコレクション数（超えると最も使われていないものから解放）
+COLLECTION_MEMORY_BUDGET_BYTES = None  # 読み込み済みのコレクションの常駐メモリの概算の上限（Noneで無制限）
+COLLECTION_SEARCH_WORKERS = 4          # 複数のコレクションを横断して検索する並列数
+
+# インデックス設定
+INDEX_TYPE = "auto"  # "flat" / "ivf_flat" / "hnsw" / "ivf_pq" / "auto"（チャンク数から自動選択）
+INDEX_AUTO_THRESHOLDS = [  # (チャンク数の上限, 種別) を昇順に並べる
+    (20000, "flat"),
+    (1000000, "ivf_flat"),
+    (float("inf"), "ivf_pq"),
+]
+INDEX_TRAIN_SAMPLE_SIZE = 100000  # IVF / PQ の学習に使う最大件数
+INDEX_RETRAIN_GROWTH_FACTOR = 4   # 学習時のチャンク数の何倍を超えたら学習し直すか
+IVF_NLIST = None                  # Noneの場合はチャンク数から決定
+IVF_NPROBE = 16                   # 大きいほど再現率が上がり、検索は遅くなる
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64               # 大きいほど再現率が上がり、検索は遅くなる
+PQ_M = 64                         # PQのサブベクトル数（次元数を割り切れる値に調整される）
+PQ_NBITS = 8
+VECTOR_QUANTIZATION = None        # None / "sq8"（int8スカラー量子化）/ "pq"（直積量子化）
+RESCORE_CANDIDATE_FACTOR = 4      # 量子化時にk件の何倍を候補として取り、float32で再スコアリングするか
+
+# ハイブリッド検索設定（文字n-gramのBM25とベクトル検索の統合）
+HYBRID_SEARCH_ENABLED = True      # Falseでベクトル検索のみ（転置インデックスを作らずメモリを節約）
+LEXICAL_NGRAM_SIZE = 2            # 日本語などを分割する文字数
+BM25_K1 = 1.2
+BM25_B = 0.75
+LEXICAL_MAX_BLOCKS = 8            # 追加ごとに作るブロックがこの数を超えたら1つにまとめる
+RRF_K = 60                        # Reciprocal Rank Fusion の定数（大きいほど下位の順位も重視）
+HYBRID_CANDIDATE_FACTOR = 4       # 統合前にそれぞれの検索で取得する件数（k の何倍か）
+EMBEDDING_TIMEOUT_SECONDS = 5.0   # クエリの埋め込みがこの秒数を超えたら語彙検索のみで回答（Noneで無制限）
+
+# コンテキスト設定（検索結果からプロンプトに入れる参考文書の選び方）
+CONTEXT_CANDIDATE_K = 12             # 検索で多めに取得する候補数（この中から重複を除いてトークン数の上限まで詰める）
+CONTEXT_MAX_DOCUMENTS = 8            # プロンプトに入れる最大チャンク数
+CONTEXT_TOKEN_BUDGETS = {            # モデルごとの参考文書のトークン数の上限（モデル名の前方一致）
+    "gpt-3.5-turbo": 2500,
+    "gpt-4": 4000,
+    "gpt-4o": 8000,
+}
+CONTEXT_DEFAULT_TOKEN_BUDGET = 2000  # 上記にないモデルの上限
+CONTEXT_DUPLICATE_THRESHOLD = 0.9    # 検索語の重なりがこの割合以上のチャンクは重複として除く
+CONTEXT_MIN_OVERLAP_CHARS = 20       # 同じ出典の前後のチャンクとこの文字数以上重なる部分は取り除く
+CONTEXT_RERANKER = None              # None / "overlap"（質問の語の網羅率）/ "cross_encoder"（sentence-transformers が必要）
+CROSS_ENCODER_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+# 文書取り込み設定
+INGESTION_MAX_WORKERS = None        # 解析に使うプロセス数（NoneはCPUコア数）
+INGESTION_EMBEDDING_WORKERS = 2     # 解析と並行して埋め込みを行うスレッド数
+INGESTION_QUEUE_SIZE = 8            # 埋め込み待ちのチャンクバッチの上限
+INGESTION_SEGMENT_CHUNKS = 4096     # 埋め込み済みのチャンクをこの数までためてから1つのセグメントとしてインデックスに追加
+INGESTION_PDF_PAGES_PER_TASK = 20   # PDFを分割して並列解析する際のページ数
+INGESTION_TEMP_DIR = "./data/tmp"
+
+# プロバイダー設定（APIを使わずにベンチマーク・負荷試験を行う場合は "fake" / "hashing"）
+LLM_PROVIDER = "openai"            # "openai" / "fake"（決定的なダミー応答）
+EMBEDDING_PROVIDER = "openai"      # "openai" / "hashing"（文字n-gramのハッシュによる決定的な埋め込み）
+HASHING_EMBEDDING_DIMENSION = 384
+FAKE_LLM_LATENCY_SECONDS = 0.5     # 最初のトークンまでの時間
+FAKE_LLM_TOKENS_PER_SECOND = 50    # 0の場合はトークン間で待たない
+FAKE_LLM_RESPONSE_TOKENS = 64
+
+# 埋め込みキャッシュ設定
+EMBEDDING_CACHE_PATH = "./data/embedding_cache.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = 200000  # 上限を超えると最終アクセスが古い順に削除
+EMBEDDING_BATCH_SIZE = 256            # キャッシュミス分を埋め込む際のバッチサイズ
+EMBEDDING_CACHE_ACCESS_FLUSH_ENTRIES = 1000     # ヒットしたキーのアクセス時刻はこの件数までためてまとめて書き込む
+EMBEDDING_CACHE_ACCESS_FLUSH_SECONDS = 60.0     # 件数に達しなくても、前回の書き込みからこの秒数が経てば書き込む
+
+# 回答キャッシュ設定
+ANSWER_CACHE_MAX_ENTRIES = 1000          # 上限を超えると最も使われていない回答から削除
+ANSWER_CACHE_TTL_SECONDS = 3600
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.97  # 言い換えとみなすクエリ埋め込みのコサイン類似度（Noneで完全一致のみ）
+
+# 問い合わせ処理設定
+AGENT_FALLBACK_WHEN_NOT_FOUND = False  # 文書があってもRAGで見つからない場合にエージェントで回答するか
+SPECULATIVE_AGENT_DELAY_SECONDS = 1.0  # aprocess_queryでRAGがこの秒数で終わらなければエージェントを並行開始（Noneで無効）
+
+# ルーティング設定（質問を計算・文書検索・雑談のどれで処理するかの判定）
+ROUTER_MATH_THRESHOLD = 2          # 計算らしさの点数がこの値以上なら計算として扱う（式・%・計算の言葉は2点以上）
+ROUTER_SMALLTALK_MAX_CHARS = 30    # 挨拶を含んでもこの文字数を超える質問は雑談として扱わない
+ROUTER_CACHE_MAX_ENTRIES = 10000   # 判定結果をキャッシュする質問数
+SMALLTALK_HISTORY_MESSAGES = 4     # 雑談の返答に付ける直近の会話のメッセージ数
+SMALLTALK_TEMPLATES = {            # LLMを呼ばずに定型文で答える言い回し（末尾の記号と全角・半角の違いは無視する）
+    "こんにちは": "こんにちは！文書についての質問や計算など、お気軽にどうぞ。",
+    "こんばんは": "こんばんは！文書についての質問や計算など、お気軽にどうぞ。",
+    "おはよう": "おはようございます！今日は何をお手伝いしましょうか。",
+    "おはようございます": "おはようございます！今日は何をお手伝いしましょうか。",
+    "はじめまして": "はじめまして！アップロードした文書への質問や計算をお手伝いします。",
+    "ありがとう": "どういたしまして！他にも気になることがあればどうぞ。",
+    "ありがとうございます": "どういたしまして！他にも気になることがあればどうぞ。",
+    "よろしくお願いします": "こちらこそよろしくお願いします！",
+    "hello": "こんにちは！文書についての質問や計算など、お気軽にどうぞ。",
+    "hi": "こんにちは！文書についての質問や計算など、お気軽にどうぞ。",
+    "thanks": "どういたしまして！他にも気になることがあればどうぞ。",
+    "thank you": "どういたしまして！他にも気になることがあればどうぞ。",
+}
+
+# 会話履歴設定（エージェントに渡す会話履歴の上限と保存）
+MEMORY_MAX_TOKENS = 1500                   # 直近のやり取りを原文で渡すトークン数の上限（超えた古いやり取りは要約する）
+MEMORY_SUMMARY_MAX_CHARS = 600             # 古いやり取りの要約の最大文字数
+MEMORY_SUMMARY_WORKERS = 2                 # 要約をバックグラウンドで行うスレッド数
+MEMORY_STORE_PATH = "./data/conversations.sqlite3"  # セッションごとの会話履歴の保存先（Noneで保存しない）
+MEMORY_MAX_SESSIONS = 1000                 # メモリに保持するセッション数（超えると最も使われていないものから破棄し、次回は保存先から読み込む）
+MEMORY_RETENTION_SECONDS = 30 * 24 * 3600  # この期間使われていない保存済みの会話は起動時に削除（Noneで無期限）
+
+# トレース設定（処理段階ごとのレイテンシ・トークン数の計測）
+TRACING_ENABLED = True
+TRACE_EXPORT_PATH = None           # 例: "./data/traces.jsonl"（1行1トレースのOTLP/JSONで追記）
+TRACE_SERVICE_NAME = "chatbot"
+TRACE_MAX_TRACES = 200             # メモリに保持する直近のトレース数
+TRACE_STAGE_WINDOW = 1000          # 段階ごとの集計に使う直近のspan数
+AGENT_VERBOSE = False              # Trueでエージェントの思考過程を標準出力に表示
+
+# 起動設定
+STARTUP_BACKGROUND_WARMUP = True   # TrueでChatBotの作成時にLLM・RAG・エージェントをバックグラウンドで読み込み始める（Falseでは最初に使うときに読み込む）
+
+# バッチ処理設定（batch.py）
+BATCH_MAX_CONCURRENCY = 8  # 回答生成を並行して行う最大数
+
+# サーバー設定（server.py）
+SERVER_HOST = "0.0.0.0"
+SERVER_PORT = 8000
+SERVER_WORKERS = 1                    # 複数にする場合は VECTOR_STORE_LOAD_MODE="mmap" でページキャッシュを共有するとよい
+SERVER_MAX_CONCURRENCY = 8            # ワーカーごとの同時処理数
+SERVER_MAX_QUEUE = 32                 # 処理待ちの上限（超えると503を返す）
+SERVER_QUEUE_TIMEOUT_SECONDS = 30     # 処理待ちがこの秒数を超えると503を返す
+SERVER_SHUTDOWN_TIMEOUT_SECONDS = 30  # 停止時に処理中のリクエストの完了を待つ秒数
 
 # Streamlit設定
 APP_TITLE = "生成AIチャットボット（RAG + Agents）"
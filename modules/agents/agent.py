@@ -1,45 +1,96 @@
-from typing import Dict, Any
-from langchain.agents import AgentType, initialize_agent
-from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
+import asyncio
+from typing import Dict, Any, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
 from .tools import ToolManager
+from .router import ROUTE_MATH
+from .smalltalk import SmallTalkResponder
+from .memory import ConversationMemory, ConversationStore
+from modules.providers.registry import create_chat_model
+from modules.core.tracing import tracer, TracingCallbackHandler
+from modules.core.startup import LazySubsystem, timed_import
 import config
 
 class AgentManager:
-    def __init__(self):
-        self.llm = ChatOpenAI(
-            openai_api_key=config.OPENAI_API_KEY,
-            model_name=config.MODEL_NAME,
-            temperature=config.TEMPERATURE
-        )
+    """エージェントとツールを保持する（複数セッションで共有できるよう、会話履歴は呼び出しごとに渡す）"""
+
+    def __init__(self, llm: Optional[BaseChatModel] = None):
+        self.llm = llm or create_chat_model()
         self.tool_manager = ToolManager()
-        self.tools = self.tool_manager.get_tools()
+        self.router = self.tool_manager.router
+        self.smalltalk = SmallTalkResponder(self.llm)
 
-        # メモリの初期化
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
+        # セッションごとの会話履歴（古いやり取りの要約にも同じLLMを使う）
+        self.memory_store = ConversationStore(self.llm)
+        # memory を渡さなかった場合に使う既定の会話履歴
+        self.memory = self.memory_store.create()
 
-        # エージェントの初期化
-        self.agent = initialize_agent(
-            tools=self.tools,
+        # エージェントは計算以外の質問で初めて使うため、最初に使うとき（または warm_up() の後）に作成する
+        self._agent = LazySubsystem("agent", self._create_agent)
+
+    def _create_agent(self):
+        agents = timed_import("langchain.agents")
+        # 会話履歴は自動保存せず、実行時に chat_history として渡す
+        return agents.initialize_agent(
+            tools=self.tool_manager.get_tools(),
             llm=self.llm,
-            agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
-            verbose=True,
-            memory=self.memory,
+            agent=agents.AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
+            verbose=config.AGENT_VERBOSE,
             handle_parsing_errors=True
         )
 
-    def process_query(self, query: str) -> Dict[str, Any]:
+    @property
+    def agent(self):
+        return self._agent.get()
+
+    @property
+    def tools(self):
+        return self.agent.tools
+
+    def warm_up(self) -> None:
+        """エージェントの作成をバックグラウンドのスレッドで開始"""
+        self._agent.start_warmup()
+
+    def create_memory(self, session_id: Optional[str] = None) -> ConversationMemory:
+        """セッションの会話履歴を取得（session_id がなければ保存しない一時的な会話履歴を作成）"""
+        return self.memory_store.get(session_id)
+
+    def process_query(self, query: str, memory: Optional[ConversationMemory] = None) -> Dict[str, Any]:
         """エージェントを使用してクエリを処理"""
+        memory = memory or self.memory
         try:
-            response = self.agent.run(query)
+            with tracer.span("agent.process_query"):
+                outputs = self.agent.invoke({"input": query, **memory.load_memory_variables({})},
+                                            config={"callbacks": [TracingCallbackHandler()]})
+            response = outputs["output"]
+        except Exception as e:
             return {
-                "answer": response,
+                "answer": f"エージェント処理中にエラーが発生しました: {str(e)}",
                 "is_agent_response": True,
-                "tools_used": self._extract_tools_used(response)
+                "tools_used": []
             }
+
+        self.remember(query, response, memory)
+        return {
+            "answer": response,
+            "is_agent_response": True,
+            "tools_used": self._extract_tools_used(response)
+        }
+
+    async def aprocess_query(self, query: str, remember: bool = True,
+                             memory: Optional[ConversationMemory] = None) -> Dict[str, Any]:
+        """process_query の非同期版
+
+        remember=False の場合は会話履歴を読むだけで書き込まない（投機的に実行して
+        結果を使わない可能性がある場合に使い、採用時に remember() で記録する）。
+        """
+        memory = memory or self.memory
+        try:
+            with tracer.span("agent.process_query"):
+                # エージェントの作成（重いimportを含む）でイベントループを止めないよう、スレッドで待つ
+                agent = await self._agent.aget()
+                outputs = await agent.ainvoke({"input": query, **memory.load_memory_variables({})},
+                                                   config={"callbacks": [TracingCallbackHandler()]})
+            response = outputs["output"]
         except Exception as e:
             return {
                 "answer": f"エージェント処理中にエラーが発生しました: {str(e)}",
@@ -47,9 +98,83 @@ class AgentManager:
                 "tools_used": []
             }
 
+        if remember:
+            # 会話履歴の保存はSQLiteへの書き込みを伴うため、スレッドで行う
+            await asyncio.to_thread(self.remember, query, response, memory)
+        return {
+            "answer": response,
+            "is_agent_response": True,
+            "tools_used": self._extract_tools_used(response)
+        }
+
+    def remember(self, query: str, answer: str, memory: Optional[ConversationMemory] = None) -> None:
+        """やり取りを会話履歴に記録"""
+        (memory or self.memory).save_context({"input": query}, {"output": answer})
+
+    def calculate_locally(self, query: str,
+                          memory: Optional[ConversationMemory] = None) -> Optional[Dict[str, Any]]:
+        """LLMを使わずに計算できるクエリはローカルで計算（解釈できなければNone）"""
+        with tracer.span("agent.local_calculator") as span:
+            answer = self.tool_manager.math_tool.local_calculator.calculate(query)
+            span.set_attribute("calculated", answer is not None)
+        if answer is None:
+            return None
+
+        # エージェントを経由しなくても、後続の質問で結果を参照できるよう会話履歴に残す
+        self.remember(query, answer, memory)
+        return {
+            "answer": answer,
+            "is_agent_response": True,
+            "tools_used": ["Calculator"]
+        }
+
+    def answer_smalltalk(self, query: str, memory: Optional[ConversationMemory] = None) -> Dict[str, Any]:
+        """挨拶・雑談に検索やエージェントを使わず直接答える"""
+        try:
+            with tracer.span("agent.smalltalk") as span:
+                result = self.smalltalk.answer(query, memory or self.memory)
+                span.set_attribute("source", result["source"])
+        except Exception as e:
+            return {
+                "answer": f"応答の生成中にエラーが発生しました: {str(e)}",
+                "is_agent_response": False,
+                "tools_used": []
+            }
+
+        self.remember(query, result["answer"], memory)
+        return {
+            "answer": result["answer"],
+            "is_agent_response": False,
+            "tools_used": []
+        }
+
+    async def aanswer_smalltalk(self, query: str, memory: Optional[ConversationMemory] = None) -> Dict[str, Any]:
+        """answer_smalltalk の非同期版"""
+        try:
+            with tracer.span("agent.smalltalk") as span:
+                result = await self.smalltalk.aanswer(query, memory or self.memory)
+                span.set_attribute("source", result["source"])
+        except Exception as e:
+            return {
+                "answer": f"応答の生成中にエラーが発生しました: {str(e)}",
+                "is_agent_response": False,
+                "tools_used": []
+            }
+
+        await asyncio.to_thread(self.remember, query, result["answer"], memory)
+        return {
+            "answer": result["answer"],
+            "is_agent_response": False,
+            "tools_used": []
+        }
+
+    def route(self, query: str) -> str:
+        """クエリの処理経路（計算・文書検索・雑談）"""
+        return self.router.route(query)
+
     def is_agent_query(self, query: str) -> bool:
-        """クエリがエージェント処理を必要とするかを判定"""
-        return self.tool_manager.is_math_query(query)
+        """クエリがエージェント処理を必要とするかを判定（計算など）"""
+        return self.route(query) == ROUTE_MATH
 
     def _extract_tools_used(self, response: str) -> list:
         """レスポンスから使用されたツールを抽出"""
@@ -58,10 +183,10 @@ class AgentManager:
             tools_used.append("Calculator")
         return tools_used
 
-    def clear_memory(self):
+    def clear_memory(self, memory: Optional[ConversationMemory] = None):
         """会話履歴をクリア"""
-        self.memory.clear()
+        (memory or self.memory).clear()
 
-    def get_memory(self) -> str:
+    def get_memory(self, memory: Optional[ConversationMemory] = None) -> str:
         """現在の会話履歴を取得"""
-        return str(self.memory.buffer)
\ No newline at end of file
+        return str((memory or self.memory).buffer)
@@ -0,0 +1,308 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+from modules.core.tokens import count_message_tokens
+from modules.core.tracing import tracer
+import config
+
+_SUMMARY_PROMPT = """あなたは会話の記録係です。これまでの要約と新しいやり取りをまとめ、
+後続の質問に答えるのに必要な事実・数値・ユーザーの意図を残して、{max_chars}文字以内の日本語で要約してください。
+要約だけを出力してください。"""
+
+
+class ConversationMemory:
+    """トークン数に上限のある会話履歴
+
+    直近のやり取りは max_tokens まで原文で保持し、超えた古いやり取りは要約にまとめる。
+    要約はLLMを使うためバックグラウンドで行い、終わるまでは要約前の古いやり取りを含めない。
+    ConversationBufferMemory と同じ load_memory_variables / save_context / clear / buffer で使える。
+    """
+
+    memory_key = "chat_history"
+
+    def __init__(self, session_id: Optional[str] = None, summarizer: Optional["ConversationSummarizer"] = None,
+                 max_tokens: int = config.MEMORY_MAX_TOKENS, on_change=None):
+        self.session_id = session_id
+        self.summarizer = summarizer
+        self.max_tokens = max_tokens
+        self.summary = ""
+        self.messages: List[BaseMessage] = []
+        self.updated_at = time.time()
+        self._pending: List[BaseMessage] = []
+        self._summarizing = False
+        self._clear_count = 0
+        self._on_change = on_change
+        self._lock = threading.Lock()
+
+    @property
+    def buffer(self) -> List[BaseMessage]:
+        """エージェントに渡す会話履歴（要約があれば先頭にシステムメッセージとして付ける）"""
+        with self._lock:
+            messages = list(self.messages)
+            summary = self.summary
+        if summary:
+            return [SystemMessage(content=f"これまでの会話の要約: {summary}")] + messages
+        return messages
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        return {self.memory_key: self.buffer}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """やり取りを追加し、上限を超えた古いやり取りを要約に回す"""
+        with self._lock:
+            self.messages.extend([HumanMessage(content=inputs["input"]), AIMessage(content=outputs["output"])])
+            # 直近のやり取りは上限を超えても残す
+            while len(self.messages) > 2 and count_message_tokens(self.messages) > self.max_tokens:
+                self._pending.extend(self.messages[:2])
+                del self.messages[:2]
+            self.updated_at = time.time()
+            start_summary = bool(self._pending) and not self._summarizing
+            if start_summary:
+                self._summarizing = True
+        if start_summary:
+            self._start_summary()
+        self._changed()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.summary = ""
+            self.messages = []
+            self._pending = []
+            self._clear_count += 1
+            self.updated_at = time.time()
+        self._changed()
+
+    def is_summarizing(self) -> bool:
+        return self._summarizing
+
+    def to_dict(self) -> Dict[str, Any]:
+        """保存用の形式（要約待ちのやり取りも含める）"""
+        with self._lock:
+            return {
+                "summary": self.summary,
+                "pending": [[message.type, message.content] for message in self._pending],
+                "messages": [[message.type, message.content] for message in self.messages]
+            }
+
+    def restore(self, data: Dict[str, Any], updated_at: float) -> None:
+        """保存した内容から復元（要約待ちだったやり取りは改めて要約する）"""
+        with self._lock:
+            self.summary = data.get("summary", "")
+            self.messages = [_to_message(kind, content) for kind, content in data.get("messages", [])]
+            self._pending = [_to_message(kind, content) for kind, content in data.get("pending", [])]
+            self.updated_at = updated_at
+            start_summary = bool(self._pending) and not self._summarizing
+            if start_summary:
+                self._summarizing = True
+        if start_summary:
+            self._start_summary()
+
+    def _start_summary(self) -> None:
+        if self.summarizer is None:
+            # 要約できない場合は、古いやり取りをそのまま捨てる
+            with self._lock:
+                self._pending = []
+                self._summarizing = False
+            return
+        self.summarizer.submit(self)
+
+    def _summarize(self) -> None:
+        """要約待ちのやり取りを要約に取り込む（要約中に追加された分は続けて要約する）"""
+        while True:
+            with self._lock:
+                pending, summary, clear_count = list(self._pending), self.summary, self._clear_count
+            new_summary = self.summarizer.summarize(summary, pending)
+            with self._lock:
+                if clear_count != self._clear_count:
+                    # 要約中にクリアされた場合は結果を捨てる
+                    self._summarizing = False
+                    return
+                self.summary = new_summary
+                del self._pending[:len(pending)]
+                if not self._pending:
+                    self._summarizing = False
+                    break
+        self._changed()
+
+    def _changed(self) -> None:
+        if self._on_change is not None:
+            self._on_change(self)
+
+
+def _to_message(kind: str, content: str) -> BaseMessage:
+    if kind == "human":
+        return HumanMessage(content=content)
+    if kind == "system":
+        return SystemMessage(content=content)
+    return AIMessage(content=content)
+
+
+class ConversationSummarizer:
+    """古いやり取りをLLMで要約する（全セッションで共有するスレッドプールで実行）"""
+
+    def __init__(self, llm: BaseChatModel, max_chars: int = config.MEMORY_SUMMARY_MAX_CHARS,
+                 workers: int = config.MEMORY_SUMMARY_WORKERS):
+        self.llm = llm
+        self.max_chars = max_chars
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="memory-summary")
+
+    def submit(self, memory: ConversationMemory) -> None:
+        self._executor.submit(self._run, memory)
+
+    @staticmethod
+    def _run(memory: ConversationMemory) -> None:
+        try:
+            memory._summarize()
+        except Exception as e:
+            print(f"会話履歴の要約中にエラーが発生しました: {e}")
+            memory._summarizing = False
+
+    def summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        """これまでの要約と新しいやり取りから要約を作成（LLMが使えなければ末尾を残して切り詰める）"""
+        transcript = "\n".join(f"{'ユーザー' if message.type == 'human' else 'アシスタント'}: {message.content}"
+                               for message in messages)
+        with tracer.span("memory.summarize", messages=len(messages)):
+            try:
+                response = self.llm.invoke([
+                    SystemMessage(content=_SUMMARY_PROMPT.format(max_chars=self.max_chars)),
+                    HumanMessage(content=f"【これまでの要約】\n{summary or 'なし'}\n\n【新しいやり取り】\n{transcript}")
+                ])
+                new_summary = response.content.strip()
+            except Exception as e:
+                print(f"会話履歴の要約に失敗したため、古いやり取りを切り詰めて残します: {e}")
+                new_summary = f"{summary}\n{transcript}".strip()
+        return new_summary[-self.max_chars:]
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+class ConversationStore:
+    """セッションIDごとの会話履歴
+
+    使用中のセッションだけをメモリに保持し（max_sessions を超えると最も使われていないものから破棄）、
+    変更のたびにSQLiteに保存する。破棄したセッションは次に使われたときに読み込み直す。
+    破棄した時点で処理中のリクエストなどが参照している会話履歴は、同じセッションの2つ目を作らないよう
+    参照が残っている間はそのまま返す。
+    retention_seconds より長く使われていない会話は削除する。path がNoneの場合は保存しない。
+    """
+
+    def __init__(self, llm: Optional[BaseChatModel] = None, path: Optional[str] = config.MEMORY_STORE_PATH,
+                 max_sessions: int = config.MEMORY_MAX_SESSIONS,
+                 retention_seconds: Optional[float] = config.MEMORY_RETENTION_SECONDS):
+        self.summarizer = ConversationSummarizer(llm) if llm is not None else None
+        self.path = path
+        self.max_sessions = max_sessions
+        self.retention_seconds = retention_seconds
+        self.evicted = 0
+        self._memories = OrderedDict()
+        # 破棄した後も参照されている会話履歴（弱参照のため、使われなくなれば自動的に消える）
+        self._alive = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations(updated_at)"
+            )
+            self._conn.commit()
+            self.purge_expired()
+
+    def create(self) -> ConversationMemory:
+        """保存しない一時的な会話履歴（1回限りの問い合わせなど）"""
+        return ConversationMemory(summarizer=self.summarizer)
+
+    def get(self, session_id: Optional[str]) -> ConversationMemory:
+        """セッションの会話履歴（なければ保存済みのものを読み込むか、新しく作成）"""
+        if session_id is None:
+            return self.create()
+
+        with self._lock:
+            memory = self._memories.get(session_id)
+            if memory is not None:
+                self._memories.move_to_end(session_id)
+                return memory
+
+            memory = self._alive.get(session_id)
+            if memory is None:
+                memory = ConversationMemory(session_id, self.summarizer, on_change=self._save)
+                row = self._load(session_id)
+                if row is not None:
+                    memory.restore(json.loads(row[0]), row[1])
+                self._alive[session_id] = memory
+            self._memories[session_id] = memory
+            while len(self._memories) > self.max_sessions:
+                # 変更のたびに保存しているため、破棄しても次回読み込める
+                self._memories.popitem(last=False)
+                self.evicted += 1
+            return memory
+
+    def delete(self, session_id: str) -> None:
+        """セッションの会話履歴を削除"""
+        with self._lock:
+            self._memories.pop(session_id, None)
+            self._alive.pop(session_id, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+                self._conn.commit()
+
+    def purge_expired(self) -> int:
+        """retention_seconds より長く使われていない保存済みの会話を削除"""
+        if self._conn is None or self.retention_seconds is None:
+            return 0
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM conversations WHERE updated_at < ?", (time.time() - self.retention_seconds,)
+            ).rowcount
+            self._conn.commit()
+        return deleted
+
+    def _load(self, session_id: str):
+        if self._conn is None:
+            return None
+        return self._conn.execute(
+            "SELECT data, updated_at FROM conversations WHERE session_id = ?", (session_id,)
+        ).fetchone()
+
+    def _save(self, memory: ConversationMemory) -> None:
+        if self._conn is None:
+            return
+        data = json.dumps(memory.to_dict(), ensure_ascii=False)
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO conversations (session_id, data, updated_at) VALUES (?, ?, ?)",
+                    (memory.session_id, data, memory.updated_at)
+                )
+                self._conn.commit()
+        except Exception as e:
+            print(f"会話履歴の保存中にエラーが発生しました: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            memories = list(self._memories.values())
+            stored = (self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+                      if self._conn is not None else None)
+        return {
+            "active_sessions": len(memories),
+            "stored_sessions": stored,
+            "evicted": self.evicted,
+            "summarizing": sum(1 for memory in memories if memory.is_summarizing())
+        }
+
+    def __len__(self) -> int:
+        return len(self._memories)
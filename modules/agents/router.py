@@ -0,0 +1,169 @@
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict, Counter, deque
+from typing import Dict, Any, List, Tuple, Set
+import numpy as np
+import config
+
+ROUTE_MATH = "math"
+ROUTE_RAG = "rag"
+ROUTE_SMALLTALK = "smalltalk"
+
+# 挨拶の言い回し（質問の全体が挨拶と記号だけの場合に雑談として扱う）
+_GREETING = (r"こんにちは|こんにちわ|こんばんは|おはよう(?:ございます)?|はじめまして"
+             r"|ありがとう(?:ございます|ございました)?|よろしく(?:お願い(?:します|いたします|致します))?"
+             r"|お疲れ(?:様|さま)?(?:です|でした)?|おつかれ(?:さま)?(?:です|でした)?|さようなら|またね"
+             r"|\b(?:hello|hi|hey|thanks|thank you|good (?:morning|afternoon|evening))\b")
+
+# 判定に使う特徴（全てを1つの正規表現にまとめ、一致した種類を名前付きグループで取り出す）
+# 同じ位置では先に書いたものが優先されるため、日付・URL・型番などの計算ではない表記を先に置き、
+# それらに含まれるハイフンやスラッシュが演算記号として扱われないようにする。
+_FEATURES: List[Tuple[str, str]] = [
+    ("url", r"https?://\S+|www\.\S+|[\w.-]+\.(?:com|jp|net|org|io)\b\S*"),
+    ("date", r"(?:19|20)\d{2}[-/.]\d{1,2}[-/.]\d{1,2}|(?:19|20)?\d{2}年(?:\d{1,2}月(?:\d{1,2}日)?)?"
+             r"|\d{1,2}月\d{1,2}日|\d{1,2}/\d{1,2}(?=\s*(?:[(（]|の|に|から|まで|付|締))"),
+    ("code", r"(?!sqrt|sin|cos|tan|log|exp)[a-z]+[-_]?\d+(?:[-_/][0-9a-z]+)*|\d+(?:-\d+){2,}|[a-z]+(?:/[a-z]+)+"),
+    ("expression", r"\d\s*[+*×÷^]\s*[\d(√]|[\d)]\s*[-/]\s*\(|\)\s*[-+*/×÷]\s*\d|\d\s+[-/]\s+\d"
+                   r"|(?:sqrt|sin|cos|tan|log)\s*\(?\d"),
+    ("number_pair", r"\d+(?:\.\d+)?\s*[-/]\s*\d+(?:\.\d+)?"),
+    ("percent", r"\d+(?:\.\d+)?\s*%"),
+    ("math_word", r"計算|足し算|引き算|掛け算|割り算|パーセント|平方根|累乗|乗根|√"
+                  r"|足す|引く|掛ける|割る|プラス|マイナス|何倍|\d\s*の?\s*-?\d+\s*乗"),
+    ("number_question", r"いくつ|いくら|何円|何%|答え|合計|平均|割合"),
+    ("greeting", _GREETING),
+    ("document", r"規程|規則|規定|手続|申請|方法|とは|について|資料|文書|マニュアル|第\d+条|制度|場合"),
+]
+_FEATURE_PATTERN = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in _FEATURES))
+
+# 特徴ごとの計算らしさの重み（合計が ROUTER_MATH_THRESHOLD 以上なら計算として扱う）
+_MATH_WEIGHTS = {
+    "expression": 3,
+    "percent": 2,
+    "math_word": 2,
+    "number_question": 1,
+    "number_pair": 1,
+    "document": -1,
+}
+# これらを含む場合は、ローカルの計算機で式として読めても計算として扱わない
+_NOT_MATH = {"url", "date", "code"}
+
+_GREETING_PATTERN = re.compile(_GREETING)
+# 挨拶を取り除いた残りがこれだけなら雑談（「こんにちは、有給は何日？」のような質問は文書検索に回す）
+_SMALLTALK_REST = re.compile(r"[\s!?.,~。、！？〜ー♪…・]*")
+
+
+def normalize_query(query: str) -> str:
+    """判定とキャッシュのキーに使う形（全角・半角と大文字・小文字、空白の違いをそろえる）"""
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+def extract_features(text: str) -> Set[str]:
+    """正規化済みのテキストに含まれる特徴の種類"""
+    return {match.lastgroup for match in _FEATURE_PATTERN.finditer(text)}
+
+
+class QueryRouter:
+    """質問を計算（エージェント）・文書検索（RAG）・雑談のどれで処理するかをローカルで判定
+
+    1つにまとめてコンパイルした正規表現で特徴を取り出して点数を付け、
+    判定が分かれる場合だけローカルの計算機で式として読めるかを確かめる。
+    同じ質問の判定結果はキャッシュし、経路ごとの件数と判定時間を集計する。
+    """
+
+    def __init__(self, calculator=None, max_entries: int = config.ROUTER_CACHE_MAX_ENTRIES,
+                 math_threshold: int = config.ROUTER_MATH_THRESHOLD,
+                 smalltalk_max_chars: int = config.ROUTER_SMALLTALK_MAX_CHARS):
+        self.calculator = calculator
+        self.max_entries = max_entries
+        self.math_threshold = math_threshold
+        self.smalltalk_max_chars = smalltalk_max_chars
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self._routes = Counter()
+        self._latencies = deque(maxlen=config.TRACE_STAGE_WINDOW)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def route(self, query: str) -> str:
+        """質問の処理経路（ROUTE_MATH / ROUTE_RAG / ROUTE_SMALLTALK）"""
+        started = time.perf_counter()
+        key = normalize_query(query)
+        with self._lock:
+            route = self._cache.get(key)
+            if route is not None:
+                self._cache.move_to_end(key)
+        hit = route is not None
+        if not hit:
+            route = self.classify(key)
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._cache[key] = route
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+            self._routes[route] += 1
+            self._latencies.append(time.perf_counter() - started)
+        return route
+
+    def classify(self, text: str) -> str:
+        """正規化済みのテキストを判定（キャッシュを使わない）"""
+        features = extract_features(text)
+        score = sum(_MATH_WEIGHTS.get(feature, 0) for feature in features)
+
+        if not features & _NOT_MATH:
+            if score >= self.math_threshold:
+                return ROUTE_MATH
+            # 「2-1は？」のように点数だけでは決まらない場合は、式として読めるかで判定する
+            if score > 0 and self.calculator is not None and self.calculator.parse(text) is not None:
+                return ROUTE_MATH
+        elif score >= self.math_threshold + _MATH_WEIGHTS["expression"]:
+            # 日付などを含んでいても、明らかな計算式と計算の言葉がある場合は計算として扱う
+            return ROUTE_MATH
+
+        if ("greeting" in features and len(text) <= self.smalltalk_max_chars
+                and _SMALLTALK_REST.fullmatch(_GREETING_PATTERN.sub("", text))):
+            return ROUTE_SMALLTALK
+        return ROUTE_RAG
+
+    def record_fallback(self) -> None:
+        """RAGに回した質問が文書から回答できず、エージェントで処理し直したことを記録"""
+        with self._lock:
+            self.fallbacks += 1
+
+    def evaluate(self, labeled: List[Tuple[str, str]]) -> Dict[str, Any]:
+        """(質問, 正しい経路) の組に対する判定の正解率と誤判定の内訳"""
+        confusion = Counter()
+        errors = []
+        for query, expected in labeled:
+            actual = self.classify(normalize_query(query))
+            confusion[(expected, actual)] += 1
+            if actual != expected:
+                errors.append({"query": query, "expected": expected, "actual": actual})
+        correct = sum(count for (expected, actual), count in confusion.items() if expected == actual)
+        return {
+            "accuracy": round(correct / len(labeled), 4) if labeled else None,
+            "count": len(labeled),
+            "confusion": {f"{expected}->{actual}": count for (expected, actual), count in sorted(confusion.items())},
+            "errors": errors
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = np.array(self._latencies) * 1e6
+            routes = dict(self._routes)
+            hits, misses, fallbacks = self.hits, self.misses, self.fallbacks
+        total = hits + misses
+        return {
+            "routes": routes,
+            "cache_hits": hits,
+            "cache_misses": misses,
+            "cache_hit_rate": round(hits / total, 4) if total else 0.0,
+            "rag_fallbacks": fallbacks,
+            "p50_us": round(float(np.percentile(latencies, 50)), 1) if len(latencies) else None,
+            "p95_us": round(float(np.percentile(latencies, 95)), 1) if len(latencies) else None
+        }
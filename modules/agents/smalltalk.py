@@ -0,0 +1,86 @@
+import time
+import threading
+import unicodedata
+from collections import Counter, deque
+from typing import Dict, Any, Optional
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import SystemMessage, HumanMessage
+from modules.core.tracing import tracer, record_llm_usage
+from .memory import ConversationMemory
+import config
+
+_SMALLTALK_PROMPT = """あなたは社内文書の検索と計算を手伝うチャットボットです。
+ユーザーの挨拶や雑談に、日本語で1〜2文の短く自然な返答をしてください。"""
+
+# テンプレートと照合する前に取り除く末尾の記号
+_TRAILING = " !?.。、,~〜♪"
+
+
+def template_key(query: str) -> str:
+    """テンプレートの照合に使う形（全角・半角と大文字・小文字、末尾の記号の違いをそろえる）"""
+    return unicodedata.normalize("NFKC", query).lower().strip().rstrip(_TRAILING)
+
+
+class SmallTalkResponder:
+    """文書もツールも必要ない挨拶・雑談に直接答える
+
+    よく使われる言い回しは config.SMALLTALK_TEMPLATES の定型文で答え（LLMを呼ばない）、
+    それ以外は直近の会話だけを付けた短いプロンプトで1回だけチャットモデルを呼ぶ。
+    """
+
+    def __init__(self, llm: BaseChatModel, templates: Dict[str, str] = config.SMALLTALK_TEMPLATES,
+                 history_messages: int = config.SMALLTALK_HISTORY_MESSAGES):
+        self.llm = llm
+        self.templates = {template_key(phrase): answer for phrase, answer in templates.items()}
+        self.history_messages = history_messages
+        self._counts = Counter()
+        self._latencies = deque(maxlen=config.TRACE_STAGE_WINDOW)
+        self._lock = threading.Lock()
+
+    def answer(self, query: str, memory: Optional[ConversationMemory] = None) -> Dict[str, Any]:
+        """返答と、定型文（"template"）・チャットモデル（"llm"）のどちらで答えたか"""
+        started = time.perf_counter()
+        answer = self.templates.get(template_key(query))
+        if answer is not None:
+            return self._finish(answer, "template", started)
+
+        messages = self._build_messages(query, memory)
+        with tracer.span("smalltalk.llm") as span:
+            response = self.llm.invoke(messages)
+            record_llm_usage(span, messages, response.content, response.response_metadata.get("token_usage"))
+        return self._finish(response.content, "llm", started)
+
+    async def aanswer(self, query: str, memory: Optional[ConversationMemory] = None) -> Dict[str, Any]:
+        """answer の非同期版（チャットモデルの応答を待つ間イベントループを塞がない）"""
+        started = time.perf_counter()
+        answer = self.templates.get(template_key(query))
+        if answer is not None:
+            return self._finish(answer, "template", started)
+
+        messages = self._build_messages(query, memory)
+        with tracer.span("smalltalk.llm") as span:
+            response = await self.llm.ainvoke(messages)
+            record_llm_usage(span, messages, response.content, response.response_metadata.get("token_usage"))
+        return self._finish(response.content, "llm", started)
+
+    def _build_messages(self, query: str, memory: Optional[ConversationMemory]) -> list:
+        """直近の会話だけを付けた短いプロンプト"""
+        history = memory.buffer[-self.history_messages:] if memory is not None and self.history_messages else []
+        return [SystemMessage(content=_SMALLTALK_PROMPT), *history, HumanMessage(content=query)]
+
+    def _finish(self, answer: str, source: str, started: float) -> Dict[str, Any]:
+        with self._lock:
+            self._counts[source] += 1
+            self._latencies.append(time.perf_counter() - started)
+        return {"answer": answer, "source": source}
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            counts = dict(self._counts)
+        return {
+            "template_answers": counts.get("template", 0),
+            "llm_answers": counts.get("llm", 0),
+            "mean_ms": round(float(latencies.mean()), 3) if len(latencies) else None
+        }
@@ -1,21 +1,180 @@
-from langchain.tools import Tool
-from langchain.chains import LLMMathChain
-from langchain_openai import ChatOpenAI
+from typing import Optional
+from modules.providers.registry import create_chat_model
+from modules.core.startup import LazySubsystem, timed_import
+from .router import QueryRouter, ROUTE_MATH
 import config
 import re
+import ast
+import math
+import operator
+import unicodedata
+
+_NUMBER = r'\d+(?:\.\d+)?'
+
+class LocalCalculator:
+    """日本語・記号で書かれた計算式をLLMを使わずに解析して評価する
+
+    式はPythonのASTに変換し、四則演算・累乗と許可した関数・定数だけを評価する。
+    計算式として解釈できない場合は None を返す。
+    """
+
+    _BINARY_OPERATORS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.Pow: operator.pow
+    }
+    _UNARY_OPERATORS = {
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg
+    }
+    _FUNCTIONS = {
+        "sqrt": math.sqrt,
+        "sin": math.sin,
+        "cos": math.cos,
+        "tan": math.tan,
+        "log": math.log,
+        "log10": math.log10,
+        "exp": math.exp,
+        "radians": math.radians,
+        "abs": abs
+    }
+    _CONSTANTS = {"pi": math.pi, "e": math.e}
+    _MAX_EXPONENT = 1000
+    # 整数の計算結果のビット数の上限（累乗を重ねた式で計算が終わらなくなるのを防ぐ）
+    _MAX_RESULT_BITS = 4096
+
+    # 計算式の前後に付く言い回し（取り除いてから式を解析する）
+    _FILLER_PATTERNS = [
+        r'(を|は)?(計算|けいさん)(して|してください|してくれ|すると|したら)?',
+        r'(は|って)?(いくつ|いくら|何|なん|なに)(ですか|でしょうか|になりますか|になる)?',
+        r'(の)?(答え|こたえ|結果)(は|を)?',
+        r'(を)?教えて(ください)?',
+        r'ですか|でしょうか|ください'
+    ]
+    _WORD_REPLACEMENTS = [
+        (r'足す|たす|プラス', '+'),
+        (r'引く|ひく|マイナス', '-'),
+        (r'掛ける|かける|×', '*'),
+        (r'割る|わる|÷', '/'),
+        (r'パーセント', '%'),
+        (r'サイン', 'sin'),
+        (r'コサイン', 'cos'),
+        (r'タンジェント', 'tan'),
+        (r'π', 'pi'),
+        (r'\^', '**')
+    ]
+
+    def calculate(self, query: str) -> Optional[str]:
+        """クエリを計算して結果の文字列を返す（計算式として解釈できなければNone）"""
+        expression = self.parse(query)
+        if expression is None:
+            return None
+        try:
+            return f"計算結果: {self.format_number(self.evaluate(expression))}"
+        except (ValueError, TypeError, ZeroDivisionError, OverflowError):
+            return None
+
+    def parse(self, query: str) -> Optional[str]:
+        """日本語・記号の計算式をPythonの式に変換"""
+        text = unicodedata.normalize("NFKC", query).strip().lower()
+        for pattern in self._FILLER_PATTERNS:
+            text = re.sub(pattern, '', text)
+        text = text.strip(' ?!.。、=:')
+        text = re.sub(r'は$', '', text).strip()
+
+        for pattern, replacement in self._WORD_REPLACEMENTS:
+            text = re.sub(pattern, replacement, text)
+
+        # 「AのB%」「B%」
+        text = re.sub(rf'({_NUMBER})の({_NUMBER})%', r'(\1*\2/100)', text)
+        text = re.sub(rf'({_NUMBER})%', r'(\1/100)', text)
+        # 「AのB乗」「AのN乗根」「Aの平方根」「√A」
+        text = re.sub(rf'({_NUMBER}|\))の?({_NUMBER})乗根', r'(\1)**(1/\2)', text)
+        text = re.sub(rf'({_NUMBER}|\))の?(-?{_NUMBER})乗', r'(\1)**(\2)', text)
+        text = re.sub(rf'({_NUMBER})の平方根', r'sqrt(\1)', text)
+        text = re.sub(r'(?:√|平方根)\s*', 'sqrt', text)
+        # 「°」「度」の付いた角度はラジアンに変換し、括弧のない関数呼び出しを補う
+        text = re.sub(rf'({_NUMBER})\s*(?:°|度)', r'radians(\1)', text)
+        text = re.sub(rf'\b(sqrt|sin|cos|tan|log10|log|exp)\s*({_NUMBER}|radians\({_NUMBER}\))', r'\1(\2)', text)
+
+        if not text or not re.fullmatch(r'[0-9a-z\s.+\-*/(),]+', text):
+            return None
+        return text
+
+    def evaluate(self, expression: str) -> float:
+        """許可した演算と関数だけでASTを評価"""
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"計算式を解析できません: {expression}") from e
+
+        # 数値だけの入力は計算として扱わない
+        if not any(isinstance(node, (ast.BinOp, ast.Call)) for node in ast.walk(tree)):
+            raise ValueError("演算が含まれていません")
+        return self._evaluate_node(tree.body)
+
+    def _evaluate_node(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name) and node.id in self._CONSTANTS:
+            return self._CONSTANTS[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in self._BINARY_OPERATORS:
+            left = self._evaluate_node(node.left)
+            right = self._evaluate_node(node.right)
+            if isinstance(node.op, ast.Pow):
+                self._check_power(left, right)
+            result = self._BINARY_OPERATORS[type(node.op)](left, right)
+            if isinstance(result, int) and result.bit_length() > self._MAX_RESULT_BITS:
+                raise ValueError("計算結果が大きすぎます")
+            return result
+        if isinstance(node, ast.UnaryOp) and type(node.op) in self._UNARY_OPERATORS:
+            return self._UNARY_OPERATORS[type(node.op)](self._evaluate_node(node.operand))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id in self._FUNCTIONS and len(node.args) == 1 and not node.keywords):
+            return self._FUNCTIONS[node.func.id](self._evaluate_node(node.args[0]))
+        raise ValueError("サポートされていない計算式です")
+
+    def _check_power(self, base, exponent) -> None:
+        """累乗を計算する前に、指数と結果の大きさ（底のビット数 × 指数）が上限内かを確認"""
+        if isinstance(base, complex) or isinstance(exponent, complex):
+            raise ValueError("複素数の計算はサポートしていません")
+        if abs(exponent) > self._MAX_EXPONENT:
+            raise ValueError("指数が大きすぎます")
+        if abs(base) > 1 and exponent > 0 and exponent * math.log2(abs(base)) > self._MAX_RESULT_BITS:
+            raise ValueError("計算結果が大きすぎます")
+
+    @staticmethod
+    def format_number(value) -> str:
+        """整数になる値は整数で、それ以外は有効数字10桁で表示"""
+        if isinstance(value, complex):
+            raise ValueError("複素数の結果はサポートしていません")
+        if float(value).is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return f"{float(value):.10g}"
+
 
 class MathTool:
     def __init__(self):
-        self.llm = ChatOpenAI(
-            openai_api_key=config.OPENAI_API_KEY,
-            model_name=config.MODEL_NAME,
-            temperature=0
-        )
-        self.llm_math = LLMMathChain.from_llm(self.llm)
+        # LLMMathChain はローカルで計算できない式にだけ使うため、最初に使うときに作成する
+        self._llm_math = LazySubsystem("llm_math", self._create_llm_math)
+        self.local_calculator = LocalCalculator()
+
+    @staticmethod
+    def _create_llm_math():
+        return timed_import("langchain.chains").LLMMathChain.from_llm(create_chat_model(temperature=0))
+
+    @property
+    def llm_math(self):
+        return self._llm_math.get()
 
     def calculate(self, query: str) -> str:
-        """数学的計算を実行"""
+        """数学的計算を実行（ローカルで解釈できない式だけLLMMathChainを使う）"""
         try:
+            local_result = self.local_calculator.calculate(query)
+            if local_result is not None:
+                return local_result
             result = self.llm_math.run(query)
             return f"計算結果: {result}"
         except Exception as e:
@@ -24,9 +183,11 @@ class MathTool:
 class ToolManager:
     def __init__(self):
         self.math_tool = MathTool()
+        self.router = QueryRouter(self.math_tool.local_calculator)
 
     def get_tools(self):
         """利用可能なツールのリストを返す"""
+        Tool = timed_import("langchain.tools").Tool
         return [
             Tool(
                 name="Calculator",
@@ -48,20 +209,4 @@ class ToolManager:
 
     def is_math_query(self, query: str) -> bool:
         """クエリが数学的計算を必要とするかを判定"""
-        math_patterns = [
-            r'\d+\s*[+\-*/]\s*\d+',  # 基本的な演算
-            r'\d+\s*の\s*\d+%',       # パーセント計算
-            r'\d+%',                  # パーセント
-            r'計算|足し算|引き算|掛け算|割り算|％|パーセント|平方根|累乗|√',
-            r'[+\-*/=]',             # 演算記号
-            r'\d+\s*\+\s*\d+',       # 足し算
-            r'\d+\s*-\s*\d+',        # 引き算
-            r'\d+\s*×\s*\d+',        # 掛け算
-            r'\d+\s*÷\s*\d+',        # 割り算
-        ]
-
-        for pattern in math_patterns:
-            if re.search(pattern, query):
-                return True
-
-        return False
\ No newline at end of file
+        return self.router.route(query) == ROUTE_MATH
@@ -0,0 +1,60 @@
+import threading
+from contextlib import contextmanager
+
+class ReadWriteLock:
+    """複数の読み取りと単一の書き込みを排他する読み書きロック
+
+    書き込み待ちがある間は新しい読み取りを待たせ、アップロードが検索に埋もれないようにする。
+    再入はできない。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self) -> None:
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self) -> None:
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self) -> None:
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def read_lock(self):
+        """読み取りロックを取得するコンテキストマネージャ"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_lock(self):
+        """書き込みロックを取得するコンテキストマネージャ"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -0,0 +1,32 @@
+import threading
+from .startup import LazySubsystem, timed_import
+
+
+def _create_chatbot():
+    # chatbot は modules を読み込むため、循環importを避けてここで読み込む
+    return timed_import("chatbot").ChatBot()
+
+_shared_chatbot = LazySubsystem("chatbot", _create_chatbot)
+_warmup_lock = threading.Lock()
+_warmup_started = False
+
+def get_shared_chatbot():
+    """プロセス内で共有するChatBotを取得（初回呼び出し時に一度だけ作成）
+
+    ベクトルストア・埋め込み/LLMクライアント・ツールは全セッションで共有し、
+    会話履歴だけを ChatBot.create_memory() でセッションごとに持つ。
+    """
+    return _shared_chatbot.get()
+
+def start_shared_chatbot() -> None:
+    """共有するChatBotの読み込みをバックグラウンドで開始（画面の表示を待たせないため）"""
+    global _warmup_started
+    with _warmup_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+    _shared_chatbot.start_warmup()
+
+def is_shared_chatbot_ready() -> bool:
+    """共有するChatBotを待たずに使えるか（サブシステムの準備が終わっているかは ChatBot.is_ready() で確認）"""
+    return _shared_chatbot.is_ready()
@@ -0,0 +1,99 @@
+import time
+import asyncio
+import threading
+import importlib
+from contextlib import contextmanager
+from typing import Dict, Any, Callable
+
+
+class StartupProfile:
+    """起動時の重いimportとサブシステムの初期化にかかった時間の記録
+
+    同じモジュールを既に読み込んでいた場合は、後から読み込んだ側には差分（ほぼ0秒）だけが記録される。
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, kind: str, name: str):
+        """with 文の範囲の時間を kind（"import" / "init"）ごとに記録"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                self._records.append({
+                    "kind": kind,
+                    "name": name,
+                    "thread": threading.current_thread().name,
+                    "start_seconds": round(started - self.started_at, 4),
+                    "seconds": round(finished - started, 4)
+                })
+
+    def get_report(self) -> Dict[str, Any]:
+        """種類ごとに時間の長い順に並べた記録と、最後の初期化が終わるまでの時間"""
+        with self._lock:
+            records = list(self._records)
+        report = {kind: sorted((record for record in records if record["kind"] == kind),
+                               key=lambda record: -record["seconds"])
+                  for kind in ("import", "init")}
+        report["ready_seconds"] = round(max((record["start_seconds"] + record["seconds"] for record in records),
+                                            default=0.0), 4)
+        return report
+
+
+startup_profile = StartupProfile()
+
+
+def timed_import(module_name: str):
+    """モジュールを読み込み、かかった時間を起動プロファイルに記録"""
+    with startup_profile.measure("import", module_name):
+        return importlib.import_module(module_name)
+
+
+class LazySubsystem:
+    """最初に使われたときに一度だけ作成するサブシステム
+
+    start_warmup() でバックグラウンドのスレッドで先に作成しておける。作成中に get() を呼ぶと完了を待ち、
+    バックグラウンドでの作成に失敗した場合は get() を呼んだスレッドで作成し直す（エラーはそこで送出する）。
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self.name = name
+        self.factory = factory
+        self._value = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._ready.is_set():
+            return self._value
+        with self._lock:
+            if not self._ready.is_set():
+                with startup_profile.measure("init", self.name):
+                    self._value = self.factory()
+                self._ready.set()
+        return self._value
+
+    async def aget(self):
+        """get の非同期版（作成済みでなければ、作成や完了待ちをスレッドで行いイベントループを止めない）"""
+        if self._ready.is_set():
+            return self._value
+        return await asyncio.to_thread(self.get)
+
+    def start_warmup(self) -> None:
+        """バックグラウンドのスレッドで作成を開始"""
+        threading.Thread(target=self._warm_up, name=f"warmup-{self.name}", daemon=True).start()
+
+    def _warm_up(self) -> None:
+        try:
+            self.get()
+        except Exception as e:
+            print(f"{self.name} の事前準備中にエラーが発生しました（使用時に改めて作成します）: {e}")
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
@@ -0,0 +1,36 @@
+import math
+from functools import lru_cache
+from typing import List
+from langchain_core.messages import BaseMessage
+import config
+
+# メッセージごとに役割などで加算されるトークン数（OpenAIのチャット形式）
+_TOKENS_PER_MESSAGE = 3
+_TOKENS_PER_REPLY = 3
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """モデルに対応する tiktoken のエンコーディング（取得できなければNone）"""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # エンコーディングの取得にはネットワークが必要なため、オフラインでは概算に切り替える
+        print(f"トークナイザーを読み込めないため、トークン数を概算します: {e}")
+        return None
+
+def count_tokens(text: str, model: str = config.MODEL_NAME) -> int:
+    """テキストのトークン数"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # 日本語は1文字（UTF-8で3バイト）、英語は3〜4文字がおよそ1トークンになる
+        return math.ceil(len(text.encode("utf-8")) / 3)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages: List[BaseMessage], model: str = config.MODEL_NAME) -> int:
+    """チャットのメッセージ列をプロンプトとして送った場合のトークン数"""
+    return sum(_TOKENS_PER_MESSAGE + count_tokens(str(message.content), model)
+               for message in messages) + _TOKENS_PER_REPLY
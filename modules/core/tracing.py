@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+from .tokens import count_message_tokens, count_tokens
+import config
+
+# トークン数を記録する属性名（OpenTelemetryのGenAIセマンティック規約に合わせる）
+INPUT_TOKENS = "gen_ai.usage.input_tokens"
+OUTPUT_TOKENS = "gen_ai.usage.output_tokens"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """処理段階1つ分の計測区間"""
+
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str],
+                 attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+        self.start_time_ns = time.time_ns()
+        self._started = time.perf_counter_ns()
+        self.duration_ns = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def record_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self) -> None:
+        if self.duration_ns is None:
+            self.duration_ns = time.perf_counter_ns() - self._started
+            self.tracer._on_end(self)
+
+    def elapsed_ms(self) -> float:
+        """開始からの経過時間"""
+        return (time.perf_counter_ns() - self._started) / 1e6
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.duration_ns or 0) / 1e6
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time_ns": self.start_time_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": dict(self.attributes),
+            "error": self.error
+        }
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """OTLP/JSON のspan形式"""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_time_ns),
+            "endTimeUnixNano": str(self.start_time_ns + (self.duration_ns or 0)),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """トレースが無効な場合のspan（何も記録しない）"""
+
+    recording = False
+    span_id = None
+    trace_id = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, **attributes) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Tracer:
+    """処理段階ごとのspanを記録し、段階別のレイテンシ集計と直近のトレースを保持する
+
+    span はコンテキスト変数で親子関係を引き継ぐ。別スレッドで処理する場合は parent を明示する。
+    export_path を指定すると、完了したトレースを1行1件のOTLP/JSON（resourceSpans）で追記する。
+    """
+
+    def __init__(self, enabled: bool = config.TRACING_ENABLED,
+                 export_path: Optional[str] = config.TRACE_EXPORT_PATH,
+                 max_traces: int = config.TRACE_MAX_TRACES,
+                 stage_window: int = config.TRACE_STAGE_WINDOW):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.stage_window = stage_window
+        self._traces = deque(maxlen=max_traces)
+        self._pending = {}
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+
+    def current_span(self):
+        return _current_span.get()
+
+    def start_span(self, name: str, parent=None, **attributes):
+        """spanを開始（end() を呼ぶまで計測する）。parent を省略すると現在のspanの子になる"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        parent = parent if parent is not None else _current_span.get()
+        if parent is not None and parent.recording:
+            return Span(self, name, parent.trace_id, parent.span_id, attributes)
+        span = Span(self, name, uuid.uuid4().hex, None, attributes)
+        with self._lock:
+            self._pending[span.trace_id] = []
+        return span
+
+    @contextmanager
+    def span(self, name: str, parent=None, **attributes):
+        """with 文の範囲を計測し、その間に開始したspanを子にする"""
+        span = self.start_span(name, parent, **attributes)
+        token = _current_span.set(span) if span.recording else None
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            if token is not None:
+                _current_span.reset(token)
+            span.end()
+
+    @contextmanager
+    def activate(self, span):
+        """span を終了させずに現在のspanにする（ジェネレーターで yield をまたがない範囲に使う）"""
+        token = _current_span.set(span) if span.recording else None
+        try:
+            yield span
+        finally:
+            if token is not None:
+                _current_span.reset(token)
+
+    def _on_end(self, span: Span) -> None:
+        with self._lock:
+            samples = self._stages.get(span.name)
+            if samples is None:
+                samples = self._stages[span.name] = deque(maxlen=self.stage_window)
+            samples.append((span.duration_ms, span.attributes.get(INPUT_TOKENS, 0),
+                            span.attributes.get(OUTPUT_TOKENS, 0), span.error is not None))
+
+            if span.parent_id is not None and span.trace_id in self._pending:
+                self._pending[span.trace_id].append(span)
+                return
+            # ルートのspan（または親より後に終わった子）で1件のトレースとして確定する
+            spans = self._pending.pop(span.trace_id, []) + [span]
+            if span.parent_id is None:
+                self._traces.append(spans)
+        self._export(spans)
+
+    def _export(self, spans: List[Span]) -> None:
+        if not self.export_path:
+            return
+        record = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", config.TRACE_SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}]
+            }]
+        }
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.export_path)), exist_ok=True)
+            with self._export_lock, open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except Exception as e:
+            print(f"トレースの書き出し中にエラーが発生しました: {e}")
+
+    def get_stage_summary(self) -> Dict[str, Dict[str, Any]]:
+        """処理段階ごとのレイテンシ（直近 stage_window 件）とトークン数の集計"""
+        with self._lock:
+            stages = {name: list(samples) for name, samples in self._stages.items()}
+
+        summary = {}
+        for name, samples in stages.items():
+            durations = np.array([sample[0] for sample in samples])
+            summary[name] = {
+                "count": len(samples),
+                "mean_ms": round(float(durations.mean()), 3),
+                "p50_ms": round(float(np.percentile(durations, 50)), 3),
+                "p95_ms": round(float(np.percentile(durations, 95)), 3),
+                "max_ms": round(float(durations.max()), 3),
+                "input_tokens": int(sum(sample[1] for sample in samples)),
+                "output_tokens": int(sum(sample[2] for sample in samples)),
+                "errors": sum(1 for sample in samples if sample[3])
+            }
+        return summary
+
+    def get_recent_traces(self, limit: int = 10, name: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """直近のトレース（新しい順）。name を指定するとルートspanの名前で絞り込む"""
+        with self._lock:
+            traces = list(self._traces)
+        traces = [spans for spans in reversed(traces) if name is None or spans[-1].name == name]
+        return [[span.to_dict() for span in spans] for spans in traces[:limit]]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._traces.clear()
+            self._pending.clear()
+            self._stages.clear()
+
+
+# プロセス全体で共有するトレーサー
+tracer = Tracer()
+
+
+def record_llm_usage(span, messages, answer: str, usage: Optional[Dict[str, Any]] = None) -> None:
+    """LLM呼び出しのトークン数をspanに記録（APIが使用量を返さない場合は数える）"""
+    if not span.recording:
+        return
+    if usage:
+        span.set_attribute(INPUT_TOKENS, usage.get("prompt_tokens", 0))
+        span.set_attribute(OUTPUT_TOKENS, usage.get("completion_tokens", 0))
+    else:
+        span.set_attribute(INPUT_TOKENS, count_message_tokens(messages))
+        span.set_attribute(OUTPUT_TOKENS, count_tokens(answer))
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """LangChainの実行（LLM呼び出し・ツール）をspanとして記録するコールバック"""
+
+    def __init__(self, parent=None):
+        # コールバックは別スレッドから呼ばれることがあるため、作成時の親spanを固定する
+        self.parent = parent if parent is not None else tracer.current_span()
+        self._spans = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        span = tracer.start_span("llm.chat", self.parent)
+        if span.recording:
+            span.set_attribute(INPUT_TOKENS, sum(count_message_tokens(batch) for batch in messages))
+        self._spans[run_id] = span
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        span = tracer.start_span("llm.completion", self.parent)
+        if span.recording:
+            span.set_attribute(INPUT_TOKENS, sum(count_tokens(prompt) for prompt in prompts))
+        self._spans[run_id] = span
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        span = self._spans.pop(run_id, None)
+        if span is None:
+            return
+        if span.recording:
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            if usage:
+                span.set_attribute(INPUT_TOKENS, usage.get("prompt_tokens", 0))
+                span.set_attribute(OUTPUT_TOKENS, usage.get("completion_tokens", 0))
+            else:
+                span.set_attribute(OUTPUT_TOKENS, sum(count_tokens(generation.text)
+                                                      for generations in response.generations
+                                                      for generation in generations))
+        span.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._end_with_error(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs) -> None:
+        self._spans[run_id] = tracer.start_span(f"tool.{serialized.get('name', 'unknown')}", self.parent)
+
+    def on_tool_end(self, output, *, run_id, **kwargs) -> None:
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.end()
+
+    def on_tool_error(self, error, *, run_id, **kwargs) -> None:
+        self._end_with_error(run_id, error)
+
+    def _end_with_error(self, run_id, error) -> None:
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.record_error(error)
+            span.end()
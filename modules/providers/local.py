@@ -0,0 +1,122 @@
+import re
+import json
+import time
+import asyncio
+import unicodedata
+from typing import List, Optional, Any, Iterator, AsyncIterator
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+import config
+
+_HASH_MULTIPLIER = np.uint64(0x100000001B3)
+_HASH_FINALIZER = np.uint64(0xFF51AFD7ED558CCD)
+
+class HashingEmbeddings(Embeddings):
+    """APIを使わない決定的な埋め込み（文字n-gramを符号付きハッシュで固定次元に写す）
+
+    同じテキストはプロセスや実行環境によらず同じベクトルになる。
+    単語の区切りがない日本語でも扱えるよう、単語ではなく文字n-gramを特徴量にする。
+    """
+
+    def __init__(self, dimension: int = config.HASHING_EMBEDDING_DIMENSION, ngram_range=(1, 3)):
+        self.dimension = dimension
+        self.ngram_range = ngram_range
+
+    def _embed(self, text: str) -> List[float]:
+        text = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text).lower()).strip()
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+        # 文字コードの列からn-gramごとのハッシュ値をまとめて計算する（uint64の乗算はオーバーフローで桁あふれさせる）
+        hashes = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            if len(codes) < n:
+                break
+            value = np.full(len(codes) - n + 1, n, dtype=np.uint64)
+            for offset in range(n):
+                value = (value ^ codes[offset:len(codes) - n + 1 + offset]) * _HASH_MULTIPLIER
+            hashes.append(value)
+        if not hashes:
+            return [0.0] * self.dimension
+
+        value = np.concatenate(hashes)
+        value ^= value >> np.uint64(33)
+        value *= _HASH_FINALIZER
+        value ^= value >> np.uint64(29)
+        # 下位ビットで次元、最上位ビットで符号を決め、衝突による偏りを打ち消す
+        signs = np.where(value >> np.uint64(63), 1.0, -1.0)
+        vector = np.bincount((value % np.uint64(self.dimension)).astype(np.int64), weights=signs,
+                             minlength=self.dimension)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """APIを使わないダミーのチャットモデル（ベンチマーク・負荷試験用）
+
+    最初のトークンまで latency_seconds 秒待ち、以降は tokens_per_second の速さで
+    入力から決定的に作った response_tokens 個のトークンを返す。
+    エージェントの出力形式が求められている場合は Final Answer のJSONで答える。
+    """
+
+    latency_seconds: float = config.FAKE_LLM_LATENCY_SECONDS
+    tokens_per_second: float = config.FAKE_LLM_TOKENS_PER_SECOND
+    response_tokens: int = config.FAKE_LLM_RESPONSE_TOKENS
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        """最後のメッセージの本文を2文字ずつ区切り、決められた数のトークンにする"""
+        source = re.sub(r"\s+", " ", str(messages[-1].content)).strip() or "応答"
+        tokens = [source[i:i + 2] for i in range(0, len(source), 2)]
+        tokens = (tokens * (self.response_tokens // len(tokens) + 1))[:self.response_tokens]
+
+        if any("action_input" in str(message.content) for message in messages):
+            answer = json.dumps({"action": "Final Answer", "action_input": "".join(tokens)}, ensure_ascii=False)
+            return ["```json\n", answer, "\n```"]
+        return tokens
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self.latency_seconds + self._token_delay() * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.latency_seconds + self._token_delay() * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency_seconds)
+        for token in self._tokens(messages):
+            time.sleep(self._token_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency_seconds)
+        for token in self._tokens(messages):
+            await asyncio.sleep(self._token_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
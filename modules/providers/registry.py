@@ -0,0 +1,65 @@
+from typing import Callable, Dict
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+import config
+
+# プロバイダー名 -> 作成関数
+_CHAT_MODEL_FACTORIES: Dict[str, Callable[[float], BaseChatModel]] = {}
+_EMBEDDING_FACTORIES: Dict[str, Callable[[], Embeddings]] = {}
+# プロバイダー名 -> 埋め込みキャッシュのキーに使うモデル名
+_EMBEDDING_MODEL_NAMES: Dict[str, Callable[[], str]] = {}
+
+def register_chat_model(name: str, factory: Callable[[float], BaseChatModel]) -> None:
+    """チャットモデルのプロバイダーを登録（factory は temperature を受け取る）"""
+    _CHAT_MODEL_FACTORIES[name] = factory
+
+def register_embeddings(name: str, factory: Callable[[], Embeddings], model_name: Callable[[], str]) -> None:
+    """埋め込みのプロバイダーを登録"""
+    _EMBEDDING_FACTORIES[name] = factory
+    _EMBEDDING_MODEL_NAMES[name] = model_name
+
+def create_chat_model(temperature: float = config.TEMPERATURE,
+                      provider: str = config.LLM_PROVIDER) -> BaseChatModel:
+    """設定で選んだプロバイダーのチャットモデルを作成"""
+    if provider not in _CHAT_MODEL_FACTORIES:
+        raise ValueError(f"サポートされていないLLMプロバイダー: {provider}")
+    return _CHAT_MODEL_FACTORIES[provider](temperature)
+
+def create_embeddings(provider: str = config.EMBEDDING_PROVIDER) -> Embeddings:
+    """設定で選んだプロバイダーの埋め込みクライアントを作成"""
+    if provider not in _EMBEDDING_FACTORIES:
+        raise ValueError(f"サポートされていない埋め込みプロバイダー: {provider}")
+    return _EMBEDDING_FACTORIES[provider]()
+
+def get_embedding_model_name(provider: str = config.EMBEDDING_PROVIDER) -> str:
+    """埋め込みキャッシュのキーに使うモデル名（プロバイダーが違えば別のキーになる）"""
+    if provider not in _EMBEDDING_MODEL_NAMES:
+        raise ValueError(f"サポートされていない埋め込みプロバイダー: {provider}")
+    return _EMBEDDING_MODEL_NAMES[provider]()
+
+
+def _openai_chat_model(temperature: float) -> BaseChatModel:
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        openai_api_key=config.OPENAI_API_KEY,
+        model_name=config.MODEL_NAME,
+        temperature=temperature
+    )
+
+def _openai_embeddings() -> Embeddings:
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(openai_api_key=config.OPENAI_API_KEY, model=config.EMBEDDING_MODEL)
+
+def _fake_chat_model(temperature: float) -> BaseChatModel:
+    from .local import FakeChatModel
+    return FakeChatModel()
+
+def _hashing_embeddings() -> Embeddings:
+    from .local import HashingEmbeddings
+    return HashingEmbeddings()
+
+
+register_chat_model("openai", _openai_chat_model)
+register_chat_model("fake", _fake_chat_model)
+register_embeddings("openai", _openai_embeddings, lambda: config.EMBEDDING_MODEL)
+register_embeddings("hashing", _hashing_embeddings, lambda: f"hashing-{config.HASHING_EMBEDDING_DIMENSION}")
@@ -0,0 +1,134 @@
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Sequence
+import numpy as np
+import config
+
+class AnswerCache:
+    """正規化したクエリ・検索したコレクション・検索されたチャンクIDの組をキーにしたRAG回答のキャッシュ
+
+    similarity_threshold を指定すると、キーが一致しなくても同じコレクション・チャンク集合に対する
+    クエリ埋め込みのコサイン類似度が閾値以上のエントリを返す（表記ゆれ・言い換え対策）。
+    エントリは保存時のコーパスのバージョンと異なるバージョンで引かれると破棄する
+    （バージョンは検索したコレクションごとに決まるため、他のコレクションの変更では破棄しない）。
+    類似検索のためにエントリを (コレクション, チャンク集合) ごとにまとめ、正規化したクエリ埋め込みを保持する。
+    """
+
+    def __init__(self, max_entries: int = config.ANSWER_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = config.ANSWER_CACHE_TTL_SECONDS,
+                 similarity_threshold: Optional[float] = config.ANSWER_CACHE_SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._scopes = {}  # (コレクション, チャンク集合) -> そのスコープのエントリのキー（順序付き集合）
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """全角半角・大文字小文字・空白・末尾の記号の違いを吸収"""
+        text = unicodedata.normalize("NFKC", query).lower()
+        text = re.sub(r"\s+", " ", text).strip()
+        return text.rstrip("?!.。、 ")
+
+    @staticmethod
+    def _make_key(normalized_query: str, collections: Sequence[str], chunk_ids: List[str]) -> tuple:
+        return (normalized_query, tuple(sorted(collections)), frozenset(chunk_ids))
+
+    def _is_expired(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["created_at"] > self.ttl_seconds
+
+    def get(self, query: str, chunk_ids: List[str], corpus_version,
+            query_vector: Optional[List[float]] = None,
+            collections: Sequence[str] = ()) -> Optional[Dict[str, Any]]:
+        """キャッシュされた回答を取得（無ければNone）"""
+        key = self._make_key(self.normalize_query(query), collections, chunk_ids)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self.similarity_threshold is not None and query_vector is not None:
+                entry_key = self._find_similar(key[1:], corpus_version, query_vector)
+                entry = self._entries.get(entry_key) if entry_key else None
+                key = entry_key or key
+
+            if entry is None or self._is_expired(entry) or entry["corpus_version"] != corpus_version:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["response"]
+
+    def _find_similar(self, scope: tuple, corpus_version, query_vector: List[float]) -> Optional[tuple]:
+        """同じコレクション・チャンク集合・コーパスのバージョンのエントリのうち、クエリ埋め込みが最も近いものを探す"""
+        query = self._normalize_vector(query_vector)
+        if query is None:
+            return None
+
+        candidates = [key for key in self._scopes.get(scope, ())
+                      if self._entries[key]["query_vector"] is not None
+                      and self._entries[key]["corpus_version"] == corpus_version]
+        if not candidates:
+            return None
+
+        # 保存時に正規化しているため、内積がそのままコサイン類似度になる
+        similarities = np.stack([self._entries[key]["query_vector"] for key in candidates]) @ query
+        best = int(np.argmax(similarities))
+        return candidates[best] if similarities[best] >= self.similarity_threshold else None
+
+    @staticmethod
+    def _normalize_vector(vector: Optional[List[float]]) -> Optional[np.ndarray]:
+        if vector is None:
+            return None
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def _remove(self, key: tuple) -> None:
+        """エントリをスコープの索引からも削除（ロックを保持して呼ぶ）"""
+        del self._entries[key]
+        keys = self._scopes.get(key[1:])
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._scopes[key[1:]]
+
+    def put(self, query: str, chunk_ids: List[str], corpus_version, response: Dict[str, Any],
+            query_vector: Optional[List[float]] = None, collections: Sequence[str] = ()) -> None:
+        """回答をキャッシュし、上限を超えたら最も使われていないものから削除"""
+        key = self._make_key(self.normalize_query(query), collections, chunk_ids)
+        with self._lock:
+            self._entries[key] = {
+                "response": response,
+                "corpus_version": corpus_version,
+                "created_at": time.time(),
+                "query_vector": self._normalize_vector(query_vector)
+            }
+            self._entries.move_to_end(key)
+            self._scopes.setdefault(key[1:], {})[key] = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """全てのエントリを削除"""
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ヒット・ミスなどの統計情報を取得"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries
+        }
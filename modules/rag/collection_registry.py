@@ -0,0 +1,263 @@
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from langchain.docstore.document import Document
+from .vector_store import VectorStore
+from .embedding_cache import EmbeddingCache, CachedEmbeddings
+from .segment_store import SegmentStore
+from .lexical_index import reciprocal_rank_fusion
+from modules.providers.registry import create_embeddings, get_embedding_model_name
+import config
+
+# コレクション名はディレクトリ名にそのまま使うため、英数字・アンダースコア・ハイフンに限る
+_NAME_PATTERN = re.compile(r"[\w\-]{1,64}", re.ASCII)
+
+
+class CollectionRegistry:
+    """名前付きのコレクション（テナント・部署ごとのベクトルインデックス）の管理
+
+    コレクションは最初に使われたときにディスクから読み込み、読み込み済みの数が
+    max_loaded を、常駐メモリの概算が memory_budget_bytes を超えると最も使われていないものから解放する
+    （解放したコレクションは次に使われたときに読み込み直す）。埋め込みクライアントとキャッシュは全コレクションで共有する。
+    """
+
+    def __init__(self, default: str = config.DEFAULT_COLLECTION,
+                 collections_dir: str = config.COLLECTIONS_DIR,
+                 max_loaded: int = config.COLLECTION_MAX_LOADED,
+                 memory_budget_bytes: Optional[int] = config.COLLECTION_MEMORY_BUDGET_BYTES,
+                 search_workers: int = config.COLLECTION_SEARCH_WORKERS):
+        self.default = self.validate_name(default)
+        self.collections_dir = collections_dir
+        self.max_loaded = max(1, max_loaded)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.embeddings = CachedEmbeddings(
+            create_embeddings(),
+            model_name=get_embedding_model_name(),
+            cache=EmbeddingCache()
+        )
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._loaded = OrderedDict()
+        # 読み込み直したコレクションを区別する番号（回答キャッシュの無効化に使う）
+        self._load_seq = {}
+        self._load_locks = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="collection-search")
+
+    @staticmethod
+    def validate_name(name: str) -> str:
+        """コレクション名を検証（使えない名前は ValueError）"""
+        if not isinstance(name, str) or not _NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"コレクション名には英数字・アンダースコア・ハイフン（64文字まで）を使ってください: {name!r}")
+        return name
+
+    def path_for(self, name: str) -> str:
+        """コレクションの保存先（既定のコレクションは従来どおり VECTOR_STORE_PATH）"""
+        if name == self.default:
+            return config.VECTOR_STORE_PATH
+        return os.path.join(self.collections_dir, name)
+
+    def exists(self, name: str) -> bool:
+        """読み込み済みか、ディスクに保存されているかを確認（既定のコレクションは常に存在する）"""
+        if name == self.default:
+            return True
+        with self._lock:
+            if name in self._loaded:
+                return True
+        return os.path.exists(os.path.join(self.path_for(name), SegmentStore.MANIFEST_NAME))
+
+    def names(self) -> List[str]:
+        """既存のコレクション名の一覧（既定のコレクションを先頭に置く）"""
+        found = set()
+        if os.path.isdir(self.collections_dir):
+            for entry in os.listdir(self.collections_dir):
+                if _NAME_PATTERN.fullmatch(entry) and entry != self.default and self.exists(entry):
+                    found.add(entry)
+        with self._lock:
+            found.update(name for name in self._loaded if name != self.default)
+        return [self.default] + sorted(found)
+
+    def resolve(self, names: Optional[List[str]] = None) -> List[str]:
+        """検索対象のコレクション名（省略時は既定のコレクション、重複は除く）"""
+        if not names:
+            return [self.default]
+        return list(dict.fromkeys(self.validate_name(name) for name in names))
+
+    def get(self, name: Optional[str] = None) -> VectorStore:
+        """コレクションを取得（読み込まれていなければディスクから読み込み、存在しなければ空で作成）"""
+        name = self.validate_name(name or self.default)
+        with self._lock:
+            store = self._loaded.get(name)
+            if store is not None:
+                self._loaded.move_to_end(name)
+                self.hits += 1
+                return store
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # 読み込みは時間がかかるため、同じコレクションの読み込みだけを排他する
+        with load_lock:
+            with self._lock:
+                store = self._loaded.get(name)
+                if store is not None:
+                    self._loaded.move_to_end(name)
+                    self.hits += 1
+                    return store
+            store = VectorStore(self.path_for(name), embeddings=self.embeddings)
+            store.load_vector_store()
+            with self._lock:
+                self._loaded[name] = store
+                self._load_seq[name] = self._load_seq.get(name, 0) + 1
+                self.loads += 1
+                self._evict(keep=name)
+        return store
+
+    def trim(self, keep: Optional[str] = None) -> None:
+        """取り込みで大きくなったコレクションがあれば、上限に収まるまで解放"""
+        with self._lock:
+            self._evict(keep=keep or self.default)
+
+    def _evict(self, keep: str) -> None:
+        """上限を超えた分を最も使われていないものから解放（ロックを保持して呼ぶ）"""
+        while len(self._loaded) > 1:
+            over_count = len(self._loaded) > self.max_loaded
+            over_budget = (self.memory_budget_bytes is not None
+                           and self._estimated_bytes() > self.memory_budget_bytes)
+            if not over_count and not over_budget:
+                return
+            name = next(name for name in self._loaded if name != keep)
+            # 解放中の検索・取り込みは保持している参照で最後まで行われる
+            del self._loaded[name]
+            self.evictions += 1
+            print(f"コレクション {name} をメモリから解放しました")
+
+    def _estimated_bytes(self) -> float:
+        return sum(self._store_bytes(store) for store in self._loaded.values())
+
+    @staticmethod
+    def _store_bytes(store: VectorStore) -> float:
+        """チャンクあたりの常駐メモリの概算 × チャンク数"""
+        report = store.get_memory_report()
+        return report.get("bytes_per_chunk_after", 0.0) * store.get_document_count()
+
+    def has_documents(self, names: Optional[List[str]] = None) -> bool:
+        """対象のコレクションのどれかに文書があるかを確認（存在しないコレクションは作成しない）"""
+        return any(self.exists(name) and self.get(name).vector_store is not None for name in self.resolve(names))
+
+    def get_document_count(self, names: Optional[List[str]] = None) -> int:
+        """対象のコレクションの文書チャンク数の合計"""
+        return sum(self.get(name).get_document_count() for name in self.resolve(names) if self.exists(name))
+
+    def corpus_version(self, names: Optional[List[str]] = None) -> Tuple:
+        """対象のコレクションそれぞれのコーパスのバージョン（回答キャッシュの無効化に使う）
+
+        読み込み直したコレクションは番号が変わるため、解放前にキャッシュした回答は使わない。
+        読み込まれていないコレクションは文書がないものとして扱う。
+        """
+        version = []
+        with self._lock:
+            for name in sorted(self.resolve(names)):
+                store = self._loaded.get(name)
+                version.append((name, self._load_seq.get(name, 0), store.corpus_version if store is not None else 0))
+        return tuple(version)
+
+    def search(self, query: str, embedding: Optional[List[float]], k: int = config.TOP_K_DOCUMENTS,
+               names: Optional[List[str]] = None, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None) -> List[Tuple[Document, float]]:
+        """対象のコレクションをハイブリッド検索（複数の場合は横断して統合した上位k件）"""
+        return self.search_batch([query], [embedding], k=k, names=names, nprobe=nprobe, ef_search=ef_search)[0]
+
+    def search_batch(self, queries: List[str], embeddings: List[Optional[List[float]]],
+                     k: int = config.TOP_K_DOCUMENTS, names: Optional[List[str]] = None,
+                     nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None) -> List[List[Tuple[Document, float]]]:
+        """複数のクエリを対象のコレクションでハイブリッド検索
+
+        コレクションが1つならその検索結果をそのまま返す。複数の場合はコレクションごとに並列に検索し、
+        順位を Reciprocal Rank Fusion で統合した上位k件を、メタデータに "collection" を付けて返す。
+        nprobe（IVF系）/ ef_search（HNSW）を指定すると、各コレクションのベクトル検索にその値を使う。
+        """
+        names = [name for name in self.resolve(names) if self.exists(name)]
+        stores = [(name, self.get(name)) for name in names]
+        stores = [(name, store) for name, store in stores if store.vector_store is not None]
+        if not stores:
+            return [[] for _ in queries]
+        if len(stores) == 1:
+            return stores[0][1].hybrid_search_by_vectors_with_score(queries, embeddings, k=k, nprobe=nprobe,
+                                                                     ef_search=ef_search)
+
+        futures = [(name, self._executor.submit(store.hybrid_search_by_vectors_with_score, queries, embeddings, k,
+                                                nprobe, ef_search))
+                   for name, store in stores]
+        per_collection = [(name, future.result()) for name, future in futures]
+
+        results = []
+        for index in range(len(queries)):
+            documents = {}
+            rankings = []
+            for name, found in per_collection:
+                ranking = []
+                for doc, _ in found[index]:
+                    # 同じファイルを複数のコレクションに入れた場合もチャンクを区別する
+                    key = (name, doc.metadata.get("chunk_id") or doc.page_content)
+                    documents[key] = doc
+                    ranking.append(key)
+                rankings.append(ranking)
+            merged = []
+            for key, score in reciprocal_rank_fusion(rankings)[:k]:
+                doc = documents[key]
+                merged.append((Document(page_content=doc.page_content,
+                                        metadata={**doc.metadata, "collection": key[0]}), score))
+            results.append(merged)
+        return results
+
+    def refresh_loaded(self) -> bool:
+        """読み込み済みのコレクションのうち、他のプロセスが変更したものを読み直す"""
+        with self._lock:
+            stores = list(self._loaded.values())
+        return any([store.refresh_if_changed() for store in stores])
+
+    def wait_for_compaction(self) -> None:
+        """読み込み済みのコレクションで実行中のコンパクションの完了を待つ"""
+        with self._lock:
+            stores = list(self._loaded.values())
+        for store in stores:
+            store.segment_store.wait_for_compaction()
+
+    def clear(self, name: Optional[str] = None) -> None:
+        """コレクションの文書を全て削除"""
+        self.get(name).clear_vector_store()
+
+    def delete(self, name: str) -> None:
+        """コレクションを削除（既定のコレクションは文書を削除するだけで残す）"""
+        name = self.validate_name(name)
+        if name == self.default:
+            self.clear(name)
+            return
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                store = self._loaded.pop(name, None)
+            if store is not None:
+                store.segment_store.wait_for_compaction()
+            shutil.rmtree(self.path_for(name), ignore_errors=True)
+        print(f"コレクション {name} を削除しました")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """読み込み済みのコレクションとキャッシュの統計情報"""
+        with self._lock:
+            loaded = list(self._loaded.items())
+            stats = {"hits": self.hits, "loads": self.loads, "evictions": self.evictions}
+        return {
+            "loaded": [{"name": name, "document_count": store.get_document_count(),
+                        "estimated_bytes": round(self._store_bytes(store))}
+                       for name, store in loaded],
+            "max_loaded": self.max_loaded,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            **stats
+        }
@@ -0,0 +1,155 @@
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+from modules.core.tokens import count_tokens
+from .lexical_index import term_ids
+import config
+
+_SEPARATOR = "\n\n"
+
+
+def get_token_budget(model: str = config.MODEL_NAME) -> int:
+    """モデルごとの参考文書のトークン数の上限（前方一致する最も長いモデル名の設定を使う）"""
+    names = [name for name in config.CONTEXT_TOKEN_BUDGETS if model.startswith(name)]
+    if not names:
+        return config.CONTEXT_DEFAULT_TOKEN_BUDGET
+    return config.CONTEXT_TOKEN_BUDGETS[max(names, key=len)]
+
+
+class OverlapReranker:
+    """質問の検索語（文字n-gram・英数字の単語）をどれだけ含むかで並べ替える（追加のモデルが不要）"""
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        query_terms = np.unique(term_ids(query))
+        if len(query_terms) == 0:
+            return [0.0] * len(texts)
+        return [float(np.isin(query_terms, term_ids(text)).mean()) for text in texts]
+
+
+class CrossEncoderReranker:
+    """質問とチャンクの組をまとめて採点するローカルのクロスエンコーダー（sentence-transformers）"""
+
+    def __init__(self, model_name: str = config.CROSS_ENCODER_MODEL):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name)
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        return [float(score) for score in self.model.predict([(query, text) for text in texts])]
+
+
+@lru_cache(maxsize=None)
+def get_reranker(name: Optional[str]):
+    """設定名に対応するリランカー（読み込めない場合はNoneで、検索順のまま使う）"""
+    if name is None:
+        return None
+    rerankers = {"overlap": OverlapReranker, "cross_encoder": CrossEncoderReranker}
+    if name not in rerankers:
+        raise ValueError(f"サポートされていないリランカー: {name}")
+    try:
+        return rerankers[name]()
+    except Exception as e:
+        print(f"リランカーを読み込めないため、検索順のまま使います: {e}")
+        return None
+
+
+def _format_document(doc: Document, text: str) -> str:
+    return f"【出典: {doc.metadata.get('source', '不明')} - ページ{doc.metadata.get('page', '不明')}】\n{text}"
+
+def _trim_overlap(text: str, other: str, min_chars: int) -> str:
+    """同じ出典の隣のチャンク other と重なっている先頭・末尾を text から取り除く
+
+    チャンクは CHUNK_OVERLAP 文字まで前後と重なって分割されるため、その範囲だけを調べる。
+    """
+    limit = min(len(text), len(other), config.CHUNK_OVERLAP)
+    for size in range(limit, min_chars - 1, -1):
+        if other.endswith(text[:size]):
+            return text[size:]
+    for size in range(limit, min_chars - 1, -1):
+        if other.startswith(text[-size:]):
+            return text[:-size]
+    return text
+
+
+class ContextBuilder:
+    """検索結果からプロンプトに入れる参考文書を作成
+
+    多めに取得した候補を（設定されていれば）リランカーで並べ替え、重複するチャンクを除き、
+    同じ出典で前後と重なる部分を取り除いてから、関連の高い順にトークン数の上限まで詰める。
+    """
+
+    def __init__(self, model: str = config.MODEL_NAME, max_tokens: Optional[int] = None,
+                 max_documents: int = config.CONTEXT_MAX_DOCUMENTS,
+                 reranker: Optional[str] = config.CONTEXT_RERANKER,
+                 duplicate_threshold: float = config.CONTEXT_DUPLICATE_THRESHOLD,
+                 min_overlap_chars: int = config.CONTEXT_MIN_OVERLAP_CHARS):
+        self.model = model
+        self.max_tokens = max_tokens if max_tokens is not None else get_token_budget(model)
+        self.max_documents = max_documents
+        self.reranker = get_reranker(reranker)
+        self.duplicate_threshold = duplicate_threshold
+        self.min_overlap_chars = min_overlap_chars
+
+    def build(self, query: str, scored_docs: List[Tuple[Document, float]]) -> Dict[str, Any]:
+        """参考文書の文字列と、実際に入れた (Document, 検索スコア) のリストを返す"""
+        candidates = list(scored_docs)
+        if self.reranker is not None and len(candidates) > 1:
+            scores = self.reranker.score(query, [doc.page_content for doc, _ in candidates])
+            order = sorted(range(len(candidates)), key=lambda index: -scores[index])
+            candidates = [candidates[index] for index in order]
+
+        separator_tokens = count_tokens(_SEPARATOR, self.model)
+        blocks, documents, selected_terms = [], [], []
+        tokens = duplicates = trimmed = over_budget = 0
+        for doc, score in candidates:
+            if len(documents) >= self.max_documents:
+                break
+            terms = np.unique(term_ids(doc.page_content))
+            if self._is_duplicate(terms, selected_terms):
+                duplicates += 1
+                continue
+
+            text = doc.page_content
+            for selected, _ in documents:
+                if selected.metadata.get("source") == doc.metadata.get("source"):
+                    text = _trim_overlap(text, selected.page_content, self.min_overlap_chars)
+            if not text.strip():
+                duplicates += 1
+                continue
+
+            block = _format_document(doc, text)
+            block_tokens = count_tokens(block, self.model) + (separator_tokens if blocks else 0)
+            if tokens + block_tokens > self.max_tokens:
+                if blocks:
+                    # 入りきらないチャンクは飛ばし、後ろの短いチャンクで残りを埋める
+                    over_budget += 1
+                    continue
+                # 最も関連の高いチャンクだけで上限を超える場合は、上限に収まる長さに切り詰める
+                while block_tokens > self.max_tokens and text:
+                    text = text[:len(text) * self.max_tokens // (block_tokens + 1)]
+                    block = _format_document(doc, text)
+                    block_tokens = count_tokens(block, self.model)
+
+            if text != doc.page_content:
+                trimmed += 1
+            blocks.append(block)
+            documents.append((doc, score))
+            selected_terms.append(terms)
+            tokens += block_tokens
+
+        return {
+            "context": _SEPARATOR.join(blocks),
+            "documents": documents,
+            "tokens": tokens,
+            "candidates": len(candidates),
+            "duplicates": duplicates,
+            "trimmed": trimmed,
+            "over_budget": over_budget
+        }
+
+    def _is_duplicate(self, terms: np.ndarray, selected_terms: List[np.ndarray]) -> bool:
+        """検索語の大部分が、既に選んだいずれかのチャンクに含まれるか"""
+        if len(terms) == 0:
+            return False
+        return any(len(np.intersect1d(terms, other, assume_unique=True)) / len(terms) >= self.duplicate_threshold
+                   for other in selected_terms)
@@ -1,28 +1,39 @@
 import os
-import pandas as pd
-from typing import List, Dict, Any
-from PyPDF2 import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from langchain.docstore.document import Document
 import config
 
+# pandas・PyPDF2・テキスト分割は文書の取り込み時にだけ使うため、起動を速くするよう使うときに読み込む
+
 class DocumentProcessor:
     def __init__(self):
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=config.CHUNK_SIZE,
-            chunk_overlap=config.CHUNK_OVERLAP,
-            length_function=len,
-        )
-
-    def process_pdf(self, file_path: str) -> List[Document]:
-        """PDFファイルを処理してDocumentオブジェクトのリストを返す"""
+        self._text_splitter = None
+
+    @property
+    def text_splitter(self):
+        if self._text_splitter is None:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+            self._text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=config.CHUNK_SIZE,
+                chunk_overlap=config.CHUNK_OVERLAP,
+                length_function=len,
+            )
+        return self._text_splitter
+
+    def process_pdf(self, file_path: str, page_range: Optional[Tuple[int, int]] = None) -> List[Document]:
+        """PDFファイルを処理してDocumentオブジェクトのリストを返す
+
+        page_range に (開始, 終了) を指定すると、そのページ範囲だけを処理する（終了は含まない）。
+        """
+        from PyPDF2 import PdfReader
         documents = []
         try:
             reader = PdfReader(file_path)
             filename = os.path.basename(file_path)
+            start, end = page_range or (0, len(reader.pages))
 
-            for page_num, page in enumerate(reader.pages):
-                text = page.extract_text()
+            for page_num in range(start, min(end, len(reader.pages))):
+                text = reader.pages[page_num].extract_text()
                 if text.strip():
                     doc = Document(
                         page_content=text,
@@ -59,38 +70,136 @@ class DocumentProcessor:
 
         return self._split_documents(documents)
 
-    def process_csv(self, file_path: str) -> List[Document]:
-        """CSVファイルを処理してDocumentオブジェクトのリストを返す"""
+    def process_csv(self, file_path: str, one_chunk_per_row: bool = config.CSV_ONE_CHUNK_PER_ROW) -> List[Document]:
+        """CSVファイルを処理してDocumentオブジェクトのリストを返す
+
+        既定では複数行を CHUNK_SIZE までまとめて1チャンクにし、行範囲をメタデータに残す。
+        one_chunk_per_row=True の場合は従来通り1行1チャンクにする。
+        """
         documents = []
+        for block in self.iter_csv(file_path, one_chunk_per_row):
+            documents.extend(block)
+        return documents
+
+    def iter_csv(self, file_path: str,
+                 one_chunk_per_row: bool = config.CSV_ONE_CHUNK_PER_ROW) -> Iterator[List[Document]]:
+        """CSVファイルを CSV_READ_CHUNK_ROWS 行ずつ処理し、読み込んだ範囲のDocumentのリストを順に返す
+
+        全体のDocumentを保持しないため、メモリに収まらない大きさのCSVも一定のメモリで処理できる。
+        """
+        import pandas as pd
         try:
             filename = os.path.basename(file_path)
-            df = pd.read_csv(file_path)
+            reader = pd.read_csv(file_path, dtype=str, keep_default_na=False,
+                                 chunksize=config.CSV_READ_CHUNK_ROWS)
+            for frame in reader:
+                texts = self._rows_to_text(frame)
+                if one_chunk_per_row:
+                    yield self._split_documents([
+                        Document(
+                            page_content=text,
+                            metadata={
+                                "source": filename,
+                                "page": index + 1,
+                                "file_type": "csv",
+                                "row_index": index
+                            }
+                        )
+                        for index, text in zip(frame.index.tolist(), texts.tolist())
+                    ])
+                else:
+                    yield self._group_rows(texts, filename)
+        except Exception as e:
+            print(f"CSV処理中にエラーが発生しました: {e}")
+
+    def _rows_to_text(self, frame: "pd.DataFrame") -> "pd.Series":
+        """各行を「列名: 値」を改行で連結した文字列に変換（列単位でまとめて処理）"""
+        import pandas as pd
+        text = None
+        for column in frame.columns:
+            part = f"{column}: " + frame[column]
+            text = part if text is None else text + "\n" + part
+        if text is None:
+            return pd.Series([], dtype=str)
+        return text
+
+    def _group_rows(self, texts: "pd.Series", filename: str) -> List[Document]:
+        """連続する行を CHUNK_SIZE を超えない範囲でまとめて1つのDocumentにする"""
+        separator = "\n\n"
+        row_texts = texts.tolist()
+        row_indices = texts.index.tolist()
+        lengths = (texts.str.len() + len(separator)).tolist()
+
+        documents = []
+        group_start = 0
+        group_length = 0
+        for position, length in enumerate(lengths + [None]):
+            if position < len(lengths) and (group_length == 0 or group_length + length <= config.CHUNK_SIZE):
+                group_length += length
+                continue
 
-            # CSVの各行をテキストとして変換
-            for index, row in df.iterrows():
-                text_content = "\n".join([f"{col}: {row[col]}" for col in df.columns])
+            if group_length > 0:
+                first_row = row_indices[group_start]
+                last_row = row_indices[position - 1]
                 doc = Document(
-                    page_content=text_content,
+                    page_content=separator.join(row_texts[group_start:position]),
                     metadata={
                         "source": filename,
-                        "page": index + 1,
+                        "page": first_row + 1,
                         "file_type": "csv",
-                        "row_index": index
+                        "row_start": first_row,
+                        "row_end": last_row,
+                        "rows": f"{first_row + 1}-{last_row + 1}"
                     }
                 )
-                documents.append(doc)
-        except Exception as e:
-            print(f"CSV処理中にエラーが発生しました: {e}")
+                # 1行だけで CHUNK_SIZE を超える場合は通常の分割を行う
+                if group_length - len(separator) > config.CHUNK_SIZE:
+                    documents.extend(self._split_documents([doc]))
+                else:
+                    documents.append(doc)
 
-        return self._split_documents(documents)
+            group_start = position
+            group_length = length or 0
+
+        return documents
 
     def _split_documents(self, documents: List[Document]) -> List[Document]:
         """文書を指定されたチャンクサイズに分割"""
         return self.text_splitter.split_documents(documents)
 
+    def count_pdf_pages(self, file_path: str) -> int:
+        """PDFのページ数を取得"""
+        from PyPDF2 import PdfReader
+        return len(PdfReader(file_path).pages)
+
+    @staticmethod
+    def get_file_type(filename: str) -> str:
+        """ファイル名から拡張子（小文字）を取得"""
+        return filename.split('.')[-1].lower()
+
+    def save_uploaded_file(self, uploaded_file, directory: str) -> str:
+        """アップロードされたファイルを元のファイル名のまま保存し、パスを返す"""
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, os.path.basename(uploaded_file.name))
+        with open(file_path, "wb") as f:
+            f.write(uploaded_file.getbuffer())
+        return file_path
+
+    def process_file(self, file_path: str, file_type: str,
+                     page_range: Optional[Tuple[int, int]] = None) -> List[Document]:
+        """保存済みのファイルを種類に応じて処理"""
+        if file_type == 'pdf':
+            return self.process_pdf(file_path, page_range)
+        elif file_type == 'txt':
+            return self.process_txt(file_path)
+        elif file_type == 'csv':
+            return self.process_csv(file_path)
+        else:
+            raise ValueError(f"サポートされていないファイル形式: {file_type}")
+
     def process_uploaded_file(self, uploaded_file) -> List[Document]:
         """Streamlitでアップロードされたファイルを処理"""
-        file_extension = uploaded_file.name.split('.')[-1].lower()
+        file_extension = self.get_file_type(uploaded_file.name)
 
         # 一時ファイルとして保存
         temp_file_path = f"./data/temp_{uploaded_file.name}"
@@ -100,16 +209,7 @@ class DocumentProcessor:
             f.write(uploaded_file.getbuffer())
 
         try:
-            if file_extension == 'pdf':
-                documents = self.process_pdf(temp_file_path)
-            elif file_extension == 'txt':
-                documents = self.process_txt(temp_file_path)
-            elif file_extension == 'csv':
-                documents = self.process_csv(temp_file_path)
-            else:
-                raise ValueError(f"サポートされていないファイル形式: {file_extension}")
-
-            return documents
+            return self.process_file(temp_file_path, file_extension)
         finally:
             # 一時ファイルを削除
             if os.path.exists(temp_file_path):
@@ -0,0 +1,211 @@
+import os
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+import config
+
+class EmbeddingCache:
+    """(埋め込みモデル, チャンク本文) のハッシュをキーにしたディスク上の埋め込みキャッシュ
+
+    ヒットしたキーのアクセス時刻はメモリにためておき、一定件数か一定時間ごとに（または保存時に）まとめて書き込む。
+    件数は読み込み時に数えた値を増減させて管理し、上限を超えたときだけ数え直す。
+    """
+
+    def __init__(self, path: str = config.EMBEDDING_CACHE_PATH,
+                 max_entries: int = config.EMBEDDING_CACHE_MAX_ENTRIES,
+                 access_flush_entries: int = config.EMBEDDING_CACHE_ACCESS_FLUSH_ENTRIES,
+                 access_flush_seconds: float = config.EMBEDDING_CACHE_ACCESS_FLUSH_SECONDS):
+        self.path = path
+        self.max_entries = max_entries
+        self.access_flush_entries = access_flush_entries
+        self.access_flush_seconds = access_flush_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending_access = {}
+        self._last_flush = time.monotonic()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)"
+        )
+        self._conn.commit()
+        self._entry_count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """モデル名とテキストからキャッシュキーを生成"""
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """キャッシュ済みのベクトルを取得（ヒットしたキーのアクセス時刻は後でまとめて更新）"""
+        found = {}
+        if not keys:
+            return found
+
+        with self._lock:
+            unique_keys = list(dict.fromkeys(keys))
+            # SQLiteの変数上限を超えないように分割して問い合わせる
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+            if found:
+                now = time.time()
+                self._pending_access.update((key, now) for key in found)
+                if (len(self._pending_access) >= self.access_flush_entries
+                        or time.monotonic() - self._last_flush >= self.access_flush_seconds):
+                    self._flush_access()
+                    self._conn.commit()
+
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """ベクトルを保存し、上限を超えた分を古い順に削除"""
+        if not items:
+            return
+
+        with self._lock:
+            now = time.time()
+            # 同じキーのベクトルは同じ内容のため、既存の行は書き換えずにアクセス時刻だけを更新する
+            inserted = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                 for key, vector in items.items()]
+            ).rowcount
+            self._entry_count += max(inserted, 0)
+            if inserted < len(items):
+                self._pending_access.update((key, now) for key in items)
+            # 削除する順番が正しくなるよう、ためておいたアクセス時刻を先に書き込む
+            self._flush_access()
+            self._evict()
+            self._conn.commit()
+
+    def _flush_access(self) -> None:
+        """ためておいたアクセス時刻を書き込む（ロックを保持して呼び、コミットは呼び出し側で行う）"""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._pending_access.items()]
+            )
+            self._pending_access = {}
+        self._last_flush = time.monotonic()
+
+    def _evict(self) -> None:
+        """LRUで上限件数までエントリを削除"""
+        if self._entry_count <= self.max_entries:
+            return
+        # 他のプロセスと共有している場合もあるため、削除する前に実際の件数を数え直す
+        self._entry_count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = self._entry_count - self.max_entries
+        if overflow > 0:
+            deleted = self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            ).rowcount
+            self._entry_count -= deleted
+
+    def get_entry_count(self) -> int:
+        """キャッシュされているベクトル数を取得"""
+        with self._lock:
+            return self._entry_count
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ヒット・ミスなどの統計情報を取得"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.get_entry_count(),
+            "max_entries": self.max_entries
+        }
+
+    def clear(self) -> None:
+        """キャッシュを全て削除"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._pending_access = {}
+            self._entry_count = 0
+            self.hits = 0
+            self.misses = 0
+
+
+class CachedEmbeddings(Embeddings):
+    """埋め込みクライアントの前段に置き、キャッシュミス分だけをまとめてAPIに送る"""
+
+    def __init__(self, embeddings: Embeddings, model_name: str,
+                 cache: Optional[EmbeddingCache] = None,
+                 batch_size: int = config.EMBEDDING_BATCH_SIZE):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache or EmbeddingCache()
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """文書の埋め込みを取得（キャッシュヒット分はAPIを呼ばない）"""
+        keys = [EmbeddingCache.make_key(self.model_name, text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # 同一バッチ内の重複テキストも一度だけ埋め込む
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            missing_keys = list(missing.keys())
+            new_vectors = {}
+            for i in range(0, len(missing_keys), self.batch_size):
+                batch_keys = missing_keys[i:i + self.batch_size]
+                vectors = self.embeddings.embed_documents([missing[key] for key in batch_keys])
+                new_vectors.update(zip(batch_keys, vectors))
+            self.cache.put_many(new_vectors)
+            cached.update(new_vectors)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        """クエリの埋め込みを取得"""
+        key = EmbeddingCache.make_key(self.model_name, text)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            return cached[key]
+
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many({key: vector})
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """クエリの埋め込みを非同期で取得（キャッシュミス時だけAPIを待つ）
+
+        キャッシュの読み書きはSQLiteのI/Oを伴うため、イベントループを止めないようスレッドで行う。
+        """
+        key = EmbeddingCache.make_key(self.model_name, text)
+        cached = await asyncio.to_thread(self.cache.get_many, [key])
+        if key in cached:
+            return cached[key]
+
+        vector = await self.embeddings.aembed_query(text)
+        await asyncio.to_thread(self.cache.put_many, {key: vector})
+        return vector
@@ -0,0 +1,134 @@
+import math
+from typing import Optional, Tuple
+import numpy as np
+import faiss
+import config
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+QUANTIZATION_TYPES = (None, "sq8", "pq")
+
+def select_index_type(chunk_count: int, index_type: str = config.INDEX_TYPE) -> str:
+    """設定とチャンク数から使用するインデックスの種類を決定"""
+    if index_type != "auto":
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"サポートされていないインデックス種別: {index_type}")
+        return index_type
+
+    # 閾値は昇順に並んでいる前提で、最初に収まる種別を選ぶ
+    for threshold, candidate in config.INDEX_AUTO_THRESHOLDS:
+        if chunk_count < threshold:
+            return candidate
+    return config.INDEX_AUTO_THRESHOLDS[-1][1]
+
+def _nlist_for(count: int) -> int:
+    """IVFのクラスタ数（学習データが各クラスタ39件以上になるよう制限）"""
+    nlist = config.IVF_NLIST or int(4 * math.sqrt(max(count, 1)))
+    return max(1, min(nlist, count // 39))
+
+def _pq_m_for(dim: int) -> int:
+    """次元数を割り切れる範囲で最大のPQサブベクトル数"""
+    m = min(config.PQ_M, dim)
+    while dim % m != 0:
+        m -= 1
+    return m
+
+def build_index(index_type: str, vectors: np.ndarray,
+                quantization: Optional[str] = config.VECTOR_QUANTIZATION) -> Tuple[faiss.Index, str, Optional[str]]:
+    """指定した種別のFAISSインデックスを作成し、必要なら学習する（ベクトルは追加しない）
+
+    quantization に "sq8"（int8スカラー量子化）または "pq"（直積量子化）を指定すると、
+    float32ベクトルの代わりに量子化コードだけをインデックスに保持する。
+    学習データが足りない場合は単純な種別・量子化方式に切り替えるため、
+    (インデックス, 実際に作成した種別, 実際の量子化方式) を返す。
+    """
+    if quantization not in QUANTIZATION_TYPES:
+        raise ValueError(f"サポートされていない量子化方式: {quantization}")
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    count, dim = vectors.shape
+    sq8 = faiss.ScalarQuantizer.QT_8bit
+
+    # PQの学習には少なくとも 2^nbits 件が必要なため、足りなければスカラー量子化にする
+    pq_trainable = count >= (1 << config.PQ_NBITS) * 4
+    if quantization == "pq" and not pq_trainable:
+        quantization = "sq8"
+    if index_type == "ivf_pq" and not pq_trainable:
+        index_type = "ivf_flat"
+    if index_type == "ivf_flat" and count < 39 * 2:
+        index_type = "flat"
+
+    if index_type == "flat":
+        if quantization == "sq8":
+            index = faiss.IndexScalarQuantizer(dim, sq8, faiss.METRIC_L2)
+        elif quantization == "pq":
+            index = faiss.IndexPQ(dim, _pq_m_for(dim), config.PQ_NBITS)
+        else:
+            return faiss.IndexFlatL2(dim), index_type, None
+        _train(index, vectors)
+        return index, index_type, quantization
+
+    if index_type == "hnsw":
+        if quantization == "sq8":
+            index = faiss.IndexHNSWSQ(dim, sq8, config.HNSW_M)
+        elif quantization == "pq":
+            index = faiss.IndexHNSWPQ(dim, _pq_m_for(dim), config.HNSW_M)
+        else:
+            index = faiss.IndexHNSWFlat(dim, config.HNSW_M)
+        index.hnsw.efConstruction = config.HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = config.HNSW_EF_SEARCH
+        if not index.is_trained:
+            _train(index, vectors)
+        return index, index_type, quantization
+
+    quantizer = faiss.IndexFlatL2(dim)
+    nlist = _nlist_for(count)
+    if index_type == "ivf_pq" or quantization == "pq":
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m_for(dim), config.PQ_NBITS)
+    elif quantization == "sq8":
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, sq8)
+    else:
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+
+    _train(index, vectors)
+    index.nprobe = min(config.IVF_NPROBE, nlist)
+    return index, index_type, quantization
+
+def _train(index: faiss.Index, vectors: np.ndarray) -> None:
+    """学習は標本で行い、巨大なコーパスでも学習時間を抑える"""
+    count = len(vectors)
+    if count > config.INDEX_TRAIN_SAMPLE_SIZE:
+        sample = np.random.default_rng(0).choice(count, config.INDEX_TRAIN_SAMPLE_SIZE, replace=False)
+        index.train(vectors[np.sort(sample)])
+    else:
+        index.train(vectors)
+
+def is_quantized(index: faiss.Index) -> bool:
+    """インデックスがfloat32ベクトルをそのまま保持していないかを判定"""
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    return not isinstance(index, (faiss.IndexFlat, faiss.IndexIVFFlat))
+
+def index_bytes_per_chunk(index: faiss.Index, dim: int, as_float32: bool = False) -> float:
+    """インデックスが1チャンクあたりに保持するおおよそのバイト数
+
+    as_float32=True の場合は、同じ構造のインデックスを量子化せずに作った場合の値を返す。
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        storage = faiss.downcast_index(index.storage)
+        # レベル0の隣接リスト（2M個のint32）を加える
+        return index_bytes_per_chunk(storage, dim, as_float32) + 2 * config.HNSW_M * 4
+
+    code_size = dim * 4 if as_float32 else getattr(index, "code_size", dim * 4)
+    if isinstance(index, faiss.IndexIVF):
+        # 転置リストにはコードに加えて64bitのIDを持つ
+        return code_size + 8
+    return code_size
+
+def build_search_params(index: faiss.Index, nprobe: Optional[int] = None,
+                        ef_search: Optional[int] = None):
+    """検索時のパラメータ（nprobe / efSearch）を作成。該当しなければNone"""
+    if nprobe is not None and isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if ef_search is not None and isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
@@ -0,0 +1,326 @@
+import os
+import queue
+import hashlib
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional, Callable, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+from .document_processor import DocumentProcessor
+from modules.core.tracing import tracer, INPUT_TOKENS
+from modules.core.tokens import count_tokens
+import config
+
+# progress_callback(stage, done, total) の stage に渡される値
+STAGE_PARSE = "parse"
+STAGE_EMBED = "embed"
+
+ProgressCallback = Callable[[str, int, int], None]
+
+def _parse_task(file_path: str, file_type: str, page_range: Optional[Tuple[int, int]]) -> List[Document]:
+    """ワーカープロセスで1つのファイル（またはPDFのページ範囲）を解析・分割"""
+    return DocumentProcessor().process_file(file_path, file_type, page_range)
+
+
+class IngestionPipeline:
+    """ファイルの解析・分割と埋め込みを並行して行う取り込みパイプライン
+
+    解析はプロセスプールでファイル・ページ範囲ごとに並列に行い、
+    分割されたチャンクは上限付きのキューを通じて埋め込みスレッドへ順次流れる。
+    CSVはプロセスプールに渡さず、一定行数ずつ読み込んで分割した分をその都度キューに投入する。
+    キューが一杯になると解析結果の投入が待たされるため、メモリ使用量は一定に保たれる。
+    埋め込み済みのチャンクは segment_chunks 件までためてから1つのセグメントとして追加し、
+    古いチャンクの削除とコンパクションは取り込みの最後に1回だけ行う。
+
+    ファイルは内容ハッシュで前回の取り込みと比較し、同一ならスキップする。
+    変更されたファイルは変わったチャンクだけを埋め込み、古いチャンクを削除する。
+    """
+
+    def __init__(self, document_processor: DocumentProcessor, vector_store,
+                 max_workers: int = config.INGESTION_MAX_WORKERS,
+                 embedding_workers: int = config.INGESTION_EMBEDDING_WORKERS,
+                 batch_size: int = config.EMBEDDING_BATCH_SIZE,
+                 queue_size: int = config.INGESTION_QUEUE_SIZE,
+                 segment_chunks: int = config.INGESTION_SEGMENT_CHUNKS):
+        self.document_processor = document_processor
+        self.vector_store = vector_store
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.embedding_workers = embedding_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.segment_chunks = segment_chunks
+
+    def run(self, uploaded_files, progress_callback: Optional[ProgressCallback] = None) -> Dict[str, Any]:
+        """アップロードされたファイルを取り込み、結果を返す
+
+        progress_callback は呼び出し元のスレッドからのみ呼ばれるため、
+        Streamlitの要素を直接更新してよい。
+        """
+        with tracer.span("ingestion.run", files=len(uploaded_files)) as span:
+            state = self._run(uploaded_files, progress_callback, span)
+            span.set_attributes(chunks=state["chunk_count"], embedded_chunks=state["embedded_count"],
+                                errors=len(state["errors"]))
+            return state
+
+    def _run(self, uploaded_files, progress_callback: Optional[ProgressCallback], span) -> Dict[str, Any]:
+        state = {
+            "processed_files": [],
+            "added_files": [],
+            "replaced_files": [],
+            "skipped_files": [],
+            "errors": [],
+            "chunk_count": 0,
+            "embedded_count": 0,
+            "reused_count": 0,
+            "deleted_count": 0,
+            "files": {}
+        }
+        report = progress_callback or (lambda stage, done, total: None)
+
+        os.makedirs(config.INGESTION_TEMP_DIR, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=config.INGESTION_TEMP_DIR)
+        try:
+            with tracer.span("ingestion.plan"):
+                tasks = self._plan_tasks(uploaded_files, temp_dir, state)
+            if not tasks:
+                return state
+
+            chunk_queue = queue.Queue(maxsize=self.queue_size)
+            state_lock = threading.Lock()
+            # 埋め込み済みでインデックスに未追加のチャンク（埋め込みスレッドで共有する）
+            pending = {"batches": [], "count": 0}
+            embed_threads = [
+                threading.Thread(target=self._embed_worker, args=(chunk_queue, state, state_lock, pending, span),
+                                 daemon=True)
+                for _ in range(self.embedding_workers)
+            ]
+            for thread in embed_threads:
+                thread.start()
+
+            parsed_tasks = 0
+            report(STAGE_PARSE, 0, len(tasks))
+
+            # 解析は別プロセスで行うため、全タスクの投入から最後の結果の受け取りまでを1つのspanにする
+            parse_span = tracer.start_span("ingestion.parse", span, tasks=len(tasks))
+            stream_tasks = [task for task in tasks if task[2] == "csv"]
+            pool_tasks = [task for task in tasks if task[2] != "csv"]
+            with self._create_executor(len(pool_tasks)) as executor:
+                futures = {
+                    executor.submit(_parse_task, file_path, file_type, page_range): filename
+                    for filename, file_path, file_type, page_range in pool_tasks
+                }
+
+                # CSVは結果の全体をプロセス間で受け渡さず、他のファイルの解析と並行して読み込みながら投入する
+                for filename, file_path, _, _ in stream_tasks:
+                    for documents in self.document_processor.iter_csv(file_path):
+                        self._enqueue(chunk_queue, filename, documents, state, state_lock, report)
+                    parsed_tasks += 1
+                    report(STAGE_PARSE, parsed_tasks, len(tasks))
+
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    parsed_tasks += 1
+                    try:
+                        documents = future.result()
+                    except Exception as e:
+                        state["files"][filename]["failed"] = True
+                        state["errors"].append(f"ファイル {filename} の処理中にエラーが発生しました: {str(e)}")
+                        report(STAGE_PARSE, parsed_tasks, len(tasks))
+                        continue
+
+                    self._enqueue(chunk_queue, filename, documents, state, state_lock, report)
+                    report(STAGE_PARSE, parsed_tasks, len(tasks))
+            parse_span.set_attribute("chunks", state["chunk_count"])
+            parse_span.end()
+
+            for _ in embed_threads:
+                self._put(chunk_queue, None, state, report)
+
+            # 埋め込みの完了を待ちながら進捗を通知
+            for thread in embed_threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.2)
+                    report(STAGE_EMBED, state["embedded_count"], state["chunk_count"])
+            self._add_pending(pending["batches"], state, state_lock, span)
+
+            with tracer.span("ingestion.finalize"):
+                self._finalize_files(state)
+            return state
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _plan_tasks(self, uploaded_files, temp_dir: str, state: Dict[str, Any]) -> List[tuple]:
+        """ファイルを一時保存し、解析タスク (ファイル名, パス, 種類, ページ範囲) に分割"""
+        tasks = []
+        segment_store = self.vector_store.segment_store
+        segment_store.migrate_file_records()
+        for uploaded_file in uploaded_files:
+            if uploaded_file.name in state["files"] or uploaded_file.name in state["skipped_files"]:
+                continue
+            try:
+                file_type = self.document_processor.get_file_type(uploaded_file.name)
+                if file_type not in ("pdf", "txt", "csv"):
+                    raise ValueError(f"サポートされていないファイル形式: {file_type}")
+
+                file_hash = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+                record = segment_store.get_file_record(uploaded_file.name)
+                if record is not None and record["hash"] == file_hash:
+                    state["skipped_files"].append(uploaded_file.name)
+                    continue
+
+                state["files"][uploaded_file.name] = {
+                    "hash": file_hash,
+                    "old_hash": record["hash"] if record else "",
+                    "old_ids": set(record["chunk_ids"]) if record else set(),
+                    "new_ids": {},
+                    "added_ids": set(),
+                    "is_replacement": record is not None,
+                    "failed": False
+                }
+
+                # 同名ファイルが複数あっても衝突しないよう、ファイルごとにディレクトリを分ける
+                file_path = self.document_processor.save_uploaded_file(
+                    uploaded_file, os.path.join(temp_dir, str(len(tasks)))
+                )
+
+                if file_type == "pdf":
+                    page_count = self.document_processor.count_pdf_pages(file_path)
+                    step = config.INGESTION_PDF_PAGES_PER_TASK
+                    for start in range(0, page_count, step):
+                        tasks.append((uploaded_file.name, file_path, file_type, (start, start + step)))
+                else:
+                    tasks.append((uploaded_file.name, file_path, file_type, None))
+            except Exception as e:
+                state["files"].pop(uploaded_file.name, None)
+                state["errors"].append(f"ファイル {uploaded_file.name} の処理中にエラーが発生しました: {str(e)}")
+        return tasks
+
+    def _create_executor(self, task_count: int):
+        """タスクが1つだけならプロセス起動のコストを避け、スレッドで処理"""
+        if task_count <= 1 or self.max_workers <= 1:
+            return ThreadPoolExecutor(max_workers=1)
+        # Streamlitはマルチスレッドで動作するため、fork ではなく spawn でワーカーを起動する
+        return ProcessPoolExecutor(
+            max_workers=min(self.max_workers, task_count),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _enqueue(self, chunk_queue: queue.Queue, filename: str, documents: List[Document],
+                 state: Dict[str, Any], state_lock: threading.Lock, report: ProgressCallback) -> None:
+        """解析したチャンクを埋め込みのバッチ単位でキューに投入"""
+        with state_lock:
+            state["chunk_count"] += len(documents)
+        for i in range(0, len(documents), self.batch_size):
+            self._put(chunk_queue, (filename, documents[i:i + self.batch_size]), state, report)
+
+    def _put(self, chunk_queue: queue.Queue, item, state: Dict[str, Any], report: ProgressCallback) -> None:
+        """キューが空くまで待ち、その間も埋め込みの進捗を通知"""
+        while True:
+            try:
+                chunk_queue.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                report(STAGE_EMBED, state["embedded_count"], state["chunk_count"])
+
+    def _embed_worker(self, chunk_queue: queue.Queue, state: Dict[str, Any], state_lock: threading.Lock,
+                      pending: Dict[str, Any], parent_span=None) -> None:
+        """キューからチャンクのバッチを取り出して埋め込み、一定数たまったらインデックスに追加"""
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                return
+
+            filename, documents = item
+            file_state = state["files"][filename]
+            ids = self.vector_store.assign_chunk_ids(documents)
+
+            # 前回から変わっていないチャンクと、同じファイル内の重複チャンクは埋め込まない
+            fresh = []
+            with state_lock:
+                for chunk_id, doc in zip(ids, documents):
+                    if chunk_id in file_state["new_ids"]:
+                        continue
+                    file_state["new_ids"][chunk_id] = True
+                    if chunk_id in file_state["old_ids"]:
+                        state["reused_count"] += 1
+                    else:
+                        fresh.append(doc)
+            if not fresh:
+                continue
+
+            try:
+                with tracer.span("ingestion.embed", parent_span, chunks=len(fresh)) as span:
+                    fresh_ids, vectors = self.vector_store.embed_documents(fresh)
+                    if span.recording:
+                        span.set_attribute(INPUT_TOKENS, sum(count_tokens(doc.page_content, config.EMBEDDING_MODEL)
+                                                             for doc in fresh))
+            except Exception as e:
+                with state_lock:
+                    file_state["failed"] = True
+                    state["errors"].append(f"ベクトルストア作成中にエラーが発生しました: {str(e)}")
+                continue
+
+            batches = None
+            with state_lock:
+                state["embedded_count"] += len(fresh)
+                pending["batches"].append((filename, fresh_ids, np.asarray(vectors, dtype=np.float32), fresh))
+                pending["count"] += len(fresh)
+                if pending["count"] >= self.segment_chunks:
+                    batches, pending["batches"], pending["count"] = pending["batches"], [], 0
+            if batches:
+                self._add_pending(batches, state, state_lock, parent_span)
+
+    def _add_pending(self, batches: List[tuple], state: Dict[str, Any], state_lock: threading.Lock,
+                     parent_span=None) -> None:
+        """ためておいた埋め込み済みのチャンクを1つのセグメントとしてインデックスに追加"""
+        if not batches:
+            return
+        ids = [chunk_id for _, batch_ids, _, _ in batches for chunk_id in batch_ids]
+        documents = [doc for _, _, _, batch_documents in batches for doc in batch_documents]
+        try:
+            with tracer.span("ingestion.index_add", parent_span, chunks=len(ids)):
+                self.vector_store.add_embedded_documents(
+                    ids, np.vstack([vectors for _, _, vectors, _ in batches]), documents, compact=False)
+            with state_lock:
+                for filename, batch_ids, _, _ in batches:
+                    state["files"][filename]["added_ids"].update(batch_ids)
+        except Exception as e:
+            with state_lock:
+                for filename, _, _, _ in batches:
+                    state["files"][filename]["failed"] = True
+                state["errors"].append(f"ベクトルストア作成中にエラーが発生しました: {str(e)}")
+
+    def _finalize_files(self, state: Dict[str, Any]) -> None:
+        """古いチャンクをまとめて削除し、ファイルの記録を更新してからコンパクションを1回行う"""
+        segment_store = self.vector_store.segment_store
+        succeeded = {filename: file_state for filename, file_state in state["files"].items()
+                     if not file_state["failed"]}
+
+        # 削除のたびにインデックスを作り直すため、全ファイルの古いチャンクを1回で削除する
+        stale = set()
+        for file_state in succeeded.values():
+            stale |= file_state["old_ids"] - file_state["new_ids"].keys()
+        if stale:
+            self.vector_store.delete_chunks(stale, compact=False)
+            state["deleted_count"] += len(stale)
+
+        for filename, file_state in state["files"].items():
+            # 失敗したファイルは古いチャンクを残し、追加できた分だけを記録に加える。
+            # ハッシュは前回のままにして、次回のアップロードで再処理されるようにする
+            if file_state["failed"]:
+                if file_state["added_ids"]:
+                    segment_store.put_file_record(filename, file_state["old_hash"],
+                                                  list(file_state["old_ids"] | file_state["added_ids"]))
+                continue
+
+            segment_store.put_file_record(filename, file_state["hash"], list(file_state["new_ids"]))
+            state["processed_files"].append(filename)
+            if file_state["is_replacement"]:
+                state["replaced_files"].append(filename)
+            else:
+                state["added_files"].append(filename)
+
+        segment_store.compact_async()
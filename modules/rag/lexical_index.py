@@ -0,0 +1,323 @@
+import re
+import math
+import unicodedata
+from array import array
+from typing import List, Dict, Tuple, Iterable, Optional
+import numpy as np
+import config
+
+# 英数字の連続（型番・規程番号のような "abc-123" もひとまとまりとして扱う）
+_ALNUM_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_ALNUM_SEPARATORS = re.compile(r"[-_./]")
+_HASH_MULTIPLIER = np.uint64(0x100000001B3)
+# セグメントごとに保存する転置インデックスの配列（mmapモードで使う）
+POSTINGS_ARRAYS = ("terms", "offsets", "positions", "frequencies", "lengths")
+
+_text_char_table: Optional[np.ndarray] = None
+
+def _is_text_char() -> np.ndarray:
+    """BMPの各文字が（英数字以外の）語を構成する文字かどうかの表"""
+    global _text_char_table
+    if _text_char_table is None:
+        table = np.zeros(0x10000, dtype=bool)
+        for code in range(0x80, 0x10000):
+            table[code] = chr(code).isalnum()
+        _text_char_table = table
+    return _text_char_table
+
+def _fold(codes: np.ndarray, starts: np.ndarray, length: int) -> np.ndarray:
+    """starts から length 文字ずつの文字コード列をまとめて64bitの値にする"""
+    value = np.full(len(starts), length, dtype=np.uint64)
+    for offset in range(length):
+        value = (value ^ codes[starts + offset]) * _HASH_MULTIPLIER
+    return value
+
+def _word_ids(words: List[str]) -> np.ndarray:
+    """英数字の単語を文字n-gramと同じ方式で64bitの値にする
+
+    組み込みの hash() はプロセスごとに値が変わるため、ディスクに保存する転置インデックスには使えない。
+    """
+    if not words:
+        return np.zeros(0, dtype=np.uint64)
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    codes = np.frombuffer("".join(words).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    starts = np.cumsum(lengths) - lengths
+    value = lengths.astype(np.uint64)
+    for offset in range(int(lengths.max())):
+        active = np.flatnonzero(lengths > offset)
+        value[active] = (value[active] ^ codes[starts[active] + offset]) * _HASH_MULTIPLIER
+    return value
+
+def document_term_ids(texts: List[str], ngram: int = config.LEXICAL_NGRAM_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """形態素解析を使わずに、複数のテキストをまとめて検索語（の64bit ID）に分割
+
+    英数字は単語単位（記号でつながった型番は全体と各部分）、
+    日本語などは ngram 文字ずつずらした文字n-gram（短い場合はその文字列全体）にする。
+    文字n-gramは全テキストをつないだ文字コードの配列に対してまとめて計算する。
+    戻り値は (検索語ID, 何番目のテキストか) の配列で、テキストの順に並ぶ。
+    """
+    words, word_counts, remainders = [], [], []
+    for text in texts:
+        text = unicodedata.normalize("NFKC", text).lower()
+        count = len(words)
+        for word in _ALNUM_PATTERN.findall(text):
+            words.append(word)
+            if not word.isalnum():
+                words.extend(_ALNUM_SEPARATORS.split(word))
+        word_counts.append(len(words) - count)
+        remainders.append(_ALNUM_PATTERN.sub(" ", text))
+    ids = [_word_ids(words)]
+    owners = [np.repeat(np.arange(len(texts), dtype=np.uint32), word_counts)]
+
+    # 改行は語を構成しないため、テキストをまたいだn-gramはできない
+    codes = np.frombuffer("\n".join(remainders).encode("utf-32-le"), dtype=np.uint32)
+    if len(codes):
+        text_ends = np.cumsum([len(text) + 1 for text in remainders])
+        mask = np.where(codes < 0x10000, _is_text_char()[np.minimum(codes, 0xFFFF)], True)
+        codes = codes.astype(np.uint64)
+        # 語を構成する文字の連続（run）の開始位置と長さ
+        edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+        run_starts = np.flatnonzero(edges == 1)
+        run_lengths = np.flatnonzero(edges == -1) - run_starts
+
+        for length in range(1, ngram):
+            starts = run_starts[run_lengths == length]
+            ids.append(_fold(codes, starts, length))
+            owners.append(np.searchsorted(text_ends, starts, side="right").astype(np.uint32))
+        long_runs = run_lengths >= ngram
+        # 長さ ngram 以上のrunの中で、n-gramを取り出せる開始位置
+        counts = run_lengths[long_runs] - ngram + 1
+        starts = np.repeat(run_starts[long_runs], counts) + (
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+        ids.append(_fold(codes, starts, ngram))
+        owners.append(np.searchsorted(text_ends, starts, side="right").astype(np.uint32))
+
+    ids, owners = np.concatenate(ids), np.concatenate(owners)
+    order = np.argsort(owners, kind="stable")
+    return ids[order], owners[order]
+
+def term_ids(text: str, ngram: int = config.LEXICAL_NGRAM_SIZE) -> np.ndarray:
+    """1つのテキスト（検索の質問など）の検索語ID"""
+    return document_term_ids([text], ngram)[0]
+
+class _Block:
+    """1回の追加分（またはマージ後）の転置インデックス（検索語IDの昇順に並べたCSR形式）"""
+
+    def __init__(self, terms: np.ndarray, offsets: np.ndarray, positions: np.ndarray, frequencies: np.ndarray):
+        self.terms = terms
+        self.offsets = offsets
+        self.positions = positions
+        self.frequencies = frequencies
+
+    @classmethod
+    def build(cls, terms: np.ndarray, positions: np.ndarray, frequencies: np.ndarray) -> "_Block":
+        """位置の昇順に並んだ (検索語ID, 位置, 出現回数) の組から作成"""
+        # 安定ソートなので、同じ検索語の中では位置の昇順が保たれる
+        order = np.argsort(terms, kind="stable")
+        terms, positions, frequencies = terms[order], positions[order], frequencies[order]
+        starts = np.flatnonzero(np.concatenate(([True], terms[1:] != terms[:-1])))[:len(terms)]
+        return cls(terms[starts], np.append(starts, len(terms)), positions, frequencies)
+
+    @classmethod
+    def from_terms(cls, terms: np.ndarray, positions: np.ndarray) -> "_Block":
+        """位置の昇順に並んだ (検索語ID, 位置) の組から作成（同じチャンク内の重複は出現回数にまとめる）"""
+        if len(terms) == 0:
+            return cls(terms, np.zeros(1, dtype=np.int64), positions, np.zeros(0, dtype=np.uint16))
+        # チャンクごとに重複をまとめてから全体を並べ替えるほうが、並べ替える件数が少なく速い
+        boundaries = np.flatnonzero(positions[1:] != positions[:-1]) + 1
+        counted = [np.unique(ids, return_counts=True) for ids in np.split(terms, boundaries)]
+        positions = np.repeat(positions[np.append(0, boundaries)], [len(ids) for ids, _ in counted])
+        terms = np.concatenate([ids for ids, _ in counted])
+        frequencies = np.minimum(np.concatenate([counts for _, counts in counted]), 65535).astype(np.uint16)
+        return cls.build(terms, positions, frequencies)
+
+    def expanded_terms(self) -> np.ndarray:
+        return np.repeat(self.terms, np.diff(self.offsets))
+
+    def find(self, term: np.uint64) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """検索語の (位置, 出現回数) の配列（無ければNone）"""
+        index = np.searchsorted(self.terms, term)
+        if index >= len(self.terms) or self.terms[index] != term:
+            return None
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.positions[start:end], self.frequencies[start:end]
+
+
+class LexicalIndex:
+    """文字n-gramの転置インデックスによるBM25検索
+
+    チャンクは追加順の通し番号（位置）で管理し、ベクトルインデックスと同じ順に追加する。
+    追加ごとにブロックを作り、max_blocks を超えたら1つにまとめる。
+    チャンクの削除はできないため、削除時はベクトルインデックスと一緒に作り直す。
+    """
+
+    def __init__(self, k1: float = config.BM25_K1, b: float = config.BM25_B,
+                 ngram: int = config.LEXICAL_NGRAM_SIZE, max_blocks: int = config.LEXICAL_MAX_BLOCKS):
+        self.k1 = k1
+        self.b = b
+        self.ngram = ngram
+        self.max_blocks = max_blocks
+        self.chunk_ids: List[str] = []
+        self._lengths = array("I")
+        self._total_length = 0
+        self._blocks: List[_Block] = []
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def add(self, chunk_ids: Iterable[str], texts: Iterable[str]) -> None:
+        """チャンクを末尾に追加"""
+        chunk_ids, texts = list(chunk_ids), list(texts)
+        if not texts:
+            return
+
+        terms, owners = document_term_ids(texts, self.ngram)
+        first_position = len(self.chunk_ids)
+        self._blocks.append(_Block.from_terms(terms, owners + np.uint32(first_position)))
+        self.chunk_ids.extend(chunk_ids)
+        lengths = np.bincount(owners, minlength=len(texts))
+        self._lengths.extend(lengths.tolist())
+        self._total_length += int(lengths.sum())
+
+        if len(self._blocks) > self.max_blocks:
+            blocks = self._blocks
+            self._blocks = [_Block.build(
+                np.concatenate([block.expanded_terms() for block in blocks]),
+                np.concatenate([block.positions for block in blocks]),
+                np.concatenate([block.frequencies for block in blocks])
+            )]
+
+    def search(self, query: str, k: int = config.TOP_K_DOCUMENTS) -> List[Tuple[int, float]]:
+        """BM25スコアの高い順に (位置, スコア) を返す"""
+        count = len(self.chunk_ids)
+        if count == 0 or k <= 0:
+            return []
+
+        lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+        average_length = self._total_length / count
+        scores = None
+        for term in np.unique(term_ids(query, self.ngram)):
+            postings = [found for found in (block.find(term) for block in self._blocks) if found is not None]
+            if not postings:
+                continue
+            positions = np.concatenate([found[0] for found in postings])
+            frequencies = np.concatenate([found[1] for found in postings]).astype(np.float32)
+
+            if scores is None:
+                scores = np.zeros(count, dtype=np.float32)
+            idf = math.log(1.0 + (count - len(positions) + 0.5) / (len(positions) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * lengths[positions] / average_length)
+            # 1つの検索語の中では位置が重複しないため、添字での加算でよい
+            scores[positions] += idf * frequencies * (self.k1 + 1.0) / (frequencies + norm)
+        if scores is None:
+            return []
+
+        top = min(k, count)
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(position), float(scores[position])) for position in candidates if scores[position] > 0]
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "chunks": len(self.chunk_ids),
+            "postings": int(sum(len(block.positions) for block in self._blocks)),
+            "blocks": len(self._blocks)
+        }
+
+
+def build_postings(texts: List[str], ngram: int = config.LEXICAL_NGRAM_SIZE) -> Dict[str, np.ndarray]:
+    """1つのセグメントの転置インデックスを作成（位置はセグメント内の行番号）"""
+    terms, owners = document_term_ids(texts, ngram)
+    block = _Block.from_terms(terms, owners)
+    return {
+        "terms": block.terms,
+        "offsets": block.offsets,
+        "positions": block.positions,
+        "frequencies": block.frequencies,
+        "lengths": np.bincount(owners, minlength=len(texts)).astype(np.uint32)
+    }
+
+def open_postings(paths: Dict[str, str]) -> Tuple[_Block, np.ndarray]:
+    """保存した転置インデックスをメモリマップで開き、(ブロック, チャンクごとの語数) を返す"""
+    arrays = {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+    block = _Block(arrays["terms"], arrays["offsets"], arrays["positions"], arrays["frequencies"])
+    return block, arrays["lengths"]
+
+
+class MappedLexicalIndex:
+    """セグメントごとに保存した転置インデックスをメモリマップしてBM25検索
+
+    読み込み時にコーパス全体を分割し直す必要がなく、複数プロセスでページキャッシュを共有できる。
+    セグメントのリストはベクトル検索（MappedIndex）と共有するため、追記されたセグメントもそのまま検索対象になる。
+    位置は全セグメントの物理的な行を先頭から通した番号で、削除済みの行は結果に含めない。
+    """
+
+    def __init__(self, segments: List, k1: float = config.BM25_K1, b: float = config.BM25_B,
+                 ngram: int = config.LEXICAL_NGRAM_SIZE):
+        self.segments = segments
+        self.k1 = k1
+        self.b = b
+        self.ngram = ngram
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    def search(self, query: str, k: int = config.TOP_K_DOCUMENTS) -> List[Tuple[int, float]]:
+        """BM25スコアの高い順に (位置, スコア) を返す"""
+        segments = list(self.segments)
+        count = sum(len(segment) for segment in segments)
+        if count == 0 or k <= 0:
+            return []
+
+        bases = np.cumsum([0] + [segment.row_count for segment in segments])
+        average_length = sum(segment.live_term_length for segment in segments) / count
+        scores = None
+        for term in np.unique(term_ids(query, self.ngram)):
+            positions, frequencies, lengths = [], [], []
+            for base, segment in zip(bases, segments):
+                found = segment.postings.find(term)
+                if found is None:
+                    continue
+                rows, counts = found
+                if segment.dead_mask is not None:
+                    live = ~segment.dead_mask[rows]
+                    rows, counts = rows[live], counts[live]
+                positions.append(rows.astype(np.int64) + base)
+                frequencies.append(counts)
+                lengths.append(segment.term_lengths[rows])
+            if not positions:
+                continue
+            positions = np.concatenate(positions)
+            if len(positions) == 0:
+                continue
+            frequencies = np.concatenate(frequencies).astype(np.float32)
+            lengths = np.concatenate(lengths)
+
+            if scores is None:
+                scores = np.zeros(bases[-1], dtype=np.float32)
+            idf = math.log(1.0 + (count - len(positions) + 0.5) / (len(positions) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * lengths / average_length)
+            scores[positions] += idf * frequencies * (self.k1 + 1.0) / (frequencies + norm)
+        if scores is None:
+            return []
+
+        top = min(k, len(scores))
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(position), float(scores[position])) for position in candidates if scores[position] > 0]
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "chunks": len(self),
+            "postings": int(sum(len(segment.postings.positions) for segment in self.segments)),
+            "blocks": len(self.segments)
+        }
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = config.RRF_K) -> List[Tuple[str, float]]:
+    """複数の順位リスト（チャンクIDの並び）を Reciprocal Rank Fusion で統合"""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, 1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
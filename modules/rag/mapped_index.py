@@ -0,0 +1,193 @@
+import json
+import mmap
+from typing import List, Tuple, Iterator, Optional, Set, Dict
+from collections.abc import Sequence
+import numpy as np
+from langchain.docstore.document import Document
+from .lexical_index import open_postings
+import config
+
+class MappedSegment:
+    """メモリマップしたセグメント（ベクトル行列 + オフセット表 + 文字列アリーナ）"""
+
+    def __init__(self, vector_path: str, meta_path: str, offsets_path: str,
+                 deleted_ids: Optional[Set[str]] = None, ids_path: Optional[str] = None,
+                 postings_paths: Optional[Dict[str, str]] = None):
+        self.vectors = np.load(vector_path, mmap_mode="r")
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        with open(meta_path, "rb") as f:
+            self._arena = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] > 0 else b""
+
+        # 削除済みの行がある場合だけチャンクID配列と照合してマスクを作る（コンパクション後は不要になる）
+        self.dead_mask = None
+        self.live_rows = None
+        if deleted_ids:
+            chunk_ids = np.load(ids_path, mmap_mode="r")
+            dead = np.isin(chunk_ids, np.asarray([chunk_id.encode("utf-8") for chunk_id in deleted_ids],
+                                                 dtype=np.bytes_))
+            if dead.any():
+                self.dead_mask = dead
+                self.live_rows = np.flatnonzero(~dead)
+
+        # 語彙検索用の転置インデックス（ハイブリッド検索を行う場合だけ開く）
+        self.postings = None
+        self.term_lengths = None
+        self.live_term_length = 0
+        if postings_paths is not None:
+            self.postings, self.term_lengths = open_postings(postings_paths)
+            self.live_term_length = int(self.term_lengths.sum())
+            if self.dead_mask is not None:
+                self.live_term_length -= int(self.term_lengths[self.dead_mask].sum())
+
+    @property
+    def row_count(self) -> int:
+        """削除済みを含む物理的な行数"""
+        return len(self.offsets) - 1
+
+    def __len__(self) -> int:
+        return self.row_count if self.live_rows is None else len(self.live_rows)
+
+    def to_row(self, index: int) -> int:
+        """有効な行の通し番号を物理的な行番号に変換"""
+        return index if self.live_rows is None else int(self.live_rows[index])
+
+    def _record(self, row: int) -> dict:
+        start = int(self.offsets[row])
+        end = int(self.offsets[row + 1])
+        return json.loads(self._arena[start:end].decode("utf-8"))
+
+    def document_at(self, row: int) -> Document:
+        """物理的な行番号のDocumentを必要になった時点でデコード"""
+        record = self._record(row)
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def document(self, index: int) -> Document:
+        """有効な行の通し番号でDocumentを取得"""
+        return self.document_at(self.to_row(index))
+
+
+class MappedDocumentList(Sequence):
+    """セグメント群をまたいで遅延デコードする読み取り専用の文書リスト"""
+
+    def __init__(self, segments: List[MappedSegment]):
+        self.segments = segments
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        for segment in self.segments:
+            if index < len(segment):
+                return segment.document(index)
+            index -= len(segment)
+        raise IndexError("文書のインデックスが範囲外です")
+
+    def __iter__(self) -> Iterator[Document]:
+        for segment in self.segments:
+            for row in range(len(segment)):
+                yield segment.document(row)
+
+
+class MappedVectors:
+    """セグメント群をまたいで通し番号でfloat32ベクトルを取得する（量子化時の再スコアリング用）"""
+
+    def __init__(self, segments: List[MappedSegment]):
+        self.segments = segments
+        self._bounds = np.cumsum([0] + [len(segment) for segment in segments])
+
+    def __len__(self) -> int:
+        return int(self._bounds[-1])
+
+    def take(self, positions: List[int]) -> np.ndarray:
+        """指定した通し番号のベクトルだけをディスクから読み出す"""
+        rows = []
+        for position in positions:
+            segment_index = int(np.searchsorted(self._bounds, position, side="right")) - 1
+            segment = self.segments[segment_index]
+            rows.append(segment.vectors[segment.to_row(position - self._bounds[segment_index])])
+        return np.asarray(rows, dtype=np.float32)
+
+
+class MappedIndex:
+    """メモリマップしたベクトル行列に対する総当たりL2検索
+
+    ページキャッシュを複数プロセスで共有でき、起動時にベクトルを読み込まない。
+    スコアはFAISSのIndexFlatL2と同じく二乗L2距離（小さいほど類似）。
+    """
+
+    def __init__(self, segments: List[MappedSegment], embeddings,
+                 block_rows: int = config.MMAP_SEARCH_BLOCK_ROWS):
+        self.segments = segments
+        self.embeddings = embeddings
+        self.block_rows = block_rows
+
+    def add_segment(self, segment: MappedSegment) -> None:
+        """追記されたセグメントを検索対象に加える"""
+        self.segments.append(segment)
+
+    def document_at_position(self, position: int) -> Document:
+        """全セグメントの物理的な行を通した番号でDocumentを取得（語彙検索の結果に使う）"""
+        for segment in self.segments:
+            if position < segment.row_count:
+                return segment.document_at(position)
+            position -= segment.row_count
+        raise IndexError("文書のインデックスが範囲外です")
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        """ベクトルでスコア付き類似度検索を実行"""
+        return self.similarity_search_with_score_by_vectors([embedding], k=k)[0]
+
+    def similarity_search_with_score_by_vectors(self, embeddings: List[List[float]],
+                                                k: int = 4) -> List[List[Tuple[Document, float]]]:
+        """複数のベクトルをまとめて検索（ベクトル行列は1回だけ走査する）"""
+        if k <= 0 or len(embeddings) == 0:
+            return [[] for _ in embeddings]
+
+        queries = np.asarray(embeddings, dtype=np.float32)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+
+        best_scores = [np.empty(0, dtype=np.float32) for _ in queries]
+        best_locations = [[] for _ in queries]
+
+        for segment_index, segment in enumerate(self.segments):
+            for start in range(0, segment.row_count, self.block_rows):
+                block = segment.vectors[start:start + self.block_rows]
+                # (ブロックの行数, クエリ数) の二乗L2距離
+                scores = (np.einsum("ij,ij->i", block, block)[:, None] - 2.0 * (block @ queries.T)
+                          + query_norms[None, :])
+                if segment.dead_mask is not None:
+                    scores[segment.dead_mask[start:start + self.block_rows]] = np.inf
+
+                top = min(k, len(scores))
+                candidates = np.argpartition(scores, top - 1, axis=0)[:top]
+                for query_index in range(len(queries)):
+                    rows = candidates[:, query_index]
+                    merged = np.concatenate([best_scores[query_index], scores[rows, query_index]])
+                    locations = best_locations[query_index] + [(segment_index, start + int(row)) for row in rows]
+                    if len(merged) > k:
+                        keep = np.argpartition(merged, k - 1)[:k]
+                        merged = merged[keep]
+                        locations = [locations[i] for i in keep]
+                    best_scores[query_index] = merged
+                    best_locations[query_index] = locations
+
+        results = []
+        for scores, locations in zip(best_scores, best_locations):
+            order = [i for i in np.argsort(scores) if np.isfinite(scores[i])]
+            results.append([
+                (self.segments[locations[i][0]].document_at(locations[i][1]), float(max(scores[i], 0.0)))
+                for i in order
+            ])
+        return results
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> List[Tuple[Document, float]]:
+        """スコア付きで類似度検索を実行"""
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k=k)
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        """類似度検索を実行"""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
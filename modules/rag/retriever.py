@@ -1,64 +1,273 @@
-from typing import List, Dict, Any, Optional
-from langchain_openai import ChatOpenAI
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain.schema import HumanMessage, SystemMessage
 from langchain.docstore.document import Document
 from .vector_store import VectorStore
+from .collection_registry import CollectionRegistry
 from .document_processor import DocumentProcessor
+from .ingestion import IngestionPipeline
+from .answer_cache import AnswerCache
+from .context_builder import ContextBuilder
+from modules.providers.registry import create_chat_model
+from modules.core.tracing import tracer, record_llm_usage, INPUT_TOKENS
+from modules.core.tokens import count_tokens, count_message_tokens
 import config
 
 class RAGRetriever:
-    def __init__(self):
-        self.llm = ChatOpenAI(
-            openai_api_key=config.OPENAI_API_KEY,
-            model_name=config.MODEL_NAME,
-            temperature=config.TEMPERATURE
-        )
-        self.vector_store = VectorStore()
+    def __init__(self, llm: Optional[BaseChatModel] = None):
+        self.llm = llm or create_chat_model()
+        self.collections = CollectionRegistry()
         self.document_processor = DocumentProcessor()
+        self.answer_cache = AnswerCache()
+        self.context_builder = ContextBuilder()
+        # クエリの埋め込みに時間制限をかけるためのスレッド（制限を超えても処理は続き、結果はキャッシュされる）
+        self._embedding_executor = ThreadPoolExecutor(thread_name_prefix="query-embedding")
 
-    def add_documents(self, uploaded_files) -> str:
-        """アップロードされたファイルを処理してベクトルストアに追加"""
+    @property
+    def vector_store(self) -> VectorStore:
+        """既定のコレクションのベクトルストア"""
+        return self.collections.get()
+
+    def add_documents(self, uploaded_files, progress_callback=None,
+                      collection: Optional[str] = None) -> str:
+        """アップロードされたファイルを処理してコレクション（省略時は既定のコレクション）に追加
+
+        progress_callback(stage, done, total) で解析・埋め込みの進捗を受け取れる。
+        """
         if not uploaded_files:
             return "ファイルが選択されていません。"
 
-        all_documents = []
-        processed_files = []
+        pipeline = IngestionPipeline(self.document_processor, self.collections.get(collection))
+        result = pipeline.run(uploaded_files, progress_callback)
+        self.collections.trim(keep=collection)
+        errors = result["errors"]
 
-        for uploaded_file in uploaded_files:
-            try:
-                documents = self.document_processor.process_uploaded_file(uploaded_file)
-                all_documents.extend(documents)
-                processed_files.append(uploaded_file.name)
-            except Exception as e:
-                return f"ファイル {uploaded_file.name} の処理中にエラーが発生しました: {str(e)}"
-
-        if all_documents:
-            try:
-                self.vector_store.create_vector_store(all_documents)
-                self.vector_store.save_vector_store()
-                return f"成功: {len(processed_files)}個のファイルを処理し、{len(all_documents)}個のチャンクを作成しました。\\n処理されたファイル: {', '.join(processed_files)}"
-            except Exception as e:
-                return f"ベクトルストア作成中にエラーが発生しました: {str(e)}"
+        if result["processed_files"] or result["skipped_files"]:
+            message = (
+                f"成功: 追加 {len(result['added_files'])}件・置換 {len(result['replaced_files'])}件・"
+                f"スキップ {len(result['skipped_files'])}件のファイルを処理し、"
+                f"{result['embedded_count']}個のチャンクを作成しました"
+                f"（再利用 {result['reused_count']}個、削除 {result['deleted_count']}個）。"
+            )
+            for label, key in (("追加", "added_files"), ("置換", "replaced_files"), ("スキップ（変更なし）", "skipped_files")):
+                if result[key]:
+                    message += f"\n{label}: {', '.join(result[key])}"
+            if errors:
+                message += "\n" + "\n".join(errors)
+            return message
+        elif errors:
+            return "\n".join(errors)
         else:
             return "処理可能なコンテンツが見つかりませんでした。"
 
     def load_existing_documents(self) -> bool:
-        """既存のベクトルストアを読み込み"""
-        return self.vector_store.load_vector_store()
+        """既定のコレクションを読み込み（その他のコレクションは最初に使われたときに読み込む）"""
+        return self.vector_store.get_document_count() > 0
+
+    def retrieve_and_generate(self, query: str, collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        """RAGを使用して質問に回答（collections を省略すると既定のコレクションから検索）"""
+        with tracer.span("rag.retrieve_and_generate"):
+            return self.generate_from_prepared(query, self._prepare_generation(query, collections))
+
+    def prepare_batch(self, queries: List[str], collections: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """複数の質問の埋め込みと検索をまとめて行い、それぞれの生成準備を返す
+
+        埋め込みは1回のバッチ呼び出し、検索は1回の複数クエリ検索で行う。
+        結果は generate_from_prepared に渡して回答を生成する。
+        """
+        if not self.collections.has_documents(collections):
+            return [self._no_documents_result() for _ in queries]
+
+        with tracer.span("rag.prepare_batch", queries=len(queries)):
+            try:
+                with tracer.span("rag.embed_query", queries=len(queries)) as span:
+                    # 全コレクションで同じ埋め込みを使うため、対象のコレクションによらず1回のバッチで埋め込む
+                    query_vectors = self.collections.embeddings.embed_documents(queries)
+                    if span.recording:
+                        span.set_attribute(INPUT_TOKENS, sum(count_tokens(query, config.EMBEDDING_MODEL)
+                                                             for query in queries))
+            except Exception as e:
+                # 埋め込みが使えない場合は語彙検索のみで回答する
+                print(f"クエリの埋め込み中にエラーが発生したため、語彙検索のみで検索します: {e}")
+                query_vectors = [None] * len(queries)
+
+            with tracer.span("rag.search", queries=len(queries)):
+                results = self.collections.search_batch(queries, query_vectors, k=config.CONTEXT_CANDIDATE_K,
+                                                        names=collections, nprobe=config.IVF_NPROBE,
+                                                        ef_search=config.HNSW_EF_SEARCH)
+            return [self._prepare_from_results(query, query_vector, relevant_docs, collections)
+                    for query, query_vector, relevant_docs in zip(queries, query_vectors, results)]
 
-    def retrieve_and_generate(self, query: str) -> Dict[str, Any]:
-        """RAGを使用して質問に回答"""
-        # ベクトルストアが空の場合
-        if self.vector_store.vector_store is None:
+    def generate_from_prepared(self, query: str, prepared: Dict[str, Any]) -> Dict[str, Any]:
+        """検索済みの生成準備からLLMで回答を生成"""
+        if "answer" in prepared:
+            return prepared
+
+        try:
+            with tracer.span("rag.llm") as span:
+                response = self.llm(prepared["messages"])
+                answer = response.content
+                record_llm_usage(span, prepared["messages"], answer,
+                                 response.response_metadata.get("token_usage"))
+        except Exception as e:
             return {
-                "answer": "資料に該当箇所が見当たりません。まず文書をアップロードしてください。",
+                "answer": f"回答生成中にエラーが発生しました: {str(e)}",
                 "sources": [],
-                "is_rag_response": False
+                "is_rag_response": True
             }
 
-        # 関連文書を検索
-        relevant_docs = self.vector_store.similarity_search_with_score(query)
+        return self._finish_generation(query, prepared, answer)
+
+    def stream_retrieve_and_generate(self, query: str, parent_span=None,
+                                     collections: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """retrieve_and_generate のストリーミング版
+
+        生成されたトークンを {"type": "token", "content": ...} として順次返し、
+        最後に retrieve_and_generate と同じ内容の {"type": "end", ...} を返す。
+        キャッシュ済みの回答や検索結果がない場合は、回答全体を1つのトークンとして返す。
+        """
+        # yield の間は呼び出し元のコンテキストに戻るため、spanは親を明示して開始・終了する
+        root = tracer.start_span("rag.stream_retrieve_and_generate", parent_span)
+        try:
+            with tracer.activate(root):
+                prepared = self._prepare_generation(query, collections)
+            if "answer" in prepared:
+                yield {"type": "token", "content": prepared["answer"]}
+                yield {"type": "end", **prepared}
+                return
+
+            chunks = []
+            span = tracer.start_span("rag.llm", root, streaming=True)
+            try:
+                for chunk in self.llm.stream(prepared["messages"]):
+                    if chunk.content:
+                        if not chunks and span.recording:
+                            span.set_attribute("time_to_first_token_ms", round(span.elapsed_ms(), 3))
+                        chunks.append(chunk.content)
+                        yield {"type": "token", "content": chunk.content}
+            except Exception as e:
+                span.record_error(e)
+                error = f"回答生成中にエラーが発生しました: {str(e)}"
+                yield {"type": "token", "content": f"\n\n{error}" if chunks else error}
+                yield {"type": "end", "answer": error, "sources": [], "is_rag_response": True}
+                return
+            finally:
+                record_llm_usage(span, prepared["messages"], "".join(chunks))
+                span.end()
+
+            yield {"type": "end", **self._finish_generation(query, prepared, "".join(chunks))}
+        finally:
+            root.end()
+
+    async def aretrieve_and_generate(self, query: str, collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        """retrieve_and_generate の非同期版（埋め込み・LLM呼び出しを待つ間イベントループを塞がない）"""
+        with tracer.span("rag.retrieve_and_generate"):
+            prepared = await self._aprepare_generation(query, collections)
+            if "answer" in prepared:
+                return prepared
+
+            try:
+                with tracer.span("rag.llm") as span:
+                    response = await self.llm.ainvoke(prepared["messages"])
+                    answer = response.content
+                    record_llm_usage(span, prepared["messages"], answer,
+                                     response.response_metadata.get("token_usage"))
+            except Exception as e:
+                return {
+                    "answer": f"回答生成中にエラーが発生しました: {str(e)}",
+                    "sources": [],
+                    "is_rag_response": True
+                }
+
+            return self._finish_generation(query, prepared, answer)
+
+    def _prepare_generation(self, query: str, collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        """関連文書を検索してプロンプトを作成
+
+        LLMを呼ばずに回答できる場合（文書がない・キャッシュ済み）は回答を、
+        それ以外は生成に必要な情報（messages など）を返す。
+        """
+        # 対象のコレクションが全て空の場合
+        if not self.collections.has_documents(collections):
+            return self._no_documents_result()
+
+        # 関連文書を検索（クエリの埋め込みは回答キャッシュの類似判定にも使う）
+        return self._prepare_from_vector(query, self._embed_query(query), collections)
+
+    def _embed_query(self, query: str) -> Optional[List[float]]:
+        """クエリを埋め込む
+
+        語彙検索が使える場合は EMBEDDING_TIMEOUT_SECONDS 秒で打ち切り、
+        失敗・タイムアウト時はNoneを返して語彙検索のみで回答する。
+        """
+        timeout = config.EMBEDDING_TIMEOUT_SECONDS
+        with tracer.span("rag.embed_query") as span:
+            try:
+                if timeout is None or not config.HYBRID_SEARCH_ENABLED:
+                    query_vector = self.collections.embeddings.embed_query(query)
+                else:
+                    future = self._embedding_executor.submit(self.collections.embeddings.embed_query, query)
+                    query_vector = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                print(f"クエリの埋め込みが{timeout}秒以内に終わらないため、語彙検索のみで検索します")
+                span.set_attribute("timed_out", True)
+                return None
+            except Exception as e:
+                print(f"クエリの埋め込み中にエラーが発生したため、語彙検索のみで検索します: {e}")
+                span.record_error(e)
+                return None
+            if span.recording:
+                span.set_attribute(INPUT_TOKENS, count_tokens(query, config.EMBEDDING_MODEL))
+            return query_vector
+
+    async def _aprepare_generation(self, query: str, collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        """_prepare_generation の非同期版（コレクションの読み込みと検索はCPU処理のためスレッドで実行）"""
+        if not await asyncio.to_thread(self.collections.has_documents, collections):
+            return self._no_documents_result()
+
+        timeout = config.EMBEDDING_TIMEOUT_SECONDS if config.HYBRID_SEARCH_ENABLED else None
+        with tracer.span("rag.embed_query") as span:
+            try:
+                query_vector = await asyncio.wait_for(self.collections.embeddings.aembed_query(query), timeout)
+                if span.recording:
+                    span.set_attribute(INPUT_TOKENS, count_tokens(query, config.EMBEDDING_MODEL))
+            except asyncio.TimeoutError:
+                print(f"クエリの埋め込みが{timeout}秒以内に終わらないため、語彙検索のみで検索します")
+                span.set_attribute("timed_out", True)
+                query_vector = None
+            except Exception as e:
+                print(f"クエリの埋め込み中にエラーが発生したため、語彙検索のみで検索します: {e}")
+                span.record_error(e)
+                query_vector = None
+        # to_thread はコンテキストを引き継ぐため、検索のspanも同じトレースに入る
+        return await asyncio.to_thread(self._prepare_from_vector, query, query_vector, collections)
 
+    @staticmethod
+    def _no_documents_result() -> Dict[str, Any]:
+        return {
+            "answer": "資料に該当箇所が見当たりません。まず文書をアップロードしてください。",
+            "sources": [],
+            "is_rag_response": False
+        }
+
+    def _prepare_from_vector(self, query: str, query_vector: Optional[List[float]],
+                             collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        """クエリの埋め込みから関連文書を検索してプロンプトを作成（埋め込みがなければ語彙検索のみ）"""
+        with tracer.span("rag.search", lexical_only=query_vector is None,
+                         collections=len(self.collections.resolve(collections))) as span:
+            # 検索時にも設定値を渡し、読み込み済みのインデックスにも現在の nprobe / efSearch を使う
+            relevant_docs = self.collections.search(query, query_vector, k=config.CONTEXT_CANDIDATE_K,
+                                                    names=collections, nprobe=config.IVF_NPROBE,
+                                                    ef_search=config.HNSW_EF_SEARCH)
+            span.set_attribute("documents", len(relevant_docs))
+        return self._prepare_from_results(query, query_vector, relevant_docs, collections)
+
+    def _prepare_from_results(self, query: str, query_vector: Optional[List[float]],
+                              relevant_docs: List[Tuple[Document, float]],
+                              collections: Optional[List[str]] = None) -> Dict[str, Any]:
+        """検索結果からプロンプトを作成"""
         if not relevant_docs:
             return {
                 "answer": "資料に該当箇所が見当たりません。",
@@ -66,18 +275,35 @@ class RAGRetriever:
                 "is_rag_response": True
             }
 
-        # 関連文書のコンテンツを結合
-        context = ""
-        sources = []
+        # 重複を除き、トークン数の上限まで参考文書を詰める
+        with tracer.span("rag.context_build") as span:
+            built = self.context_builder.build(query, relevant_docs)
+            span.set_attributes(candidates=built["candidates"], documents=len(built["documents"]),
+                                duplicates=built["duplicates"], trimmed=built["trimmed"],
+                                over_budget=built["over_budget"], context_tokens=built["tokens"])
+        context = built["context"]
 
-        for doc, score in relevant_docs:
-            context += f"\\n\\n【出典: {doc.metadata.get('source', '不明')} - ページ{doc.metadata.get('page', '不明')}】\\n"
-            context += doc.page_content
-            sources.append({
+        # 同じ（または言い換えの）質問に同じチャンクが選ばれた場合はキャッシュから返す
+        chunk_ids = [doc.metadata.get("chunk_id", "") for doc, _ in built["documents"]]
+        # 検索したコレクションごとにキャッシュを分け、他のコレクションの読み込み・解放・変更では無効にしない
+        collections = self.collections.resolve(collections)
+        corpus_version = self.collections.corpus_version(collections)
+        with tracer.span("rag.cache_lookup") as span:
+            cached = self.answer_cache.get(query, chunk_ids, corpus_version, query_vector, collections)
+            span.set_attribute("hit", cached is not None)
+        if cached is not None:
+            return {**cached, "cached": True}
+
+        span = tracer.start_span("rag.prompt_assembly", documents=len(built["documents"]))
+        sources = [
+            {
                 "source": doc.metadata.get('source', '不明'),
                 "page": doc.metadata.get('page', '不明'),
-                "score": score
-            })
+                "score": score,
+                **({"collection": doc.metadata["collection"]} if "collection" in doc.metadata else {})
+            }
+            for doc, score in built["documents"]
+        ]
 
         # プロンプトを作成
         system_prompt = """あなたは親切なアシスタントです。提供された文書の内容のみを基に、正確に質問に答えてください。
@@ -98,33 +324,44 @@ class RAGRetriever:
 
 【回答】"""
 
-        try:
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=user_prompt)
-            ]
+        messages = [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=user_prompt)
+        ]
+        if span.recording:
+            span.set_attributes(context_characters=len(context), prompt_tokens=count_message_tokens(messages))
+        span.end()
 
-            response = self.llm(messages)
-            answer = response.content
+        return {
+            "messages": messages,
+            "sources": sources,
+            "chunk_ids": chunk_ids,
+            "corpus_version": corpus_version,
+            "collections": collections,
+            "query_vector": query_vector
+        }
 
-            return {
-                "answer": answer,
-                "sources": sources,
-                "is_rag_response": True
-            }
+    def _finish_generation(self, query: str, prepared: Dict[str, Any], answer: str) -> Dict[str, Any]:
+        """生成した回答をキャッシュして結果を返す"""
+        result = {
+            "answer": answer,
+            "sources": prepared["sources"],
+            "is_rag_response": True
+        }
+        self.answer_cache.put(query, prepared["chunk_ids"], prepared["corpus_version"], result,
+                              prepared["query_vector"], prepared["collections"])
+        return {**result, "cached": False}
 
-        except Exception as e:
-            return {
-                "answer": f"回答生成中にエラーが発生しました: {str(e)}",
-                "sources": [],
-                "is_rag_response": True
-            }
+    def get_document_count(self, collections: Optional[List[str]] = None) -> int:
+        """保存されている文書数を取得（collections を省略すると既定のコレクション）"""
+        return self.collections.get_document_count(collections)
 
-    def get_document_count(self) -> int:
-        """保存されている文書数を取得"""
-        return self.vector_store.get_document_count()
+    def clear_documents(self, collection: Optional[str] = None) -> str:
+        """コレクション（省略時は既定のコレクション）の全ての文書をクリア"""
+        self.collections.clear(collection)
+        return "全ての文書がクリアされました。"
 
-    def clear_documents(self) -> str:
-        """全ての文書をクリア"""
-        self.vector_store.clear_vector_store()
-        return "全ての文書がクリアされました。"
\ No newline at end of file
+    def delete_collection(self, collection: str) -> str:
+        """コレクションを削除（既定のコレクションは文書をクリアするだけ）"""
+        self.collections.delete(collection)
+        return f"コレクション {collection} を削除しました。"
\ No newline at end of file
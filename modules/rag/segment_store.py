@@ -0,0 +1,468 @@
+import os
+import glob
+import json
+import hashlib
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple, Dict, Any, Optional, Set, Iterable
+import numpy as np
+from langchain.docstore.document import Document
+from .mapped_index import MappedSegment
+from .lexical_index import POSTINGS_ARRAYS, build_postings
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間ロックを行わない
+    fcntl = None
+
+class SegmentStore:
+    """追記専用のセグメントファイルとマニフェストでベクトルとメタデータを永続化
+
+    マニフェストの更新はファイルロックで排他し、更新前にディスクから読み直すため、
+    同じディレクトリを複数のプロセスで共有できる。
+    """
+
+    MANIFEST_NAME = "manifest.json"
+    LOCK_NAME = ".lock"
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: str = config.VECTOR_STORE_PATH,
+                 compaction_threshold: int = config.SEGMENT_COMPACTION_THRESHOLD):
+        self.path = path
+        self.compaction_threshold = compaction_threshold
+        self._lock = threading.Lock()
+        self._compaction_thread = None
+        self.manifest = self._read_manifest()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.path, self.MANIFEST_NAME)
+
+    def exists(self) -> bool:
+        """マニフェストが存在するかを確認"""
+        return os.path.exists(self.manifest_path)
+
+    def _empty_manifest(self) -> Dict[str, Any]:
+        # deleted は {チャンクID: 削除時点の next_segment}。それより前のセグメントの行だけを削除済みとみなし、
+        # 同じ内容のチャンクが後から再追加された場合は有効なまま扱う
+        # generation はチャンクの追加・削除のたびに増え、他のプロセスによる変更の検出に使う
+        # file_records_migrated はファイルの記録が全てのチャンクについて揃っているか（migrate_file_records を参照）
+        return {"version": self.FORMAT_VERSION, "next_segment": 1, "segments": [], "deleted": {}, "generation": 0,
+                "file_records_migrated": True}
+
+    @property
+    def generation(self) -> int:
+        """このインスタンスが最後に読み書きしたマニフェストの世代"""
+        return self.manifest.get("generation", 0)
+
+    def read_generation(self) -> int:
+        """ディスク上のマニフェストの世代"""
+        return self._read_manifest().get("generation", 0)
+
+    def manifest_stamp(self) -> Optional[Tuple[int, int, int]]:
+        """マニフェストファイルの識別子（置き換えのたびに変わる。読み直しが必要かの軽い判定用）"""
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @contextmanager
+    def _locked(self):
+        """プロセス内外の更新を排他し、最新のマニフェストを読み直してから処理する"""
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, self.LOCK_NAME), "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    self.manifest = self._read_manifest()
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _segment_seq(name: str) -> int:
+        return int(name.split("_")[-1])
+
+    def _deleted_in(self, name: str, deleted: Dict[str, int]) -> Set[str]:
+        """指定セグメントで削除済みとみなすチャンクID"""
+        seq = self._segment_seq(name)
+        return {chunk_id for chunk_id, before in deleted.items() if seq < before}
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        if not os.path.exists(self.manifest_path):
+            return self._empty_manifest()
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self) -> None:
+        """マニフェストを一時ファイル経由でアトミックに書き換え"""
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def _segment_files(self, name: str) -> Tuple[str, str, str]:
+        return (os.path.join(self.path, f"{name}.npy"),
+                os.path.join(self.path, f"{name}.jsonl"),
+                os.path.join(self.path, f"{name}.offsets.npy"))
+
+    def _ids_file(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.ids.npy")
+
+    def _postings_files(self, name: str) -> Dict[str, str]:
+        # n-gramの文字数を変えた場合は別のファイルとして作り直す
+        prefix = os.path.join(self.path, f"{name}.bm25-n{config.LEXICAL_NGRAM_SIZE}")
+        return {array_name: f"{prefix}.{array_name}.npy" for array_name in POSTINGS_ARRAYS}
+
+    def _remove_segment_files(self, name: str) -> None:
+        """セグメントのファイル（転置インデックスなどの付随ファイルを含む）を削除"""
+        for file_path in glob.glob(os.path.join(glob.escape(self.path), f"{name}.*")):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def _write_segment(self, name: str, ids: List[str], vectors: np.ndarray,
+                       documents: List[Document]) -> None:
+        vector_path, meta_path, offsets_path = self._segment_files(name)
+        os.makedirs(self.path, exist_ok=True)
+
+        with open(vector_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # メタデータは1行1レコードの文字列アリーナとし、各レコードの開始位置をオフセット表に記録
+        offsets = [0]
+        with open(meta_path, "wb") as f:
+            for chunk_id, doc in zip(ids, documents):
+                record = {"id": chunk_id, "page_content": doc.page_content, "metadata": doc.metadata}
+                line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._write_offsets(offsets_path, offsets)
+        self._write_ids(self._ids_file(name), ids)
+
+    def _write_ids(self, ids_path: str, ids: List[str]) -> None:
+        # 削除済みの行をJSONをデコードせずに判定できるよう、チャンクIDを固定長バイト列の配列で保存
+        tmp_path = f"{ids_path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray([chunk_id.encode("utf-8") for chunk_id in ids], dtype=np.bytes_))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, ids_path)
+
+    def _write_offsets(self, offsets_path: str, offsets: List[int]) -> None:
+        with open(offsets_path, "wb") as f:
+            np.save(f, np.asarray(offsets, dtype=np.int64))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_postings(self, name: str, texts: List[str]) -> None:
+        """セグメントの語彙検索用の転置インデックスを書き出す
+
+        検索語IDはプロセスによらず同じ値になるため、他のプロセスが同時に書き出しても内容は変わらない。
+        """
+        arrays = build_postings(texts)
+        for array_name, file_path in self._postings_files(name).items():
+            tmp_path = f"{file_path}.tmp{os.getpid()}"
+            with open(tmp_path, "wb") as f:
+                np.save(f, arrays[array_name])
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+
+    def postings_paths(self, name: str) -> Dict[str, str]:
+        """セグメントの転置インデックスのファイルパスを取得（無い場合はメタデータから作成）"""
+        paths = self._postings_files(name)
+        if not all(os.path.exists(file_path) for file_path in paths.values()):
+            _, meta_path, _ = self._segment_files(name)
+            with open(meta_path, "r", encoding="utf-8") as f:
+                texts = [json.loads(line)["page_content"] for line in f]
+            self.write_postings(name, texts)
+        return paths
+
+    def _read_segment(self, name: str) -> Tuple[List[str], np.ndarray, List[Document]]:
+        vector_path, meta_path, _ = self._segment_files(name)
+        vectors = np.load(vector_path)
+        ids = []
+        documents = []
+        with open(meta_path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                ids.append(record["id"])
+                documents.append(Document(page_content=record["page_content"], metadata=record["metadata"]))
+        return ids, vectors, documents
+
+    def segment_paths(self, name: str) -> Tuple[str, str, str]:
+        """セグメントのファイルパスを取得（オフセット表が無い場合は作成）"""
+        vector_path, meta_path, offsets_path = self._segment_files(name)
+        if not os.path.exists(offsets_path):
+            offsets = [0]
+            with open(meta_path, "rb") as f:
+                for line in f:
+                    offsets.append(offsets[-1] + len(line))
+            self._write_offsets(offsets_path, offsets)
+        return vector_path, meta_path, offsets_path
+
+    def ids_path(self, name: str) -> str:
+        """セグメントのチャンクID配列のファイルパスを取得（無い場合はメタデータから作成）"""
+        ids_path = self._ids_file(name)
+        if not os.path.exists(ids_path):
+            _, meta_path, _ = self._segment_files(name)
+            with open(meta_path, "r", encoding="utf-8") as f:
+                self._write_ids(ids_path, [json.loads(line)["id"] for line in f])
+        return ids_path
+
+    def _open_mapped(self, name: str, deleted: Dict[str, int], with_postings: bool) -> MappedSegment:
+        # 削除済みのチャンクがあるセグメントだけチャンクID配列を開く
+        deleted_ids = self._deleted_in(name, deleted)
+        return MappedSegment(*self.segment_paths(name), deleted_ids=deleted_ids,
+                             ids_path=self.ids_path(name) if deleted_ids else None,
+                             postings_paths=self.postings_paths(name) if with_postings else None)
+
+    def open_mapped_segments(self, with_postings: bool = False) -> List[MappedSegment]:
+        """マニフェスト上の全セグメントをメモリマップで開く
+
+        コンパクションによるマニフェストの差し替えと競合しないようロック内で開く。
+        差し替え後に旧ファイルが削除されても、開いたマップは有効なまま残る。
+        with_postings=True の場合は語彙検索用の転置インデックスも開く（無いセグメントは作成する）。
+        """
+        def open_all():
+            with self._lock:
+                manifest = self._read_manifest()
+                deleted = manifest.get("deleted", {})
+                return [self._open_mapped(segment["name"], deleted, with_postings)
+                        for segment in manifest["segments"]]
+        return self._retry_on_compaction(open_all)
+
+    def _retry_on_compaction(self, func):
+        """別のインスタンスのコンパクションで読み込み中にセグメントが消えた場合は、マニフェストから読み直す"""
+        for attempt in range(3):
+            try:
+                return func()
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def open_mapped_segment(self, name: str, with_postings: bool = False) -> MappedSegment:
+        """指定したセグメントをメモリマップで開く"""
+        with self._lock:
+            return self._open_mapped(name, self.manifest.get("deleted", {}), with_postings)
+
+    def metadata_bytes(self) -> int:
+        """メタデータ（本文を含む）のディスク上の合計バイト数"""
+        total = 0
+        for segment in self.list_segments():
+            meta_path = self._segment_files(segment["name"])[1]
+            if os.path.exists(meta_path):
+                total += os.path.getsize(meta_path)
+        return total
+
+    def list_segments(self) -> List[Dict[str, Any]]:
+        """ディスク上のマニフェストからセグメント一覧を取得"""
+        with self._lock:
+            return list(self._read_manifest()["segments"])
+
+    def append(self, ids: List[str], vectors, documents: List[Document]) -> str:
+        """新しいチャンクだけを新規セグメントとして追記"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._locked():
+            name = f"seg_{self.manifest['next_segment']:06d}"
+            self._write_segment(name, ids, vectors, documents)
+            self.manifest["next_segment"] += 1
+            self.manifest["segments"].append({"name": name, "count": len(ids), "dim": int(vectors.shape[1])})
+            self.manifest["generation"] = self.generation + 1
+            self._write_manifest()
+        return name
+
+    def load(self) -> Tuple[List[str], np.ndarray, List[Document]]:
+        """マニフェストを先頭から再生して全チャンクを読み込む（削除済みのチャンクは除く）"""
+        def read_all():
+            with self._lock:
+                manifest = self._read_manifest()
+            return self._read_live_rows(manifest["segments"], manifest.get("deleted", {}))
+        return self._retry_on_compaction(read_all)
+
+    def _read_live_rows(self, segments: List[Dict[str, Any]],
+                        deleted: Dict[str, int]) -> Tuple[List[str], np.ndarray, List[Document]]:
+        all_ids = []
+        all_vectors = []
+        all_documents = []
+        for segment in segments:
+            ids, vectors, documents = self._read_segment(segment["name"])
+            deleted_ids = self._deleted_in(segment["name"], deleted)
+            live = [row for row, chunk_id in enumerate(ids) if chunk_id not in deleted_ids]
+            all_ids.extend(ids[row] for row in live)
+            all_vectors.append(vectors[live])
+            all_documents.extend(documents[row] for row in live)
+
+        if not all_ids:
+            return [], np.zeros((0, 0), dtype=np.float32), []
+        return all_ids, np.vstack(all_vectors), all_documents
+
+    def add_tombstones(self, chunk_ids: Iterable[str]) -> None:
+        """チャンクを削除済みとして記録（実際の削除はコンパクション時に行う）"""
+        with self._locked():
+            deleted = self.manifest.setdefault("deleted", {})
+            for chunk_id in chunk_ids:
+                deleted[chunk_id] = self.manifest["next_segment"]
+            self.manifest["generation"] = self.generation + 1
+            self._write_manifest()
+
+    def _file_record_path(self, source: str) -> str:
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "files", f"{digest}.json")
+
+    def get_file_record(self, source: str) -> Optional[Dict[str, Any]]:
+        """取り込み済みファイルの記録（内容ハッシュとチャンクID）を取得"""
+        record_path = self._file_record_path(source)
+        if not os.path.exists(record_path):
+            return None
+        with open(record_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def put_file_record(self, source: str, file_hash: str, chunk_ids: List[str]) -> None:
+        """取り込んだファイルの記録を保存（ファイルごとに1つの小さなJSONを書き換える）"""
+        record_path = self._file_record_path(source)
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        tmp_path = f"{record_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"source": source, "hash": file_hash, "chunk_ids": chunk_ids}, f, ensure_ascii=False)
+        os.replace(tmp_path, record_path)
+
+    def migrate_file_records(self) -> int:
+        """ファイルの記録が無かった頃に取り込んだチャンクを source ごとにまとめて記録する
+
+        記録が無いと再アップロード時に古いチャンクを削除できず重複するため、最初の取り込み前に一度だけ
+        全セグメントのメタデータを走査する（済んだことはマニフェストに残す）。作成した記録の数を返す。
+        ハッシュは空にしておき、次のアップロードでは置換として処理して変わっていないチャンクを再利用する。
+        """
+        if self.manifest.get("file_records_migrated"):
+            return 0
+
+        with self._locked():
+            if self.manifest.get("file_records_migrated"):
+                return 0
+            deleted = self.manifest.get("deleted", {})
+            ids_by_source = {}
+            for segment in self.manifest["segments"]:
+                deleted_ids = self._deleted_in(segment["name"], deleted)
+                _, meta_path, _ = self._segment_files(segment["name"])
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        record = json.loads(line)
+                        source = record["metadata"].get("source")
+                        if source and record["id"] not in deleted_ids:
+                            ids_by_source.setdefault(source, {})[record["id"]] = True
+
+            migrated = 0
+            for source, chunk_ids in ids_by_source.items():
+                if not os.path.exists(self._file_record_path(source)):
+                    self.put_file_record(source, "", list(chunk_ids))
+                    migrated += 1
+
+            self.manifest["file_records_migrated"] = True
+            self._write_manifest()
+
+        if migrated:
+            print(f"既存のチャンクから {migrated} 件のファイルの記録を作成しました")
+        return migrated
+
+    def write_snapshot(self, ids: List[str], vectors, documents: List[Document]) -> None:
+        """既存の内容を破棄し、全チャンクを単一セグメントとして書き出す
+
+        ファイルの記録は書き出さないため、次の取り込みの前にチャンクの source から作り直す。
+        """
+        self.clear()
+        if ids:
+            self.append(ids, vectors, documents)
+            with self._locked():
+                self.manifest["file_records_migrated"] = False
+                self._write_manifest()
+
+    def compact_async(self) -> None:
+        """セグメント数が閾値を超えたか削除済みのチャンクがあれば、バックグラウンドでコンパクション"""
+        if len(self.manifest["segments"]) < self.compaction_threshold and not self.manifest.get("deleted"):
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+
+        self._compaction_thread = threading.Thread(target=self.compact, daemon=True)
+        self._compaction_thread.start()
+
+    def wait_for_compaction(self) -> None:
+        """実行中のコンパクションの完了を待つ"""
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+
+    def compact(self) -> None:
+        """既存のセグメントを1つに統合し、削除済みのチャンクを取り除く"""
+        try:
+            with self._locked():
+                targets = list(self.manifest["segments"])
+                deleted = dict(self.manifest.get("deleted", {}))
+                if not targets or (len(targets) < 2 and not deleted):
+                    return
+                # 他のプロセスが同じ名前を使わないよう、予約した番号をすぐに書き込む
+                name = f"seg_{self.manifest['next_segment']:06d}"
+                self.manifest["next_segment"] += 1
+                self._write_manifest()
+
+            # 統合中も追記できるよう、ロックの外で読み書きする
+            all_ids, merged_vectors, all_documents = self._read_live_rows(targets, deleted)
+            if all_ids:
+                self._write_segment(name, all_ids, merged_vectors, all_documents)
+                # mmapモードで転置インデックスを使っていれば、統合したセグメントの分も作っておく
+                if all(os.path.exists(self._postings_files(segment["name"])["lengths"]) for segment in targets):
+                    self.write_postings(name, [doc.page_content for doc in all_documents])
+
+            with self._locked():
+                target_names = {segment["name"] for segment in targets}
+                # 他のプロセスが同じセグメントを先に統合していたら、今回の結果は捨てる
+                current_names = {segment["name"] for segment in self.manifest["segments"]}
+                if not target_names <= current_names:
+                    self._remove_segment_files(name)
+                    return
+                remaining = [s for s in self.manifest["segments"] if s["name"] not in target_names]
+                merged = [{"name": name, "count": len(all_ids), "dim": int(merged_vectors.shape[1])}] if all_ids else []
+                self.manifest["segments"] = merged + remaining
+                # 統合前から存在した削除記録は、対象の行が全て取り除かれたので不要になる
+                self.manifest["deleted"] = {
+                    chunk_id: before for chunk_id, before in self.manifest.get("deleted", {}).items()
+                    if deleted.get(chunk_id) != before
+                }
+                self._write_manifest()
+
+            for segment in targets:
+                self._remove_segment_files(segment["name"])
+        except Exception as e:
+            print(f"セグメントのコンパクション中にエラーが発生しました: {e}")
+
+    def clear(self) -> None:
+        """全てのセグメントを削除し、空のマニフェストにする
+
+        他のプロセスが削除を検出できるよう、マニフェストは消さずに世代を進める。
+        """
+        self.wait_for_compaction()
+        if not self.exists():
+            return
+        with self._locked():
+            for segment in self.manifest["segments"]:
+                self._remove_segment_files(segment["name"])
+            shutil.rmtree(os.path.join(self.path, "files"), ignore_errors=True)
+            generation = self.generation + 1
+            next_segment = self.manifest["next_segment"]
+            self.manifest = self._empty_manifest()
+            self.manifest["generation"] = generation
+            self.manifest["next_segment"] = next_segment
+            self._write_manifest()
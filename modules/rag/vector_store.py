@@ -1,92 +1,436 @@
 import os
-import pickle
-from typing import List, Tuple, Optional
+import hashlib
+from typing import List, Tuple, Optional, Dict, Any
+import numpy as np
 from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.docstore.document import Document
+from .embedding_cache import EmbeddingCache, CachedEmbeddings
+from .segment_store import SegmentStore
+from .mapped_index import MappedDocumentList, MappedVectors, MappedIndex
+from .lexical_index import LexicalIndex, MappedLexicalIndex, reciprocal_rank_fusion
+from modules.core.rwlock import ReadWriteLock
+from modules.providers.registry import create_embeddings, get_embedding_model_name
+from .index_factory import select_index_type, build_index, build_search_params, is_quantized, index_bytes_per_chunk
 import config
 
 class VectorStore:
-    def __init__(self):
-        self.embeddings = OpenAIEmbeddings(openai_api_key=config.OPENAI_API_KEY)
+    def __init__(self, path: str = config.VECTOR_STORE_PATH, embeddings: Optional[CachedEmbeddings] = None):
+        # 複数のコレクションで埋め込みクライアントとキャッシュを共有する場合は embeddings を渡す
+        if embeddings is None:
+            embeddings = CachedEmbeddings(
+                create_embeddings(),
+                model_name=get_embedding_model_name(),
+                cache=EmbeddingCache()
+            )
+        self.embeddings = embeddings
+        self.embedding_cache = embeddings.cache
         self.vector_store = None
-        self.documents = []
+        self.segment_store = SegmentStore(path)
+        # 実際に作成したインデックスの種別と量子化方式（学習データが少ないと設定より単純なものになる）と、
+        # チャンク数から選んだ種別（学習し直す判定に使う）
+        self._index_type = None
+        self._quantization = None
+        self._selected_index_type = None
+        self._trained_count = 0
+        # 検索は並行に行い、チャンクの追加・削除・読み込みは検索と排他する
+        self.lock = ReadWriteLock()
+        # 量子化インデックスの再スコアリングに使う、ディスク上のfloat32ベクトル
+        self._exact_vectors = None
+        # コーパスが変わるたびに増える番号（回答キャッシュの無効化に使う）
+        self.corpus_version = 0
+        # インデックスに反映済みのマニフェストの世代（他のプロセスによる変更の検出に使う）
+        self._load_mode = config.VECTOR_STORE_LOAD_MODE
+        self._generation = 0
+        self._manifest_stamp = None
+        # ベクトルインデックスと同じ順にチャンクを追加する語彙検索用の転置インデックス
+        self.lexical_index = self._new_lexical_index()
+
+    @property
+    def documents(self) -> List[Document]:
+        """登録済みの文書チャンク（インデックスのdocstoreから参照し、複製は持たない）"""
+        vector_store = self.vector_store
+        if vector_store is None:
+            return []
+        if isinstance(vector_store, MappedIndex):
+            return MappedDocumentList(vector_store.segments)
+        with self.lock.read_lock():
+            if self.vector_store is None:
+                return []
+            docstore = self.vector_store.docstore
+            return [docstore.search(chunk_id) for chunk_id in self.vector_store.index_to_docstore_id.values()]
 
     def create_vector_store(self, documents: List[Document]) -> None:
         """文書からベクトルストアを作成"""
+        self.add_documents(documents)
+
+    def add_documents(self, documents: List[Document]) -> None:
+        """文書を埋め込んでインデックスに追加し、新しいチャンクだけをセグメントとして追記"""
+        ids, vectors = self.embed_documents(documents)
+        self.add_embedded_documents(ids, vectors, documents)
+
+    @staticmethod
+    def assign_chunk_ids(documents: List[Document]) -> List[str]:
+        """出典・ページ・本文のハッシュからチャンクIDを決めてメタデータに設定
+
+        同じ内容のチャンクは常に同じIDになるため、再アップロード時の差分検出に使える。
+        """
+        ids = []
+        for doc in documents:
+            key = f"{doc.metadata.get('source', '')}\0{doc.metadata.get('page', '')}\0{doc.page_content}"
+            chunk_id = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+            doc.metadata["chunk_id"] = chunk_id
+            ids.append(chunk_id)
+        return ids
+
+    def embed_documents(self, documents: List[Document]) -> Tuple[List[str], List[List[float]]]:
+        """チャンクにIDを割り当てて埋め込む（インデックスは変更しないため並行実行できる）"""
         if not documents:
             raise ValueError("文書が提供されていません")
 
-        self.documents.extend(documents)
+        ids = self.assign_chunk_ids(documents)
+        vectors = self.embeddings.embed_documents([doc.page_content for doc in documents])
+        return ids, vectors
 
-        if self.vector_store is None:
-            self.vector_store = FAISS.from_documents(documents, self.embeddings)
+    def add_embedded_documents(self, ids: List[str], vectors, documents: List[Document],
+                               compact: bool = True) -> None:
+        """埋め込み済みのチャンクをインデックスとセグメントに追加
+
+        続けて追加する場合は compact=False とし、最後に segment_store.compact_async() を1回だけ呼ぶ。
+        """
+        with self.lock.write_lock():
+            segment_name = self.segment_store.append(ids, vectors, documents)
+
+            if self.segment_store.generation != self._generation + 1:
+                # 他のプロセスが先にチャンクを追加・削除していたため、追記分も含めてディスクから読み直す
+                self._reload()
+            elif self.is_mapped():
+                # マップモードでは追記したセグメントをそのままマップして検索対象に加える
+                # （転置インデックスもセグメントごとに保存し、語彙検索はセグメントのリストを共有する）
+                if self.lexical_index is not None:
+                    self.segment_store.write_postings(segment_name, [doc.page_content for doc in documents])
+                self.vector_store.add_segment(self.segment_store.open_mapped_segment(
+                    segment_name, with_postings=self.lexical_index is not None))
+            else:
+                self._add_to_index(ids, vectors, documents)
+            self._generation = self.segment_store.generation
+            self.corpus_version += 1
+
+        if compact:
+            self.segment_store.compact_async()
+
+    def delete_chunks(self, chunk_ids, compact: bool = True) -> None:
+        """チャンクを削除（セグメントには削除記録を追記し、インデックスは残りのチャンクから作り直す）"""
+        chunk_ids = list(chunk_ids)
+        if not chunk_ids:
+            return
+
+        with self.lock.write_lock():
+            self.segment_store.add_tombstones(chunk_ids)
+            # IVF系やHNSWは位置を詰めた削除ができないため、どの種別でも残りのチャンクから作り直す
+            self._reload()
+
+        if compact:
+            self.segment_store.compact_async()
+
+    def refresh_if_changed(self) -> bool:
+        """他のプロセスがチャンクを追加・削除していればディスクから読み直す
+
+        通常はマニフェストファイルのstatを確認するだけなので、問い合わせごとに呼んでよい。
+        """
+        stamp = self.segment_store.manifest_stamp()
+        if stamp is None or stamp == self._manifest_stamp:
+            return False
+        self._manifest_stamp = stamp
+
+        if self.segment_store.read_generation() == self._generation:
+            return False
+        with self.lock.write_lock():
+            if self.segment_store.read_generation() == self._generation:
+                return False
+            self._reload()
+        return True
+
+    def _reload(self) -> None:
+        """マニフェストを再生してインデックスを作り直す（書き込みロックを保持して呼ぶ）
+
+        新しいインデックスはローカル変数に作ってから最後にまとめて差し替えるため、
+        ロックを取らずに参照する処理（文書数の取得など）が途中の空の状態を見ることはない。
+        """
+        # 読み込み中に更新された場合は、次回の refresh_if_changed で改めて読み直す
+        generation = self.segment_store.read_generation()
+
+        if self._load_mode == "mmap":
+            # 転置インデックスもセグメントごとに保存したものをマップし、コーパス全体を分割し直さない
+            segments = self.segment_store.open_mapped_segments(with_postings=config.HYBRID_SEARCH_ENABLED)
+            vector_store = MappedIndex(segments, self.embeddings)
+            lexical_index = MappedLexicalIndex(vector_store.segments) if config.HYBRID_SEARCH_ENABLED else None
+            self._install(vector_store, lexical_index)
         else:
-            # 既存のベクトルストアに文書を追加
-            new_vector_store = FAISS.from_documents(documents, self.embeddings)
-            self.vector_store.merge_from(new_vector_store)
+            ids, vectors, documents = self.segment_store.load()
+            if ids:
+                self._install(**self._build_memory_index(ids, vectors, documents))
+            else:
+                self._install(None, self._new_lexical_index())
+        self._generation = generation
+        self.corpus_version += 1
+
+    def _install(self, vector_store, lexical_index, exact_vectors=None, index_type: Optional[str] = None,
+                 quantization: Optional[str] = None, selected_index_type: Optional[str] = None,
+                 trained_count: int = 0) -> None:
+        """作り直したインデックス一式に差し替える（vector_store は最後に代入する）"""
+        self.lexical_index = lexical_index
+        self._exact_vectors = exact_vectors
+        self._index_type = index_type
+        self._quantization = quantization
+        self._selected_index_type = selected_index_type
+        self._trained_count = trained_count
+        self.vector_store = vector_store
+
+    def is_mapped(self) -> bool:
+        """メモリマップモードで読み込まれているかを判定"""
+        return isinstance(self.vector_store, MappedIndex)
+
+    def _build_memory_index(self, ids: List[str], vectors, documents: List[Document]) -> Dict[str, Any]:
+        """チャンクから新しいFAISSインデックスと転置インデックスを作成（現在のインデックスは変更しない）"""
+        selected_index_type = select_index_type(len(ids))
+        index, index_type, quantization = build_index(selected_index_type, np.asarray(vectors, dtype=np.float32))
+        vector_store = FAISS(self.embeddings, index, InMemoryDocstore(), {})
+        text_embeddings = list(zip([doc.page_content for doc in documents], vectors))
+        vector_store.add_embeddings(text_embeddings, metadatas=[doc.metadata for doc in documents], ids=ids)
+
+        lexical_index = self._new_lexical_index()
+        if lexical_index is not None:
+            lexical_index.add(ids, (doc.page_content for doc in documents))
+
+        # インデックスの通し番号はセグメントの再生順と一致するため、そのまま行番号として使える
+        exact_vectors = MappedVectors(self.segment_store.open_mapped_segments()) if is_quantized(index) else None
+        return {"vector_store": vector_store, "lexical_index": lexical_index, "exact_vectors": exact_vectors,
+                "index_type": index_type, "quantization": quantization,
+                "selected_index_type": selected_index_type, "trained_count": len(ids)}
+
+    def _add_to_index(self, ids: List[str], vectors, documents: List[Document]) -> None:
+        """計算済みのベクトルをFAISSインデックスに追加"""
+        if self.vector_store is None:
+            self._install(**self._build_memory_index(ids, vectors, documents))
+            return
+
+        total = len(ids) + self.vector_store.index.ntotal
+        index_type = select_index_type(total)
+        type_changed = index_type != self._selected_index_type
+        # 学習が必要なインデックスと、学習データが足りず単純な種別で作ったインデックスは、
+        # 学習時から大きく増えた場合に作り直す
+        outgrown = (
+            (is_quantized(self.vector_store.index) or self._index_type in ("ivf_flat", "ivf_pq")
+             or self._index_type != self._selected_index_type)
+            and total > self._trained_count * config.INDEX_RETRAIN_GROWTH_FACTOR
+        )
+        if type_changed or outgrown:
+            print(f"インデックスを {index_type} で再構築します（{total}チャンク）")
+            self._install(**self._build_memory_index(*self.segment_store.load()))
+            return
+
+        text_embeddings = list(zip([doc.page_content for doc in documents], vectors))
+        metadatas = [doc.metadata for doc in documents]
+        self.vector_store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        self._add_to_lexical_index(ids, documents)
+
+        if is_quantized(self.vector_store.index):
+            if self._exact_vectors is None or len(self._exact_vectors) != self.vector_store.index.ntotal:
+                self._exact_vectors = MappedVectors(self.segment_store.open_mapped_segments())
+
+    @staticmethod
+    def _new_lexical_index() -> Optional[LexicalIndex]:
+        return LexicalIndex() if config.HYBRID_SEARCH_ENABLED else None
+
+    def _add_to_lexical_index(self, ids: List[str], documents) -> None:
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, (doc.page_content for doc in documents))
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """複数の質問をまとめて埋め込む（キャッシュミス分だけを1回のバッチでAPIに送る）"""
+        # OpenAIの埋め込みは質問と文書で同じベクトルになるため、文書用のバッチAPIを使う
+        return self.embeddings.embed_documents(queries)
 
     def similarity_search(self, query: str, k: int = config.TOP_K_DOCUMENTS) -> List[Document]:
         """類似度検索を実行"""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def similarity_search_with_score(self, query: str, k: int = config.TOP_K_DOCUMENTS,
+                                     nprobe: Optional[int] = None,
+                                     ef_search: Optional[int] = None) -> List[Tuple[Document, float]]:
+        """スコア付きで類似度検索を実行
+
+        nprobe（IVF系）と ef_search（HNSW）で再現率と検索速度のバランスを調整できる。
+        """
         if self.vector_store is None:
             return []
 
         try:
-            results = self.vector_store.similarity_search(query, k=k)
-            return results
+            embedding = self.embeddings.embed_query(query)
+            return self.similarity_search_by_vector_with_score(embedding, k=k, nprobe=nprobe, ef_search=ef_search)
         except Exception as e:
             print(f"検索中にエラーが発生しました: {e}")
             return []
 
-    def similarity_search_with_score(self, query: str, k: int = config.TOP_K_DOCUMENTS) -> List[Tuple[Document, float]]:
-        """スコア付きで類似度検索を実行"""
-        if self.vector_store is None:
-            return []
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = config.TOP_K_DOCUMENTS,
+                                               nprobe: Optional[int] = None,
+                                               ef_search: Optional[int] = None) -> List[Tuple[Document, float]]:
+        """埋め込みベクトルでスコア付き類似度検索を実行"""
+        return self.similarity_search_by_vectors_with_score([embedding], k=k, nprobe=nprobe, ef_search=ef_search)[0]
 
-        try:
-            results = self.vector_store.similarity_search_with_score(query, k=k)
+    def similarity_search_by_vectors_with_score(self, embeddings: List[List[float]],
+                                                k: int = config.TOP_K_DOCUMENTS,
+                                                nprobe: Optional[int] = None,
+                                                ef_search: Optional[int] = None) -> List[List[Tuple[Document, float]]]:
+        """複数の埋め込みベクトルをまとめてスコア付き類似度検索（インデックスの検索は1回）"""
+        with self.lock.read_lock():
+            if self.vector_store is None or len(embeddings) == 0:
+                return [[] for _ in embeddings]
+
+            if self.is_mapped():
+                return self.vector_store.similarity_search_with_score_by_vectors(embeddings, k=k)
+
+            index = self.vector_store.index
+            query_vectors = np.asarray(embeddings, dtype=np.float32)
+
+            # 量子化インデックスでは候補を多めに取り、float32ベクトルで正確に再スコアリングする
+            fetch_k = k * config.RESCORE_CANDIDATE_FACTOR if self._exact_vectors is not None else k
+
+            params = build_search_params(index, nprobe=nprobe, ef_search=ef_search)
+            if params is not None:
+                scores, positions = index.search(query_vectors, fetch_k, params=params)
+            else:
+                scores, positions = index.search(query_vectors, fetch_k)
+
+            results = []
+            for query_vector, row_scores, row_positions in zip(query_vectors, scores, positions):
+                candidates = [(int(position), float(score)) for position, score in zip(row_positions, row_scores)
+                              if position != -1]
+
+                if self._exact_vectors is not None and candidates:
+                    exact = self._exact_vectors.take([position for position, _ in candidates])
+                    distances = ((exact - query_vector) ** 2).sum(axis=1)
+                    candidates = sorted(zip([position for position, _ in candidates], distances.tolist()),
+                                        key=lambda item: item[1])
+
+                docs_and_scores = []
+                for position, score in candidates[:k]:
+                    chunk_id = self.vector_store.index_to_docstore_id[position]
+                    docs_and_scores.append((self.vector_store.docstore.search(chunk_id), float(score)))
+                results.append(docs_and_scores)
             return results
-        except Exception as e:
-            print(f"検索中にエラーが発生しました: {e}")
-            return []
 
-    def save_vector_store(self, path: str = config.VECTOR_STORE_PATH) -> None:
-        """ベクトルストアを保存"""
+    def lexical_search_with_score(self, query: str, k: int = config.TOP_K_DOCUMENTS) -> List[Tuple[Document, float]]:
+        """文字n-gramのBM25で検索（スコアは大きいほど関連が高い。埋め込みを使わないため高速）"""
+        with self.lock.read_lock():
+            if self.vector_store is None or self.lexical_index is None:
+                return []
+            if self.is_mapped():
+                return [(self.vector_store.document_at_position(position), score)
+                        for position, score in self.lexical_index.search(query, k)]
+            docstore = self.vector_store.docstore
+            return [(docstore.search(self.lexical_index.chunk_ids[position]), score)
+                    for position, score in self.lexical_index.search(query, k)]
+
+    def hybrid_search_with_score(self, query: str, embedding: Optional[List[float]],
+                                 k: int = config.TOP_K_DOCUMENTS, nprobe: Optional[int] = None,
+                                 ef_search: Optional[int] = None) -> List[Tuple[Document, float]]:
+        """語彙検索とベクトル検索の結果を統合して検索（embedding がNoneなら語彙検索のみ）"""
+        return self.hybrid_search_by_vectors_with_score([query], [embedding], k=k, nprobe=nprobe,
+                                                        ef_search=ef_search)[0]
+
+    def hybrid_search_by_vectors_with_score(self, queries: List[str], embeddings: List[Optional[List[float]]],
+                                            k: int = config.TOP_K_DOCUMENTS, nprobe: Optional[int] = None,
+                                            ef_search: Optional[int] = None) -> List[List[Tuple[Document, float]]]:
+        """複数のクエリをハイブリッド検索（ベクトル検索は1回にまとめる）
+
+        それぞれ k * HYBRID_CANDIDATE_FACTOR 件を取得し、Reciprocal Rank Fusion で統合した上位k件を返す。
+        スコアはRRFの値（大きいほど関連が高い）。語彙検索が無効な場合はベクトル検索の結果をそのまま返す。
+        nprobe / ef_search はベクトル検索にそのまま渡す。
+        """
+        if self.lexical_index is None:
+            with_vectors = [index for index, embedding in enumerate(embeddings) if embedding is not None]
+            found = self.similarity_search_by_vectors_with_score([embeddings[index] for index in with_vectors], k=k,
+                                                                 nprobe=nprobe, ef_search=ef_search)
+            results = [[] for _ in queries]
+            for index, docs_and_scores in zip(with_vectors, found):
+                results[index] = docs_and_scores
+            return results
+
+        fetch_k = k * config.HYBRID_CANDIDATE_FACTOR
+        with_vectors = [index for index, embedding in enumerate(embeddings) if embedding is not None]
+        vector_results = dict(zip(with_vectors, self.similarity_search_by_vectors_with_score(
+            [embeddings[index] for index in with_vectors], k=fetch_k, nprobe=nprobe, ef_search=ef_search)))
+
+        results = []
+        for index, query in enumerate(queries):
+            lexical = self.lexical_search_with_score(query, fetch_k)
+            if index not in vector_results:
+                results.append(lexical[:k])
+                continue
+
+            documents = {}
+            rankings = []
+            for docs_and_scores in (vector_results[index], lexical):
+                ranking = []
+                for doc, _ in docs_and_scores:
+                    chunk_id = doc.metadata.get("chunk_id") or doc.page_content
+                    documents[chunk_id] = doc
+                    ranking.append(chunk_id)
+                rankings.append(ranking)
+            results.append([(documents[chunk_id], score) for chunk_id, score in reciprocal_rank_fusion(rankings)[:k]])
+        return results
+
+    def save_vector_store(self, path: Optional[str] = None) -> None:
+        """ベクトルストアを保存
+
+        チャンクは add_documents 時にセグメントとして追記済みのため、
+        同じパスへの保存ではコンパクションの完了を待つだけになる。
+        別のパスを指定した場合は全体を単一セグメントとして書き出す。
+        """
         if self.vector_store is None:
             print("保存するベクトルストアがありません")
             return
+        path = path or self.segment_store.path
 
         try:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.segment_store.wait_for_compaction()
 
-            # FAISSインデックスを保存
-            self.vector_store.save_local(path)
-
-            # 文書メタデータを別途保存
-            with open(f"{path}/documents.pkl", "wb") as f:
-                pickle.dump(self.documents, f)
+            if os.path.abspath(path) != os.path.abspath(self.segment_store.path):
+                ids, vectors, documents = self.segment_store.load()
+                SegmentStore(path).write_snapshot(ids, vectors, documents)
 
             print(f"ベクトルストアを {path} に保存しました")
         except Exception as e:
             print(f"ベクトルストア保存中にエラーが発生しました: {e}")
 
-    def load_vector_store(self, path: str = config.VECTOR_STORE_PATH) -> bool:
-        """保存されたベクトルストアを読み込み"""
+    def load_vector_store(self, path: Optional[str] = None,
+                          mode: str = config.VECTOR_STORE_LOAD_MODE) -> bool:
+        """保存されたベクトルストアを読み込み（マニフェストを再生）
+
+        path を省略すると作成時のパスから読み込む。
+        mode="mmap" の場合はベクトル行列とメタデータをメモリマップし、
+        起動時に全体をRAMへ読み込まない。
+        """
+        path = path or self.segment_store.path
         try:
             # ディレクトリが存在しない場合は作成
             os.makedirs(path, exist_ok=True)
 
-            if os.path.exists(f"{path}/index.faiss"):
-                self.vector_store = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+            if os.path.abspath(path) != os.path.abspath(self.segment_store.path):
+                self.segment_store = SegmentStore(path)
+            self._load_mode = mode
+
+            if not self.segment_store.exists() and os.path.exists(f"{path}/index.faiss"):
+                self._migrate_legacy_store(path)
 
-                # 文書メタデータを読み込み
-                documents_path = f"{path}/documents.pkl"
-                if os.path.exists(documents_path):
-                    with open(documents_path, "rb") as f:
-                        self.documents = pickle.load(f)
+            if self.segment_store.exists():
+                with self.lock.write_lock():
+                    self._reload()
 
                 print(f"ベクトルストアを {path} から読み込みました")
-                return True
+                return self.get_document_count() > 0
             else:
                 print(f"ベクトルストアファイルが見つかりません。新しく作成されます。")
                 return False
@@ -94,12 +438,95 @@ class VectorStore:
             print(f"ベクトルストア読み込み中にエラーが発生しました: {e}")
             return False
 
+    def _migrate_legacy_store(self, path: str) -> None:
+        """旧形式（index.faiss + documents.pkl）をセグメント形式に変換"""
+        legacy_store = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+        index = legacy_store.index
+        vectors = index.reconstruct_n(0, index.ntotal)
+
+        ids = []
+        documents = []
+        for position in range(index.ntotal):
+            chunk_id = legacy_store.index_to_docstore_id[position]
+            doc = legacy_store.docstore.search(chunk_id)
+            doc.metadata["chunk_id"] = chunk_id
+            ids.append(chunk_id)
+            documents.append(doc)
+
+        self.segment_store.write_snapshot(ids, vectors, documents)
+
+        for legacy_file in ("index.faiss", "index.pkl", "documents.pkl"):
+            legacy_path = os.path.join(path, legacy_file)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+
+        print(f"旧形式のベクトルストアをセグメント形式に変換しました（{len(ids)}チャンク）")
+
     def get_document_count(self) -> int:
         """保存されている文書数を取得"""
-        return len(self.documents)
+        # 読み込み直しと並行して呼ばれてもよいよう、参照は一度だけ取り出す
+        vector_store = self.vector_store
+        if vector_store is None:
+            return 0
+        if isinstance(vector_store, MappedIndex):
+            return len(MappedDocumentList(vector_store.segments))
+        return len(vector_store.index_to_docstore_id)
+
+    def get_index_type(self) -> Optional[str]:
+        """現在のインデックス種別を取得"""
+        vector_store = self.vector_store
+        if vector_store is None:
+            return None
+        if isinstance(vector_store, MappedIndex):
+            return "mmap"
+        if self._quantization:
+            return f"{self._index_type}+{self._quantization}"
+        return self._index_type
+
+    def get_memory_report(self) -> Dict[str, Any]:
+        """チャンクあたりの常駐メモリ（量子化前後）の概算を取得"""
+        vector_store = self.vector_store
+        count = self.get_document_count()
+        if vector_store is None or count == 0:
+            return {}
+
+        document_bytes = self.segment_store.metadata_bytes() / count
+        if isinstance(vector_store, MappedIndex):
+            if not vector_store.segments:
+                return {}
+            dim = vector_store.segments[0].vectors.shape[1]
+            float_bytes = float(dim * 4)
+            index_bytes = 0.0  # ページキャッシュ上にあり、プロセス固有のメモリは使わない
+            document_copies = 0
+        else:
+            index = vector_store.index
+            dim = index.d
+            float_bytes = float(index_bytes_per_chunk(index, dim, as_float32=True))
+            index_bytes = float(index_bytes_per_chunk(index, dim))
+            document_copies = 1
+
+        # 従来はfloat32ベクトルに加えて、docstore と self.documents の2つの文書コピーを保持していた
+        before = float_bytes + document_bytes * 2
+        after = index_bytes + document_bytes * document_copies
+        return {
+            "quantization": self._quantization or "none",
+            "dimension": dim,
+            "float32_index_bytes_per_chunk": float_bytes,
+            "index_bytes_per_chunk": index_bytes,
+            "bytes_per_chunk_before": round(before, 1),
+            "bytes_per_chunk_after": round(after, 1),
+            "reduction_ratio": round(before / after, 2) if after else None
+        }
+
+    def get_embedding_cache_stats(self) -> Dict[str, Any]:
+        """埋め込みキャッシュの統計情報を取得"""
+        return self.embedding_cache.get_stats()
 
     def clear_vector_store(self) -> None:
         """ベクトルストアをクリア"""
-        self.vector_store = None
-        self.documents = []
+        with self.lock.write_lock():
+            self._install(None, self._new_lexical_index())
+            self.corpus_version += 1
+            self.segment_store.clear()
+            self._generation = self.segment_store.generation
         print("ベクトルストアをクリアしました")
\ No newline at end of file
@@ -0,0 +1,248 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import uvicorn
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from modules.core.shared import get_shared_chatbot
+from modules.core.tracing import tracer
+import config
+
+class QueryRequest(BaseModel):
+    query: str
+    session_id: Optional[str] = None
+    collections: Optional[List[str]] = None  # 省略時は既定のコレクション、複数なら横断して検索
+
+
+class UploadedFileAdapter:
+    """UploadFile をStreamlitのアップロードファイルと同じ形（name / getbuffer）で扱う"""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self._data = data
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._data)
+
+
+class RequestLimiter:
+    """同時処理数を制限し、処理待ちが上限を超えたリクエストは503で拒否する"""
+
+    def __init__(self, max_concurrency: int = config.SERVER_MAX_CONCURRENCY,
+                 max_queue: int = config.SERVER_MAX_QUEUE,
+                 queue_timeout: float = config.SERVER_QUEUE_TIMEOUT_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.draining = False
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def acquire(self) -> None:
+        """処理枠を確保（確保できなければHTTPException(503)）"""
+        if self.draining:
+            raise HTTPException(status_code=503, detail="サーバーは停止処理中です")
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="混雑しています。しばらくしてから再度お試しください",
+                                headers={"Retry-After": "1"})
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="処理待ちがタイムアウトしました",
+                                headers={"Retry-After": "1"})
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        """処理枠を確保して処理するコンテキストマネージャ"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def drain(self, timeout: float) -> None:
+        """新しいリクエストを拒否し、処理中・処理待ちのリクエストが終わるまで待つ"""
+        self.draining = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self.active or self.waiting) and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+    def get_stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "draining": self.draining
+        }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にChatBotを読み込み、停止時は処理中のリクエストの完了を待つ"""
+    app.state.chatbot = await run_in_threadpool(get_shared_chatbot)
+    app.state.limiter = RequestLimiter()
+    yield
+    await app.state.limiter.drain(config.SERVER_SHUTDOWN_TIMEOUT_SECONDS)
+    # 書きかけのコンパクションを待ってから終了する
+    await run_in_threadpool(app.state.chatbot.rag_retriever.collections.wait_for_compaction)
+
+
+app = FastAPI(title=config.APP_TITLE, lifespan=lifespan)
+
+
+async def resolve_collections(chatbot, collections: Optional[List[str]]) -> List[str]:
+    """コレクション名を検証（使えない名前は400を返す）"""
+    try:
+        return await run_in_threadpool(chatbot.rag_retriever.collections.resolve, collections)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/query")
+async def query(request: QueryRequest):
+    """質問に回答"""
+    chatbot = app.state.chatbot
+    async with app.state.limiter.slot():
+        # 他のワーカーが追加・削除した文書を反映
+        await run_in_threadpool(chatbot.refresh_documents)
+        # 保存済みの会話履歴の読み込みはSQLiteを使うため、スレッドで行う
+        collections = await resolve_collections(chatbot, request.collections)
+        memory = await run_in_threadpool(chatbot.create_memory, request.session_id)
+        return await chatbot.aprocess_query(request.query, memory, collections)
+
+
+@app.post("/query/stream")
+async def query_stream(request: QueryRequest):
+    """質問への回答を1行1イベントのJSON（NDJSON）でストリーミング"""
+    chatbot = app.state.chatbot
+    limiter = app.state.limiter
+
+    await limiter.acquire()
+    try:
+        collections = await resolve_collections(chatbot, request.collections)
+        await run_in_threadpool(chatbot.refresh_documents)
+        memory = await run_in_threadpool(chatbot.create_memory, request.session_id)
+    except Exception:
+        limiter.release()
+        raise
+
+    async def events():
+        # 処理枠はストリームの終了（クライアントの切断を含む）まで保持する
+        try:
+            async for event in iterate_in_threadpool(chatbot.stream_query(request.query, memory, collections)):
+                yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        finally:
+            limiter.release()
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.get("/documents")
+async def get_documents(collection: Optional[str] = None):
+    """コレクション（省略時は既定のコレクション）の登録文書数を取得"""
+    chatbot = app.state.chatbot
+    collections = await resolve_collections(chatbot, [collection] if collection else None)
+    await run_in_threadpool(chatbot.refresh_documents)
+    return {"collection": collections[0],
+            "document_count": await run_in_threadpool(chatbot.get_document_count, collections)}
+
+
+@app.post("/documents")
+async def add_documents(files: List[UploadFile] = File(...), collection: Optional[str] = None):
+    """文書をアップロードしてコレクション（省略時は既定のコレクション、なければ作成）に追加"""
+    chatbot = app.state.chatbot
+    collections = await resolve_collections(chatbot, [collection] if collection else None)
+    async with app.state.limiter.slot():
+        uploaded_files = [UploadedFileAdapter(file.filename, await file.read()) for file in files]
+        message = await run_in_threadpool(chatbot.add_documents, uploaded_files, None, collections[0])
+        return {"message": message, "collection": collections[0],
+                "document_count": await run_in_threadpool(chatbot.get_document_count, collections)}
+
+
+@app.delete("/documents")
+async def clear_documents(collection: Optional[str] = None):
+    """コレクション（省略時は既定のコレクション）の全ての文書をクリア"""
+    chatbot = app.state.chatbot
+    collections = await resolve_collections(chatbot, [collection] if collection else None)
+    async with app.state.limiter.slot():
+        message = await run_in_threadpool(chatbot.clear_documents, collections[0])
+        return {"message": message, "collection": collections[0]}
+
+
+@app.get("/collections")
+async def list_collections():
+    """コレクションの一覧と、読み込み済みのコレクションの状態を取得"""
+    chatbot = app.state.chatbot
+    # rag_retriever は初回参照時に読み込みを待つため、イベントループの外で取得する
+    return {
+        "collections": await run_in_threadpool(chatbot.list_collections),
+        **await run_in_threadpool(lambda: chatbot.rag_retriever.collections.get_stats())
+    }
+
+
+@app.delete("/collections/{collection}")
+async def delete_collection(collection: str):
+    """コレクションを削除（既定のコレクションは文書をクリアするだけ）"""
+    chatbot = app.state.chatbot
+    collections = await resolve_collections(chatbot, [collection])
+    async with app.state.limiter.slot():
+        message = await run_in_threadpool(chatbot.delete_collection, collections[0])
+        return {"message": message}
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """セッションの会話履歴（保存済みのものを含む）を削除"""
+    await run_in_threadpool(lambda: app.state.chatbot.agent_manager.memory_store.delete(session_id))
+    return {"session_id": session_id}
+
+
+@app.get("/status")
+async def status():
+    """システムとサーバーの状態を取得"""
+    chatbot = app.state.chatbot
+    await run_in_threadpool(chatbot.refresh_documents)
+    system_status = await run_in_threadpool(chatbot.get_system_status)
+    return {
+        **system_status,
+        "server": app.state.limiter.get_stats()
+    }
+
+
+@app.get("/metrics")
+async def metrics(traces: int = 0):
+    """処理段階ごとのレイテンシ・トークン数の集計（traces を指定すると直近のトレースも返す）"""
+    return {
+        "stages": tracer.get_stage_summary(),
+        "server": app.state.limiter.get_stats(),
+        "recent_traces": tracer.get_recent_traces(limit=traces) if traces else []
+    }
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "server:app",
+        host=config.SERVER_HOST,
+        port=config.SERVER_PORT,
+        workers=config.SERVER_WORKERS,
+        timeout_graceful_shutdown=config.SERVER_SHUTDOWN_TIMEOUT_SECONDS
+    )
@@ -0,0 +1,33 @@
+from modules.rag.answer_cache import AnswerCache
+
+RESPONSE = {"answer": "20日です", "sources": [], "is_rag_response": True}
+
+
+def test_entries_are_scoped_by_collections():
+    cache = AnswerCache(similarity_threshold=None)
+    cache.put("有給は何日？", ["a"], (("hr", 1, 1),), RESPONSE, collections=["hr"])
+
+    assert cache.get("有給は何日？", ["a"], (("hr", 1, 1),), collections=["hr"]) == RESPONSE
+    assert cache.get("有給は何日？", ["a"], (("hr", 1, 1), ("it", 1, 1)), collections=["it", "hr"]) is None
+
+
+def test_other_collection_versions_do_not_invalidate():
+    cache = AnswerCache(similarity_threshold=None)
+    cache.put("有給は何日？", ["a"], (("hr", 1, 1),), RESPONSE, collections=["hr"])
+    cache.put("VPNは？", ["b"], (("it", 1, 1),), RESPONSE, collections=["it"])
+    # it のコレクションが変わっても hr の回答は使える
+    assert cache.get("VPNは？", ["b"], (("it", 1, 2),), collections=["it"]) is None
+    assert cache.get("有給は何日？", ["a"], (("hr", 1, 1),), collections=["hr"]) == RESPONSE
+
+
+def test_similar_queries_match_only_within_scope():
+    cache = AnswerCache(max_entries=2, similarity_threshold=0.9)
+    cache.put("有給は何日？", ["a"], 1, RESPONSE, query_vector=[1.0, 0.0], collections=["hr"])
+    cache.put("VPNは？", ["b"], 1, RESPONSE, query_vector=[1.0, 0.0], collections=["it"])
+
+    assert cache.get("有給休暇の日数", ["a"], 1, query_vector=[2.0, 0.1], collections=["hr"]) == RESPONSE
+    assert cache.get("有給休暇の日数", ["c"], 1, query_vector=[2.0, 0.1], collections=["hr"]) is None
+    # 上限を超えて削除されたエントリはスコープの索引からも消える
+    cache.put("経費精算", ["d"], 1, RESPONSE, query_vector=[0.0, 1.0], collections=["hr"])
+    assert cache.get("VPNの設定", ["b"], 1, query_vector=[1.0, 0.0], collections=["it"]) is None
+    assert (("it",), frozenset(["b"])) not in cache._scopes
@@ -0,0 +1,30 @@
+import time
+import pytest
+from modules.agents.tools import LocalCalculator
+
+
+@pytest.fixture
+def calculator():
+    return LocalCalculator()
+
+
+def test_power(calculator):
+    assert calculator.calculate("2の10乗を計算して") == "計算結果: 1024"
+    assert calculator.calculate("2^3") == "計算結果: 8"
+
+
+def test_nested_power_is_rejected_quickly(calculator):
+    started = time.perf_counter()
+    assert calculator.calculate("((9^999)^999)^999を計算") is None
+    assert time.perf_counter() - started < 1.0
+
+
+def test_result_size_is_bounded(calculator):
+    with pytest.raises(ValueError):
+        calculator.evaluate("(9**999)**999")
+    with pytest.raises(ValueError):
+        calculator.evaluate("2**4000*2**4000")
+
+
+def test_negative_exponent(calculator):
+    assert calculator.calculate("5の-2乗は？") == "計算結果: 0.04"
@@ -0,0 +1,22 @@
+from modules.agents.memory import ConversationStore
+
+
+def test_evicted_session_in_use_is_not_duplicated(tmp_path):
+    store = ConversationStore(None, path=str(tmp_path / "conversations.sqlite3"), max_sessions=1)
+    held = store.get("a")
+    store.get("b")  # a をメモリから破棄する
+
+    again = store.get("a")
+    assert again is held
+
+    held.save_context({"input": "q1"}, {"output": "r1"})
+    again.save_context({"input": "q2"}, {"output": "r2"})
+    assert [message.content for message in store.get("a").messages] == ["q1", "r1", "q2", "r2"]
+
+
+def test_evicted_session_is_reloaded_from_disk(tmp_path):
+    store = ConversationStore(None, path=str(tmp_path / "conversations.sqlite3"), max_sessions=1)
+    store.get("a").save_context({"input": "q1"}, {"output": "r1"})
+    store.get("b")
+
+    assert [message.content for message in store.get("a").messages] == ["q1", "r1"]
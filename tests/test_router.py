@@ -0,0 +1,37 @@
+import pytest
+from modules.agents.tools import LocalCalculator
+from modules.agents.router import QueryRouter, ROUTE_MATH, ROUTE_RAG, ROUTE_SMALLTALK
+
+
+@pytest.fixture
+def router():
+    return QueryRouter(LocalCalculator())
+
+
+@pytest.mark.parametrize("query", [
+    "こんにちは",
+    "おはようございます！",
+    "ありがとうございます。",
+    "よろしくお願いします",
+    "お疲れ様です！",
+    "Hello",
+    "thanks!",
+])
+def test_greeting_only_is_smalltalk(router, query):
+    assert router.route(query) == ROUTE_SMALLTALK
+
+
+@pytest.mark.parametrize("query", [
+    "こんにちは、有給は何日？",
+    "お疲れ様です。交通費の上限は？",
+    "Hi, what is the refund policy?",
+    "ありがとう、経費精算の締め日も教えて",
+    "元気な職場づくりの取り組みは？",
+])
+def test_greeting_with_question_goes_to_rag(router, query):
+    assert router.route(query) == ROUTE_RAG
+
+
+@pytest.mark.parametrize("query", ["2の3乗", "2の3乗は？", "１０の２乗", "5の-2乗は？"])
+def test_power_is_math(router, query):
+    assert router.route(query) == ROUTE_MATH